@@ -23,6 +23,8 @@ from pdb import set_trace
 
 import sqlite3
 import os
+import threading
+import time
 
 from sqlassist import SQLassist
 from sqlbackend import LibrarianDBackendSQL
@@ -38,14 +40,27 @@ class SQLite3assist(SQLassist):
     # Crossover data so all "base" classes have it.
     SCHEMA_VERSION = LibrarianDBackendSQL.SCHEMA_VERSION
 
+    # How long to wait for another connection's write lock
+    BUSY_SECS = 60.0
+
+    # Compiled statements kept per connection, looked up by SQL text.
+    # LibrarianDBackendSQL builds a few dozen shapes, plus one per path
+    # depth walked, so this is room for all of them many times over.
+    CACHED_STATEMENTS = 512
+
     def DBconnect(self):
         try:
             uri = 'file:%s' % self.db_file
             if self.ro:
                 uri += '?mode=ro'
-            self._conn = sqlite3.connect(uri,
-                                         uri=True,
-                                         isolation_level='EXCLUSIVE')
+            # A reader can't take the write lock; DEFERRED gives it a
+            # snapshot from its first SELECT to the end of the command.
+            self._conn = sqlite3.connect(
+                uri,
+                uri=True,
+                timeout=self.BUSY_SECS,
+                cached_statements=self.CACHED_STATEMENTS,
+                isolation_level='DEFERRED' if self.ro else 'EXCLUSIVE')
             self._cursor = self._conn.cursor()
         except Exception as e:
             raise RuntimeError('Cannot open %s: %s' % (self.db_file, str(e)))
@@ -60,6 +75,145 @@ class SQLite3assist(SQLassist):
     def __init__(self, **kwargs):
         super(self.__class__, self).__init__(**kwargs)
         self.DBname = kwargs['db_file']
+        self._batches = [ ]     # total_changes at each open begin()
+        self._clean = self._conn.total_changes
+        self.commits = 0        # transactions committed ...
+        self.aborts = 0         # ... and lost with changes in them
+        self.write_waits = dict(acquired=0, contended=0,
+                                wait_secs=0.0, max_wait_secs=0.0)
+
+    # Command batching.  Between begin() and end() the commit() calls made
+    # by the upper layers are absorbed, and a failure only unwinds back to
+    # the SAVEPOINT.  end() leaves the work in the enclosing transaction;
+    # the caller decides when that really gets committed.  begin() nests,
+    # one SAVEPOINT per level, so one command of a batch can fail alone.
+
+    @property
+    def batching(self):
+        return bool(self._batches)
+
+    def _savepoint(self, level=None):
+        return 'batch%d' % (level or len(self._batches))
+
+    # With "lazy" set, begin() leaves the transaction for later.  Reads
+    # before the first write run outside of one, and that write opens it
+    # with BEGIN IMMEDIATE, waiting for SQLite's one write lock.  Several
+    # lazy connections to one database can then read side by side.  What
+    # they read might change before they write unless the caller keeps
+    # them apart some other way.  Lazy connections in one process queue for
+    # the write lock on a threading.Lock first: SQLite's busy handler only
+    # polls, sleeping longer each time, so a writer that just missed the
+    # lock could otherwise idle long after it's free.
+
+    lazy = False
+    _batches = ()
+    _writing = False
+    _WRITES = ('INSERT', 'UPDATE', 'DELETE', 'REPLAC')
+    _write_locks = { }
+    _write_locks_mutex = threading.Lock()
+
+    @property
+    def _write_lock(self):
+        path = os.path.realpath(self.db_file)
+        with self._write_locks_mutex:
+            return self._write_locks.setdefault(path, threading.Lock())
+
+    def _done_writing(self):
+        if self._writing and not self._conn.in_transaction:
+            self._writing = False
+            self._write_lock.release()
+
+    def execute(self, query, parms=None):
+        if self.lazy and self._batches and \
+           not self._conn.in_transaction and \
+           query.lstrip()[:6].upper() in self._WRITES:
+            self.hold_writes()
+        return self.__getattr__('execute')(query, parms)
+
+    def hold_writes(self):
+        '''Open the transaction begin() put off, as the writer.'''
+        if not self.lazy or self._conn.in_transaction:
+            return
+        t0 = time.time()
+        self._write_lock.acquire()
+        self._writing = True
+        try:
+            self._cursor.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self._done_writing()
+            raise
+        waited = time.time() - t0
+        stats = self.write_waits
+        stats['acquired'] += 1
+        if waited > 0.001:      # more than just the BEGIN itself
+            stats['contended'] += 1
+            stats['wait_secs'] += waited
+            stats['max_wait_secs'] = max(stats['max_wait_secs'], waited)
+        for level in range(1, len(self._batches) + 1):
+            self._batches[level - 1] = self._conn.total_changes
+            self._cursor.execute('SAVEPOINT %s' % self._savepoint(level))
+
+    def begin(self):
+        if self.lazy and not self._conn.in_transaction:
+            self._batches.append(None)      # for hold_writes() to fill
+            return
+        if not self._conn.in_transaction:
+            self._cursor.execute('BEGIN %s' % self._conn.isolation_level)
+        self._batches.append(self._conn.total_changes)
+        self._cursor.execute('SAVEPOINT %s' % self._savepoint())
+
+    def end(self, ok=True):
+        '''Returns True if changes made since begin() were discarded.'''
+        assert self._batches, 'end() without begin()'
+        savepoint = self._savepoint()
+        changes = self._batches.pop()
+        if changes is None:     # lazy, and nothing was written
+            return False
+        undo = not ok and self._conn.total_changes != changes
+        try:
+            if undo:
+                self._cursor.execute('ROLLBACK TO %s' % savepoint)
+            self._cursor.execute('RELEASE %s' % savepoint)
+        except sqlite3.Error:
+            # Some errors (I/O, full disk) make SQLite abandon the whole
+            # transaction, and with it anything else not yet committed.
+            if self._conn.in_transaction:
+                raise
+            self._clean = self._conn.total_changes
+            self.aborts += 1
+            self._done_writing()
+            return True
+        if self._batches:
+            return undo
+        if self._conn.in_transaction and not self.pending:
+            self._conn.commit()     # drop the lock of a read-only batch
+            self._done_writing()
+        return undo
+
+    @property
+    def pending(self):
+        '''Changes exist that have not been committed'''
+        return (self._conn.in_transaction and
+                self._conn.total_changes != self._clean)
+
+    def commit(self):
+        if self._batches:
+            return
+        self._conn.commit()
+        self._clean = self._conn.total_changes
+        self.commits += 1
+        self._done_writing()
+
+    def rollback(self):
+        if self._batches:
+            if self._batches[-1] is not None:
+                self._cursor.execute('ROLLBACK TO %s' % self._savepoint())
+            return
+        if self.pending:
+            self.aborts += 1
+        self._conn.rollback()
+        self._clean = self._conn.total_changes
+        self._done_writing()
 
     def schema(self, table):
         self.execute(self._SQLshowschema.format(table))
@@ -173,12 +327,36 @@ class LibrarianDBackendSQLite3(LibrarianDBackendSQL):
             help='SQLite3 database backing store file',
             type=str,
             default="/var/hpetm/librarian.db")
+        parser.add_argument(
+            '--durability',
+            help='full: fsync every commit; normal: fsync the WAL only at '
+                 'checkpoints; deferred: never fsync, leave it to the OS',
+            choices=sorted(LibrarianDBackendSQLite3._SYNCHRONOUS.keys()),
+            default='full')
+        parser.add_argument(
+            '--group_commit_ms',
+            help='hold commits this long to batch consecutive commands, '
+                 'and their replies with them (0 commits every command)',
+            type=int,
+            default=0)
+        parser.add_argument(
+            '--shard',
+            help='K/N: serve shard K of N from a database made by '
+                 'shard_router.py --split (default: not sharded)',
+            type=str,
+            default=None)
+
+    _SYNCHRONOUS = {
+        'full':     'FULL',
+        'normal':   'NORMAL',
+        'deferred': 'OFF',
+    }
 
-    def __init__(self, args):
+    def __init__(self, args, ro=False, lazy=False):
         if not os.path.isfile(args.db_file):
             raise RuntimeError('DB file "%s" does not exist' % args.db_file)
         try:
-            self._cur = SQLite3assist(db_file=args.db_file)
+            self._cur = SQLite3assist(db_file=args.db_file, ro=ro, lazy=lazy)
             self._cur.execute('SELECT schema_version FROM globals')
             tmp = self._cur.fetchone()
         except Exception as e:
@@ -186,4 +364,25 @@ class LibrarianDBackendSQLite3(LibrarianDBackendSQL):
         assert tmp is not None and isinstance(tmp, tuple) and tmp, \
             '"%s" is not a valid Librarian database' % self._cur.DBname
         assert tmp[0] == self._cur.SCHEMA_VERSION, \
-            'Schema version mismatch in DB "%s"' % self._cur.DBname
+            'Schema version mismatch in DB "%s": "%s", not "%s" ' \
+            '(db_migrate.py upgrades it)' % (
+                self._cur.DBname, tmp[0], self._cur.SCHEMA_VERSION)
+        durability = getattr(args, 'durability', 'full')
+        self._cur.execute('PRAGMA synchronous=%s' %
+                          self._SYNCHRONOUS[durability])
+        self.group_commit_secs = getattr(args, 'group_commit_ms', 0) / 1000.0
+        shard = getattr(args, 'shard', None)
+        if shard:
+            try:
+                k, n = (int(i) for i in shard.split('/'))
+            except ValueError as e:
+                raise RuntimeError('--shard takes K/N, not "%s"' % shard)
+            assert 0 <= k < n, 'Shard %d/%d does not exist' % (k, n)
+            self.shard = (k, n)
+        self._args = args
+
+    def reader(self):
+        '''Another backend on this database for a reader thread (see
+           LibrarianCommandEngine.start_readers()).  It can't write, so it
+           never waits for the write lock, and sees only what's committed.'''
+        return self.__class__(self._args, ro=True)
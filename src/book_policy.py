@@ -24,8 +24,12 @@ import errno
 import os
 import random
 import sys
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from itertools import accumulate, islice
 from pdb import set_trace
 from collections import defaultdict
+from copy import copy
 
 from book_shelf_bos import TMBook
 from frdnode import BooksIGInterpretation as BII    # for constants
@@ -42,6 +46,113 @@ def _node_id2ig(node_id, mode=BII.MODE_LZA):
     # Overload IG field with BIImode before DB query
     return (node_id - 1) | (mode << BII.MODE_SHIFT)
 
+#--------------------------------------------------------------------------
+# Asking SQL for every FREE book in an IG, building a TMBook for each, and
+# then shuffling the lot to hand back a few gets expensive on a full rack.
+# Keep the FREE book ids in memory, one sorted array per intlv_group value
+# (BII mode bits included, exactly as stored in the books table).  The
+# books table is still the source of truth: picks are materialized from
+# SQL and checked, and any disagreement forces a rebuild.  Engines on
+# other threads share the index through a view(); the engine makes sure
+# only the database's current writer changes it.
+
+
+class FreeBooks(object):
+
+    RANDOM = 'random'
+    ASCENDING = 'ascending'
+    DESCENDING = 'descending'
+
+    def __init__(self, db):
+        self.db = db
+        self.changes = 0    # lets a caller notice add()/discard() traffic
+        self._free = defaultdict(list)
+        self.rebuild()
+
+    def view(self, db):
+        '''The same index, read through another backend.  changes counts
+           only what goes through this view.'''
+        view = copy(self)
+        view.db = db
+        view.changes = 0
+        return view
+
+    def rebuild(self):
+        '''(Re)load the index from the books table.'''
+        self._free.clear()      # in place, for every view
+        for book_id, intlv_group in self.db.get_book_ids(TMBook.ALLOC_FREE):
+            self._free[intlv_group].append(book_id)   # SQL sorted them
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._free.values())
+
+    def __str__(self):
+        return 'FreeBooks: %d books in %d IGs' % (len(self), len(self._free))
+
+    def count(self, intlv_group):
+        return len(self._free.get(intlv_group, ()))
+
+    def add(self, book):
+        '''Book has transitioned to FREE.'''
+        ids = self._free[book.intlv_group]
+        i = bisect_left(ids, book.id)
+        if i == len(ids) or ids[i] != book.id:
+            ids.insert(i, book.id)
+            self.changes += 1
+
+    def discard(self, book):
+        '''Book has transitioned out of FREE.'''
+        ids = self._free.get(book.intlv_group, None)
+        if ids is None:
+            return
+        i = bisect_left(ids, book.id)
+        if i < len(ids) and ids[i] == book.id:
+            del ids[i]
+            self.changes += 1
+
+    def _pick(self, books_needed, IGs, exclude, order):
+        if exclude:
+            IGs = frozenset(IGs)
+            keys = [ ig for ig in self._free if ig not in IGs ]
+        else:
+            keys = [ ig for ig in IGs if ig in self._free ]
+        lists = [ self._free[ig] for ig in sorted(set(keys)) ]
+        lists = [ ids for ids in lists if ids ]
+        if not lists or books_needed <= 0:
+            return [ ]
+
+        if order == self.ASCENDING:
+            return list(islice(merge(*lists), books_needed))
+        if order == self.DESCENDING:
+            return list(islice(merge(*[reversed(ids) for ids in lists],
+                                     reverse=True), books_needed))
+
+        # Uniform over every candidate book, same as shuffling them all.
+        # Flatten the index space across IGs via cumulative lengths.
+        bounds = list(accumulate(len(ids) for ids in lists))
+        total = bounds[-1]
+        picks = [ ]
+        for n in random.sample(range(total), min(books_needed, total)):
+            which = bisect_right(bounds, n)
+            offset = n - (bounds[which - 1] if which else 0)
+            picks.append(lists[which][offset])
+        return picks
+
+    def __call__(self, books_needed, IGs, exclude=False, order=RANDOM):
+        '''Return up to books_needed FREE TMBooks (IN or NOT IN IGs) without
+           changing their state; _set_book_alloc() will do that.'''
+        book_ids = self._pick(books_needed, IGs, exclude, order)
+        books = self.db.get_books_by_ids(book_ids)
+        if len(books) == len(book_ids) and \
+           all(b.allocated == TMBook.ALLOC_FREE for b in books):
+            return books
+        # Index drifted from SQL (rollback?).  SQL wins, try once more.
+        self.rebuild()
+        book_ids = self._pick(books_needed, IGs, exclude, order)
+        return self.db.get_books_by_ids(book_ids)
+
+#--------------------------------------------------------------------------
+
 
 class BookPolicy(object):
 
@@ -142,13 +253,11 @@ class BookPolicy(object):
         return self.__str__()
 
     def _IGs2books(self, books_needed, IGs, exclude=False, shuffle=True):
-        db = self.LCEobj.db
-        # Randomization needs to work with EVERY possible book
-        tmp = 999999 if shuffle else books_needed
-        books = db.get_books_by_intlv_group(tmp, IGs, exclude=exclude)
-        if shuffle:
-            random.shuffle(books)
-        return books[:books_needed]
+        # Randomization needs to work with EVERY possible book, which
+        # the in-memory index does without pulling them all from SQL.
+        order = FreeBooks.RANDOM if shuffle else FreeBooks.ASCENDING
+        return self.LCEobj.freebooks(
+            books_needed, IGs, exclude=exclude, order=order)
 
     # For "NUMA" distance calculations there are three sources
     # (Node | Enc | OffEnc aka Rack), eight states.
@@ -272,9 +381,9 @@ class BookPolicy(object):
 
     def _policy_LZAascending(self, books_needed, ascending=True):
         '''Using all IGs, select books from all of FAM in specified order.'''
-        db = self.LCEobj.db
-        freebooks = db.get_books_by_intlv_group(
-            books_needed, (999999, ), exclude=True, ascending=ascending)
+        order = FreeBooks.ASCENDING if ascending else FreeBooks.DESCENDING
+        freebooks = self.LCEobj.freebooks(
+            books_needed, (999999, ), exclude=True, order=order)
         return freebooks
 
     def _policy_LZAdescending(self, books_needed):
@@ -320,8 +429,8 @@ class BookPolicy(object):
         for ig in igCnt.keys():
             # Overload IG field with BIImode before DB query
             mod_ig = ig | self.LCEobj.BII() << BII.MODE_SHIFT
-            booksIG[ig] = db.get_books_by_intlv_group(
-                igCnt[ig], (mod_ig, ), exclude=False)
+            booksIG[ig] = self.LCEobj.freebooks(
+                igCnt[ig], (mod_ig, ), order=FreeBooks.ASCENDING)
 
         # Build list of books using request_interleave pattern
         self.LCEobj.errno = errno.ENOSPC
@@ -36,6 +36,7 @@ from pdb import set_trace
 
 from book_shelf_bos import TMBook, TMShelf, TMBos, TMOpenedShelves
 from backend_sqlite3 import SQLite3assist
+from db_migrate import MIGRATIONS
 from frdnode import FRDnode, FRDintlv_group, FRDFAModule
 from frdnode import BooksIGInterpretation
 from tmconfig import TMConfig, multiplier
@@ -1016,6 +1017,13 @@ def create_empty_db(cur):
                        ON shelf_xattrs (shelf_id, xattr)''')
         cur.commit()
 
+        # That was LIBRARIAN 0.997.  Everything since is a migration step;
+        # running them all makes this the same as an upgraded database.
+        for step in MIGRATIONS:
+            for ddl in step.ddl:
+                cur.execute(ddl)
+        cur.commit()
+
     except Exception as e:
         raise SystemExit('DB operation failed at line %d: %s' % (
             sys.exc_info()[2].tb_lineno, str(e)))
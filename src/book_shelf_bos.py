@@ -16,6 +16,8 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 import time
+from array import array
+from itertools import accumulate
 from pdb import set_trace
 
 #########################################################################
@@ -64,6 +66,41 @@ class BookShelfStuff(object):      # could become a mixin
                 except AttributeError as e:
                     pass
         setattr(self, self._MFname, None)
+        self._fixup()
+
+    def _fixup(self):
+        '''Fields that want something other than 0 when missing'''
+        pass
+
+    # SQLassist iteration: what __init__(**dict(zip(names, row))) does,
+    # worked out once per query shape instead of once per row.  Columns
+    # that aren't fields are dropped, just as __init__ drops them.
+    @classmethod
+    def row_factory(cls, names):
+        fields = [ (i, name) for i, name in enumerate(names)
+                   if name in cls.__slots__ ]
+        zeroed = tuple(sorted(
+            cls.__slots__ - set(names) - set((cls._MFname, ))))
+        setters = tuple((i, cls.__dict__[name].__set__)
+                        for i, name in fields
+                        if name in cls.__dict__)
+        assert len(setters) == len(fields), cls._msg(cls, 'slot mismatch')
+        zero = tuple(cls.__dict__[name].__set__ for name in zeroed)
+        matchfields = cls.__dict__[cls._MFname].__set__
+        fixup = None if cls._fixup is BookShelfStuff._fixup else cls._fixup
+        new = cls.__new__
+
+        def make(row):
+            obj = new(cls)
+            for set_ in zero:
+                set_(obj, 0)
+            matchfields(obj, None)
+            for i, set_ in setters:
+                set_(obj, row[i])
+            if fixup is not None:
+                fixup(obj)
+            return obj
+        return make
 
     def __eq__(self, other):
         for k in self._ordered_schema:  # not ids
@@ -175,8 +212,7 @@ class TMShelf(BookShelfStuff):
                                                'open_handle',
                                                '_fd'))
 
-    def __init__(self, *args, **kwargs):
-        super(self.__class__, self).__init__(*args, **kwargs)
+    def _fixup(self):
         # super.__init__ sets things to zero if the constructor dict is
         # missing them.  Some fields need a different "missing" value.
         if self.bos == 0:
@@ -190,12 +226,91 @@ class TMShelf(BookShelfStuff):
         # If size_bytes match, then len(bos) must match.
         if self.id != other.id or self.size_bytes != other.size_bytes:
             return False
+        if isinstance(self.bos, BookColumns) and \
+           isinstance(other.bos, BookColumns):
+            return set(self.bos.rows()) <= set(other.bos.rows())
         for book in self.bos:
             if book not in other.bos:
                 return False
         return True
 
 #########################################################################
+# The books of a shelf in seq_num order as one array per TMBook field,
+# instead of a dict per book.  That's how list_shelf_books sends them
+# when asked for "columns" and how lfs_fuse keeps them, so finding the
+# book under a shelf offset is indexing, not a dict lookup.  On the wire
+# each column is a list of ints; with "delta" encoding the id (LZA)
+# column holds the first id then differences, which are short numbers
+# for the runs of adjacent books a shelf usually gets.
+
+
+class BookColumns(object):
+
+    _fields = TMBook._ordered_schema
+
+    def __init__(self, rows=()):
+        '''rows: tuples of TMBook fields in _ordered_schema order'''
+        columns = list(zip(*rows)) or [ () ] * len(self._fields)
+        for field, column in zip(self._fields, columns):
+            setattr(self, field, array('q', column))
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, i):   # one book as a dict, like the old lists
+        return dict((f, getattr(self, f)[i]) for f in self._fields)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return isinstance(other, BookColumns) and all(
+            getattr(self, f) == getattr(other, f) for f in self._fields)
+
+    def __repr__(self):
+        return '%s(%d books: %s)' % (
+            self.__class__.__name__, len(self),
+            ', '.join('0x%x' % i for i in self.id[:4]) +
+            (', ...' if len(self) > 4 else ''))
+
+    def rows(self):
+        return zip(*(getattr(self, f) for f in self._fields))
+
+    def startswith(self, other):
+        '''Are the first len(other) books those of other, in order?'''
+        n = len(other)
+        if not n:
+            return True
+        return n <= len(self) and all(
+            getattr(self, f)[:n] == getattr(other, f) for f in self._fields)
+
+    def wire(self, delta=False):
+        value = dict((f, getattr(self, f).tolist()) for f in self._fields)
+        value['encoding'] = 'delta' if delta else 'plain'
+        if delta and len(self):
+            ids = self.id
+            value['id'] = [ ids[0] ] + [
+                b - a for a, b in zip(ids, ids[1:]) ]
+        return value
+
+    @classmethod
+    def from_wire(cls, value):
+        '''Also takes the list of book dicts an older librarian sends'''
+        if isinstance(value, list):
+            return cls(tuple(b[f] for f in cls._fields) for b in value)
+        books = cls()
+        encoding = value.get('encoding', 'plain')
+        assert encoding in ('plain', 'delta'), \
+            'Unknown book list encoding "%s"' % encoding
+        for field in cls._fields:
+            column = value[field]
+            if field == 'id' and encoding == 'delta':
+                column = accumulate(column)
+            setattr(books, field, array('q', column))
+        return books
+
+#########################################################################
 
 
 class TMBos(BookShelfStuff):
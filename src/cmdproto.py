@@ -31,6 +31,13 @@ from genericobj import GenericObject as GO
 class LibrarianCommandProtocol(object):
     '''__call__ will take a full tuple, kwargs, or a dict.'''
 
+    # Bulk queries may take any of these as keywords.  Results come in
+    # id order; a page is the "limit" entries past "after_id", and its
+    # reply says where the next one starts ("after_id") and if there is
+    # one ("more").  With "stream" true the librarian sends every page,
+    # each reply carrying the request's seq, until "more" is false.
+    _PAGING = ('after_id', 'limit', 'stream')
+
     _commands = {
 
         'version':  GO(
@@ -52,6 +59,7 @@ class LibrarianCommandProtocol(object):
         'list_shelf_books': GO(
             doc='list books on a shelf',
             parms=('path', ),
+            optional=('columns', ),     # "plain" or "delta", see BookColumns
         ),
         'list_shelves': GO(
             doc='list shelf names',
@@ -60,6 +68,7 @@ class LibrarianCommandProtocol(object):
         'list_open_shelves': GO(
             doc='show all open shelves',
             parms=None,
+            optional=_PAGING,
         ),
         'open_shelf': GO(
             doc='open shelf and setup node access',
@@ -112,6 +121,7 @@ class LibrarianCommandProtocol(object):
         'get_book_all': GO(
             doc='get all books in database sorted by LZA',
             parms=None,
+            optional=_PAGING,
         ),
         'mkdir': GO(
             doc='create new directory',
@@ -142,6 +152,25 @@ class LibrarianCommandProtocol(object):
             doc='update the status for each media controller on a given node',
             parms=('status',),
         ),
+        'batch': GO(
+            doc='run a list of commands as one transaction (see batch())',
+            parms=('commands', 'stop_on_error'),
+        ),
+
+        # shard_router only
+
+        'prepare_move': GO(
+            doc='first phase of a rename between shards (see shard_router)',
+            parms=('path', 'txn', 'record'),
+        ),
+        'finish_move': GO(
+            doc='second phase of a rename between shards: commit or abort',
+            parms=('txn', 'commit'),
+        ),
+        'list_moves': GO(
+            doc='renames between shards a shard has yet to finish',
+            parms=None,
+        ),
 
         # repl_client and demos only
 
@@ -153,11 +182,13 @@ class LibrarianCommandProtocol(object):
         'get_book_ig': GO(
             doc='get all books in an interleave group',
             parms=('intlv_group', ),
+            optional=_PAGING,
         ),
 
         'get_book_info_all': GO(
             doc='get all books for an interleave group joined with shelf information',
             parms=('intlv_group', ),
+            optional=_PAGING,
         ),
 
     }   # _commands
@@ -178,12 +209,15 @@ class LibrarianCommandProtocol(object):
         go = self._commands[command]    # natural keyerror is fine here
 
         assert not (args and kwargs), 'Pos/keyword args are mutually exclusive'
+        # Each request gets its own copy: several may be in flight at once
+        # and the caller fills in uid/pid/etc. after this returns.
         self._seq_lock.acquire()
         self._context['seq'] += 1
+        context = dict(self._context)
         self._seq_lock.release()
         respdict = OrderedDict((
             ('command', command),
-            ('context', self._context),
+            ('context', context),
         ))
 
         # Polymorphism.  Careful: passing a sring makes args[0] a tuple
@@ -197,6 +231,7 @@ class LibrarianCommandProtocol(object):
                 if str(arg0) == 'help':
                     respdict = OrderedDict((('command', command), ))
                     respdict['parms'] = go.parms
+                    respdict['optional'] = go.get('optional', None)
                     return respdict
 
                 # It might be an object.  Try duck typing first.
@@ -209,7 +244,10 @@ class LibrarianCommandProtocol(object):
                         respdict[item[0]] = item[1]
             elif kwargs:
                 keys = sorted(kwargs.keys())
-                assert set(keys) == set(go.parms), 'Arg field mismatch'
+                parms = set(go.parms or ())
+                optional = set(go.get('optional', None) or ())
+                assert parms <= set(keys) <= parms | optional, \
+                    'Arg field mismatch'
                 for key in keys:
                     respdict[key] = kwargs[key]
             else:
@@ -224,6 +262,18 @@ class LibrarianCommandProtocol(object):
                 self.__class__.__name__, sys.exc_info()[2].tb_lineno, str(e))
         raise RuntimeError(msg)
 
+    def batch(self, *cmdicts, stop_on_error=True):
+        '''Envelope for several commands already built by __call__.  The
+           librarian runs them in order in one transaction; the reply
+           value is a list with {'value': ...} or errmsg/errno for each
+           command, None for any not run after a stop_on_error failure.'''
+        commands = [ ]
+        for cmdict in cmdicts:
+            command = OrderedDict(cmdict)
+            command.pop('context', None)    # the envelope's goes for all
+            commands.append(command)
+        return self('batch', commands=commands, stop_on_error=stop_on_error)
+
     @property
     def commandset(self):
         return tuple(sorted(self._commands.keys()))
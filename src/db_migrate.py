@@ -0,0 +1,202 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Upgrade a Librarian database in place to the SCHEMA_VERSION this tree
+    expects.  Stop the librarian first:
+
+        db_migrate.py --db_file librarian.db
+
+    MIGRATIONS is the history of the schema after LIBRARIAN 0.997, one
+    step per version, each applied in its own transaction along with the
+    new schema_version in globals.  book_register.py builds a new database
+    as 0.997 and then runs every step's DDL, so old and new databases end
+    up the same.  A schema change is a new step at the end, never an edit
+    to one that has shipped.
+"""
+
+import argparse
+import sqlite3
+import sys
+
+from collections import namedtuple
+from pdb import set_trace
+
+from sqlbackend import LibrarianDBackendSQL
+
+Step = namedtuple('Step', ('version', 'upgrade', 'doc', 'ddl'))
+
+MIGRATIONS = (
+    Step('LIBRARIAN 0.997', 'LIBRARIAN 0.998',
+         'indexes for every per-command query',
+         (
+            # Allocation, FreeBooks, books_used: allocated IN (...) AND
+            # intlv_group IN (...).  Covering, so the books table itself
+            # is never read.
+            'CREATE INDEX IDX_books_allocated ON books '
+            '(allocated, intlv_group, book_num, attributes)',
+            # get_book_info_all: one IG, in id order
+            'CREATE INDEX IDX_books_intlv_group ON books (intlv_group)',
+            # A shelf's books in order, and a book's shelf.  Covering.
+            'CREATE INDEX IDX_bos_shelf ON books_on_shelves '
+            '(shelf_id, seq_num, book_id)',
+            'CREATE INDEX IDX_bos_book ON books_on_shelves '
+            '(book_id, shelf_id, seq_num)',
+            # Path walks.  Not UNIQUE: that's the engine's job, and a
+            # migration must not fail on a database that let one slip.
+            'CREATE INDEX IDX_shelves_parent ON shelves (parent_id, name)',
+            # Who has a shelf open.  Covering.
+            'CREATE INDEX IDX_opened_shelf ON opened_shelves '
+            '(shelf_id, node_id, pid)',
+            # readlink.  Covering.
+            'CREATE INDEX IDX_links ON links (shelf_id, target)',
+         )),
+    Step('LIBRARIAN 0.998', 'LIBRARIAN 0.999',
+         'book counts per interleave group and allocation state',
+         (
+            # Capacity questions (get_fs_stats on every statfs, LMP) read
+            # this instead of counting books.  The triggers keep it right
+            # in the same transaction as whatever changed the books, no
+            # matter who did it.  INSERT OR IGNORE then UPDATE rather than
+            # an UPSERT, which older SQLite doesn't have.
+            'CREATE TABLE book_counts ('
+            'intlv_group INT, allocated INT, books INT, '
+            'PRIMARY KEY (intlv_group, allocated)) WITHOUT ROWID',
+            'INSERT INTO book_counts '
+            'SELECT intlv_group, allocated, COUNT(*) FROM books '
+            'GROUP BY intlv_group, allocated',
+            '''CREATE TRIGGER TRG_books_insert AFTER INSERT ON books
+               BEGIN
+                  INSERT OR IGNORE INTO book_counts
+                     VALUES (NEW.intlv_group, NEW.allocated, 0);
+                  UPDATE book_counts SET books = books + 1
+                     WHERE intlv_group = NEW.intlv_group
+                     AND allocated = NEW.allocated;
+               END''',
+            '''CREATE TRIGGER TRG_books_delete AFTER DELETE ON books
+               BEGIN
+                  UPDATE book_counts SET books = books - 1
+                     WHERE intlv_group = OLD.intlv_group
+                     AND allocated = OLD.allocated;
+               END''',
+            '''CREATE TRIGGER TRG_books_update
+               AFTER UPDATE OF intlv_group, allocated ON books
+               WHEN OLD.intlv_group IS NOT NEW.intlv_group
+                 OR OLD.allocated IS NOT NEW.allocated
+               BEGIN
+                  UPDATE book_counts SET books = books - 1
+                     WHERE intlv_group = OLD.intlv_group
+                     AND allocated = OLD.allocated;
+                  INSERT OR IGNORE INTO book_counts
+                     VALUES (NEW.intlv_group, NEW.allocated, 0);
+                  UPDATE book_counts SET books = books + 1
+                     WHERE intlv_group = NEW.intlv_group
+                     AND allocated = NEW.allocated;
+               END''',
+         )),
+    Step('LIBRARIAN 0.999', 'LIBRARIAN 1.000',
+         'intents for renames between shards',
+         (
+            # Each shard's half of a move from prepare_move() to
+            # finish_move(), so shard_router.py can finish or undo one a
+            # crash interrupted.  shelf_id is the shelf on this shard:
+            # the one leaving, or the one that arrived once committed.
+            'CREATE TABLE moves ('
+            'txn TEXT PRIMARY KEY, direction TEXT, state TEXT, '
+            'shelf_id INT, name TEXT, parent_id INT, record TEXT)',
+            'CREATE INDEX IDX_moves_shelf ON moves (shelf_id)',
+         )),
+)
+
+assert MIGRATIONS[-1].upgrade == LibrarianDBackendSQL.SCHEMA_VERSION, \
+    'db_migrate.py is missing a step to %s' % \
+    LibrarianDBackendSQL.SCHEMA_VERSION
+
+
+def migrate(db_file, verbose=False):
+    """ Bring db_file up to SCHEMA_VERSION.
+        Input---
+          db_file - an existing Librarian database
+          verbose - print each step as it's applied
+        Output---
+          list of the Steps applied (empty if it was current), or raise
+          RuntimeError.  A failed step leaves the database as it was
+          after the last good one.
+    """
+    try:
+        conn = sqlite3.connect('file:%s?mode=rw' % db_file, uri=True,
+                               isolation_level=None)
+    except Exception as e:
+        raise RuntimeError('Cannot open %s: %s' % (db_file, str(e)))
+    steps = dict((step.version, step) for step in MIGRATIONS)
+    applied = [ ]
+    try:
+        while True:
+            conn.execute('BEGIN EXCLUSIVE')
+            try:
+                version = conn.execute(
+                    'SELECT schema_version FROM globals').fetchone()
+                if version is None:
+                    raise RuntimeError(
+                        '"%s" is not a valid Librarian database' % db_file)
+                version = version[0]
+                if version == LibrarianDBackendSQL.SCHEMA_VERSION:
+                    conn.execute('ROLLBACK')
+                    return applied
+                step = steps.get(version, None)
+                if step is None:
+                    raise RuntimeError(
+                        '%s: no migration from schema "%s"' % (
+                            db_file, version))
+                if verbose:
+                    print('%s -> %s: %s' % (
+                        step.version, step.upgrade, step.doc))
+                for ddl in step.ddl:
+                    conn.execute(ddl)
+                conn.execute('UPDATE globals SET schema_version=?',
+                             (step.upgrade, ))
+                conn.execute('COMMIT')
+                applied.append(step)
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+    except sqlite3.Error as e:
+        raise RuntimeError('%s: %s' % (db_file, str(e)))
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Upgrade a Librarian database to schema "%s"' %
+        LibrarianDBackendSQL.SCHEMA_VERSION)
+    parser.add_argument(
+        '--db_file',
+        help='SQLite3 database backing store file',
+        required=True)
+    args = parser.parse_args()
+    try:
+        applied = migrate(args.db_file, verbose=True)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    if not applied:
+        print('%s is already at "%s"' % (
+            args.db_file, LibrarianDBackendSQL.SCHEMA_VERSION))
+
+
+if __name__ == '__main__':
+    main()
@@ -25,18 +25,209 @@ import time
 import math
 import stat
 import sys
+import threading
 import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
+from queue import Queue
 from operator import attrgetter
 from pdb import set_trace
 
-from book_policy import BookPolicy
+from book_policy import BookPolicy, FreeBooks
 from book_shelf_bos import TMBook, TMShelf, TMBos
 from cmdproto import LibrarianCommandProtocol as lcp
-from frdnode import FRDnode, BooksIGInterpretation
+from frdnode import BooksIGInterpretation
 from genericobj import GenericObject
 
 _ZERO_PREFIX = '.lfs_pending_zero_'     # agree with lfs_fuse.py
 
+#---------------------------------------------------------------------------
+# Path walks hit the same directories over and over.  Remember the shelf
+# found under (parent_id, name), a la the Linux dcache.  Only the identity
+# of a cached shelf (id, parent_id, name) is trustworthy; sizes and
+# times go stale, so anyone who needs those must re-read the shelf by id.
+# Entries are dropped explicitly wherever a name is created or destroyed.
+
+
+class DentryCache(object):
+
+    MAX_ENTRIES = 16384
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._dentries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._dentries)
+
+    def __str__(self):
+        return 'DentryCache: %d entries, %d hits, %d misses' % (
+            len(self), self.hits, self.misses)
+
+    def get(self, parent_id, name):
+        try:
+            shelf = self._dentries[(parent_id, name)]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._dentries.move_to_end((parent_id, name))
+        self.hits += 1
+        return shelf
+
+    def put(self, shelf):
+        self._dentries[(shelf.parent_id, shelf.name)] = shelf
+        if len(self._dentries) > self.max_entries:
+            self._dentries.popitem(last=False)      # LRU
+
+    def invalidate(self, parent_id, name):
+        self._dentries.pop((parent_id, name), None)
+
+    def clear(self):
+        self._dentries.clear()
+
+    @property
+    def stats(self):
+        return { 'entries': len(self), 'hits': self.hits,
+                 'misses': self.misses }
+
+
+#---------------------------------------------------------------------------
+# Commands that never change state can run beside the writer.  Each reader
+# thread has its own engine over its own read-only connection; SQLite drops
+# the GIL while it steps a query and WAL gives every reader a snapshot of
+# whatever had been committed when its command began.  Optionally, every
+# other command runs on a worker thread too (see LibrarianCommandEngine.
+# worker()), and the server loop is left to do just the I/O.
+
+
+class EnginePool(object):
+
+    def __init__(self, copier, backend_factory, nthreads, name):
+        '''copier(backend_factory()) makes each thread's engine.  It's all
+           done on the thread since sqlite3 objects can't change threads.'''
+        self.name = name
+        self.engines = [ ]
+        self._queue = Queue()
+        self._threads = [ ]
+        started = Queue()
+        for i in range(nthreads):
+            thread = threading.Thread(
+                target=self._run, name='%s%d' % (name, i), daemon=True,
+                args=(copier, backend_factory, started))
+            thread.start()
+            self._threads.append(thread)
+        errors = [ started.get() for _ in self._threads ]
+        errors = [ e for e in errors if e is not None ]
+        if errors:
+            self.close()
+            raise RuntimeError('%s startup failed: %s' % (name, errors[0]))
+
+    def __len__(self):
+        return len(self._threads)
+
+    def _run(self, copier, backend_factory, started):
+        try:
+            engine = copier(backend_factory())
+        except Exception as e:
+            started.put(str(e))
+            return
+        self.engines.append(engine)
+        started.put(None)
+        while True:
+            work = self._queue.get()
+            if work is None:
+                break
+            cmdict, done = work
+            done(*engine.run(cmdict))
+        engine.db.close()
+
+    def submit(self, cmdict, done):
+        '''done(reply, OOBmsg) gets called on a pool thread.'''
+        self._queue.put((cmdict, done))
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = [ ]
+
+
+#---------------------------------------------------------------------------
+# What keeps workers apart.  A command takes all of its locks before it
+# starts, in sorted order, so no two commands can deadlock.  Time spent
+# waiting is kept per kind of lock to show where the contention is.
+
+
+class LockTable(object):
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locks = { }   # (kind, name): [ lock, threads holding or queued ]
+        self._stats = { }
+
+    @staticmethod
+    def tally(stats, waited, contended):
+        stats['acquired'] += 1
+        if contended:
+            stats['contended'] += 1
+            stats['wait_secs'] += waited
+            stats['max_wait_secs'] = max(stats['max_wait_secs'], waited)
+
+    @contextmanager
+    def held(self, keys):
+        taken = [ ]
+        try:
+            for key in sorted(set(keys)):
+                with self._mutex:
+                    entry = self._locks.get(key, None)
+                    if entry is None:
+                        entry = self._locks[key] = [ threading.Lock(), 0 ]
+                    entry[1] += 1
+                waited = 0.0
+                contended = not entry[0].acquire(blocking=False)
+                if contended:
+                    t0 = time.time()
+                    entry[0].acquire()
+                    waited = time.time() - t0
+                taken.append(key)
+                with self._mutex:
+                    stats = self._stats.setdefault(key[0], dict(
+                        acquired=0, contended=0,
+                        wait_secs=0.0, max_wait_secs=0.0))
+                    self.tally(stats, waited, contended)
+            yield
+        finally:
+            with self._mutex:
+                for key in reversed(taken):
+                    entry = self._locks[key]
+                    entry[0].release()
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self._locks[key]
+
+    @property
+    def stats(self):
+        with self._mutex:
+            return dict((kind, dict(stats))
+                        for kind, stats in self._stats.items())
+
+
+# One page of a bulk query: its entries (in id order), where the next page
+# starts, and whether there is one.  The cursor is an id, not an offset, so
+# a page costs the same no matter how deep into the table it is.
+
+
+class Page(list):
+
+    def __init__(self, entries, limit, after_id):
+        super(Page, self).__init__(entries[:limit])
+        self.more = len(entries) > limit
+        self.after_id = self[-1].id if self else after_id
+
 
 class LibrarianCommandEngine(object):
 
@@ -45,7 +236,18 @@ class LibrarianCommandEngine(object):
 
     @staticmethod
     def argparse_extend(parser):
-        pass
+        parser.add_argument(
+            '--readers',
+            help='threads running read-only commands, each with its own '
+                 'DB connection (0 runs everything on the server loop)',
+            type=int,
+            default=1)
+        parser.add_argument(
+            '--workers',
+            help='threads running all other commands, each with its own '
+                 'DB connection (0 runs them on the server loop)',
+            type=int,
+            default=0)
 
     _book_size_bytes = 0
     _nvm_bytes_total = 0  # read from DB
@@ -82,6 +284,9 @@ class LibrarianCommandEngine(object):
         # books_per_IG has been expanded for MODE_PHYSADDR
         lfs_globals['books_per_IG'] = self.books_per_IG
         lfs_globals['BIImode'] = self.BII()
+        lfs_globals['dentry_cache'] = self.writer.dentries.stats
+        lfs_globals['locks'] = self.writer.lock_stats
+        lfs_globals['statements'] = self.writer.statement_stats
         return lfs_globals
 
     def cmd_create_shelf(self, cmdict):
@@ -93,7 +298,7 @@ class LibrarianCommandEngine(object):
         """
         path_list = self._path2list(cmdict['path'])
         cmdict['name'] = path_list[-1]
-        parent_shelf = self._path2shelf(path_list[:-1])
+        parent_shelf = self._path2shelf(path_list[:-1], fresh=False)
         cmdict['parent_id'] = parent_shelf.id
         cmdict['link_count'] = 1  # normal files get one
 
@@ -106,6 +311,7 @@ class LibrarianCommandEngine(object):
         self.errno = errno.EINVAL
         shelf = TMShelf(cmdict)
         self.db.create_shelf(shelf)
+        self.dentries.invalidate(shelf.parent_id, shelf.name)
         self.db.create_xattr(shelf,
                              BookPolicy.XATTR_ALLOCATION_POLICY,
                              BookPolicy.DEFAULT_ALLOCATION_POLICY)
@@ -130,7 +336,7 @@ class LibrarianCommandEngine(object):
         path_list = self._path2list(cmdict['path'])
         try:
             cmdict['name'] = path_list[-1]
-            parent_shelf = self._path2shelf(path_list[:-1])
+            parent_shelf = self._path2shelf(path_list[:-1], fresh=False)
             cmdict['parent_id'] = parent_shelf.id
         except IndexError:
             #case of getting root
@@ -175,25 +381,41 @@ class LibrarianCommandEngine(object):
 
         return [working_dir] + [parent_dir] + children_dirs
 
-    def _path2shelf(self, path):
-        '''Returns shelf object corresponding to given path'''
+    def _path2shelf(self, path, fresh=True):
+        '''Returns shelf object corresponding to given path.  If fresh is
+           False the shelf may come from the dentry cache and only its id,
+           parent_id and name can be trusted; it must not be modified.'''
         # accepts a string, or a list. either is handled in path2list
         path_list = self._path2list(path)
-        # FIXME: not sure if this will work, attempting to start at root and move from there
-        # if things break, this would be a reasonable place to look
-        tmp = TMShelf(id=2)
-        tmp.matchfields = ('id', )
-        current_shelf = self.db.get_shelf(tmp)
-        for name in path_list:
-            tmp = TMShelf(parent_id=current_shelf.id, name=name)
-            tmp.matchfields = ('parent_id', 'name')
+        # Start at root (id 2, which is its own parent) and walk down
+        # the cache as far as it goes.  The rest is one SQL statement.
+        current_shelf = self.dentries.get(2, '.')
+        if current_shelf is None:
+            path_list = [ '.' ] + path_list
+            current_shelf = TMShelf(id=2)
+        for i, name in enumerate(path_list):
+            cached = self.dentries.get(current_shelf.id, name)
+            if cached is None:
+                shelves = self.db.get_shelves_by_path(
+                    path_list[i:], current_shelf.id)
+                for shelf in shelves:   # callers may scribble on theirs
+                    self.dentries.put(TMShelf(shelf.dict))
+                if len(shelves) != len(path_list) - i:
+                    return None
+                return shelves[-1]
+            current_shelf = cached
+
+        if fresh:
+            tmp = TMShelf(id=current_shelf.id)
+            tmp.matchfields = ('id', )
             current_shelf = self.db.get_shelf(tmp)
-
         return current_shelf
 
     def cmd_list_open_shelves(self, cmdict):
-        '''Returns a list.'''
-        return self.db.get_open_shelf_all()
+        '''Returns a list, or a Page of it.'''
+        after_id, limit = self._paging(cmdict)
+        return self._paged(self.db.get_open_shelf_all(after_id, limit),
+                           cmdict)
 
     def cmd_open_shelf(self, cmdict):
         """ Open a shelf for access by a node.
@@ -204,6 +426,7 @@ class LibrarianCommandEngine(object):
         """
         shelf = self.cmd_get_shelf(
             cmdict, match_parent_id=True)  # may raise ENOENT
+        self._not_moving(shelf)
         self.db.modify_opened_shelves(shelf, 'get', cmdict['context'])
         return shelf
 
@@ -239,7 +462,11 @@ class LibrarianCommandEngine(object):
            probably rename this (and change call in lfs_fuse.py).'''
         shelf = self.cmd_get_shelf(cmdict)
         # return self._list_shelf_books(shelf) old
-        return self.db.get_books_on_shelf(shelf)
+        columns = cmdict.get('columns', None)
+        if not columns:
+            return self.db.get_books_on_shelf(shelf)
+        books = self.db.get_books_on_shelf(shelf, columns=True)
+        return books.wire(delta=columns == 'delta')
 
     def _set_book_alloc(self, bookorbos, newalloc):
         self.errno = errno.EUCLEAN
@@ -250,6 +477,7 @@ class LibrarianCommandEngine(object):
             book = self.db.get_book_by_id(bookorbos.book_id)
         if newalloc == book.allocated:
             return book
+        oldalloc = book.allocated
         msg = 'Book allocation %d -> %d' % (book.allocated, newalloc)
         if newalloc == TMBook.ALLOC_INUSE:
             assert book.allocated == TMBook.ALLOC_FREE, msg
@@ -264,6 +492,10 @@ class LibrarianCommandEngine(object):
         book = self.db.modify_book(book)
         self.errno = errno.ENOENT
         assert book, 'Book allocation change to %d failed' % newalloc
+        if newalloc == TMBook.ALLOC_FREE:
+            self.freebooks.add(book)
+        elif oldalloc == TMBook.ALLOC_FREE:
+            self.freebooks.discard(book)
         return book
 
     def cmd_rename_shelf(self, cmdict):
@@ -289,12 +521,15 @@ class LibrarianCommandEngine(object):
 
         self.errno = errno.ENOENT
         shelf = self.cmd_get_shelf(cmdict)
+        self._not_moving(shelf)
         old_path_list = self._path2list(cmdict['path'])
         new_path_list = self._path2list(cmdict['newpath'])
+        self.dentries.invalidate(shelf.parent_id, shelf.name)
         shelf.name = new_path_list[-1]
         old_parent_shelf = self._path2shelf(old_path_list[:-1])
         new_parent_shelf = self._path2shelf(new_path_list[:-1])
         shelf.parent_id = new_parent_shelf.id
+        self.dentries.invalidate(shelf.parent_id, shelf.name)
         shelf.matchfields = ('name', 'parent_id')
         shelf = self.db.modify_shelf(shelf, commit=True)
 
@@ -321,6 +556,172 @@ class LibrarianCommandEngine(object):
             self.db.commit()
         return shelf
 
+    # A rename between shards (see shard_router.py) is two-phase.  With
+    # both paths locked, the router has each shard prepare_move(), then
+    # finish_move() on the destination and, only if that worked, on the
+    # source.  Books go with the shelf; OFFLINE is how a shard sees books
+    # that belong to another.  Each shard keeps its half of the move in
+    # its moves table, in the same transactions as the move itself, so
+    # after a crash ShardRouter.recover() can see how far it got.  A shelf
+    # that is leaving can't be opened, destroyed or renamed meanwhile.
+
+    def cmd_prepare_move(self, cmdict):
+        """ Check that a shelf can move off of or onto this shard and hold
+            on to what that takes until finish_move().
+            In (dict)---
+                path
+                txn - the router's name for the move
+                record - None on the source, else what the source returned
+            Out (dict) ---
+                on the source, the record: shelf, books and their state
+                in order, xattrs and symlink target
+        """
+        txn = cmdict['txn']
+        self.errno = errno.EINVAL
+        assert not self.db.get_moves(txn=txn), \
+            'move %s already prepared' % txn
+        record = cmdict['record']
+        if record is None:
+            shelf = self.cmd_get_shelf(cmdict)
+            self.errno = errno.EXDEV
+            assert not stat.S_ISDIR(shelf.mode), \
+                'directory %s cannot change shards' % shelf.name
+            self.errno = errno.EBUSY
+            assert not self.db.open_count(shelf), \
+                '%s has active opens' % shelf.name
+            self._not_moving(shelf)
+            books = self.db.get_books_by_ids(
+                [ b.book_id for b in self._list_shelf_books(shelf) ])
+            target = None
+            if stat.S_ISLNK(shelf.mode):
+                target = self.db.get_symlink_target(shelf)
+            self.db.create_move(txn, 'out', shelf)
+            self.db.commit()
+            return {
+                'shelf': shelf.dict,
+                'books': [ (b.id, b.allocated) for b in books ],
+                'xattrs': dict((xattr, self.db.get_xattr(shelf, xattr))
+                               for xattr in self.db.list_xattrs(shelf)),
+                'target': target,
+            }
+
+        path_list = self._path2list(cmdict['path'])
+        self.errno = errno.ENOENT
+        assert path_list, 'cannot move onto /'
+        parent = self._path2shelf(path_list[:-1])
+        assert parent is not None, 'no such directory for %s' % path_list[-1]
+        self.errno = errno.ENOTDIR
+        assert stat.S_ISDIR(parent.mode), '%s is not a directory' % parent.name
+        shelf = TMShelf(name=path_list[-1], parent_id=parent.id)
+        shelf.matchfields = ('name', 'parent_id')
+        self.errno = errno.EEXIST
+        assert self.db.get_shelf(shelf) is None, \
+            'Duplicate path found during rename %s' % cmdict['path']
+        book_ids = [ book_id for book_id, _ in record['books'] ]
+        books = self.db.get_books_by_ids(book_ids)
+        self.errno = errno.EREMOTEIO
+        assert len(books) == len(book_ids) and all(
+            b.allocated == TMBook.ALLOC_OFFLINE for b in books), \
+            'books of %s are not another shard\'s' % shelf.name
+        self.db.create_move(txn, 'in', shelf, record)
+        self.db.commit()
+        return None
+
+    def cmd_finish_move(self, cmdict):
+        """ Carry out a prepared move, or forget it.  On a destination
+            that already carried it out, commit just forgets it.
+            In (dict)---
+                txn
+                commit - False to forget it
+            Out (dict) ---
+                the shelf on the destination, else None
+        """
+        txn = cmdict['txn']
+        self.errno = errno.ENOENT
+        moves = self.db.get_moves(txn=txn)
+        assert moves, 'move %s was not prepared' % txn
+        move = moves[0]
+        if move['state'] == 'committed':
+            self.errno = errno.EINVAL
+            assert cmdict['commit'], 'move %s was committed' % txn
+            self.db.delete_move(txn)
+            self.db.commit()
+            return None
+        if not cmdict['commit']:
+            self.db.delete_move(txn)
+            self.db.commit()
+            return None
+
+        if move['direction'] == 'out':
+            shelf = TMShelf(id=move['shelf_id'])
+            shelf.matchfields = ('id', )
+            shelf = self.db.get_shelf(shelf)
+            assert shelf is not None, 'move %s lost its shelf' % txn
+            bos = self.db.get_bos_by_shelf_id(shelf.id)
+            for thisbos in bos:
+                self.db.delete_bos(thisbos)
+            self._hand_over([ (b.book_id, None) for b in bos ])
+            for xattr in self.db.list_xattrs(shelf):
+                self.db.remove_xattr(shelf, xattr)
+            if stat.S_ISLNK(shelf.mode):
+                self.db.delete_symlink(shelf)
+            self.db.delete_shelf(shelf)
+            self.dentries.invalidate(shelf.parent_id, shelf.name)
+            self.db.delete_move(txn)
+            self.db.commit()
+            return None
+
+        record = move['record']
+        moved = TMShelf(record['shelf'])
+        moved.name = move['name']
+        moved.parent_id = move['parent_id']
+        self.db.create_shelf(moved)
+        self.dentries.invalidate(moved.parent_id, moved.name)
+        self._hand_over(record['books'])
+        for seq_num, (book_id, _) in enumerate(record['books'], 1):
+            self.db.create_bos(TMBos(
+                shelf_id=moved.id, book_id=book_id, seq_num=seq_num))
+        for xattr, value in record['xattrs'].items():
+            self.db.create_xattr(moved, xattr, value)
+        if record['target'] is not None:
+            self.db.create_symlink(moved, record['target'])
+        self.db.commit_move(txn, moved)
+        self.db.commit()
+        return moved
+
+    def cmd_list_moves(self, cmdict):
+        """ Every move this shard has prepared and not yet finished.
+            In (dict)---
+                None
+            Out (list) ---
+                txn, direction, state, shelf_id, name, parent_id of each
+        """
+        moves = self.db.get_moves()
+        for move in moves:
+            del move['record']
+        return moves
+
+    def _not_moving(self, shelf):
+        self.errno = errno.EBUSY
+        assert not self.db.get_moves(shelf_id=shelf.id), \
+            '%s is moving to another shard' % shelf.name
+
+    def _hand_over(self, books):
+        '''(book_id, allocated) pairs: to OFFLINE if allocated is None,
+           else from OFFLINE to allocated.  The FREE index never sees it.'''
+        states = dict(books)
+        for book in self.db.get_books_by_ids(states.keys()):
+            to = states[book.id]
+            if to is None:
+                to = TMBook.ALLOC_OFFLINE
+            self.errno = errno.EREMOTEIO
+            assert TMBook.ALLOC_OFFLINE in (book.allocated, to) and \
+                TMBook.ALLOC_FREE not in (book.allocated, to), \
+                'Book allocation %d -> %d' % (book.allocated, to)
+            book.allocated = to
+            book.matchfields = 'allocated'
+            self.db.modify_book(book)
+
     # This is a protocol operation, not necessarily POSIX flow.  Search
     # in here for "unlink workflow", which first marks all books ZOMBIE,
     # zeroes them via dd, the zero truncates the shelf, and FINALLY
@@ -338,6 +739,7 @@ class LibrarianCommandEngine(object):
         shelf = self.cmd_get_shelf(cmdict)
         assert not self.db.open_count(
             shelf), '%s has active opens' % shelf.name
+        self._not_moving(shelf)
         bos = self._list_shelf_books(shelf)
         xattrs = self.db.list_xattrs(shelf)
         for thisbos in bos:
@@ -346,6 +748,7 @@ class LibrarianCommandEngine(object):
         for xattr in xattrs:
             self.db.remove_xattr(shelf, xattr)
         rsp = self.db.delete_shelf(shelf, commit=True)
+        self.dentries.invalidate(shelf.parent_id, shelf.name)
 
         return rsp
 
@@ -375,6 +778,7 @@ class LibrarianCommandEngine(object):
                 z_shelf_path
         """
         shelf = self.cmd_get_shelf(cmdict, match_id=True)
+        self._not_moving(shelf)
         bos = self._list_shelf_books(shelf)
         new_size_bytes = int(cmdict['size_bytes'])
         self.errno = errno.EINVAL
@@ -409,6 +813,9 @@ class LibrarianCommandEngine(object):
 
         books_needed = new_book_count - shelf.book_count
         if books_needed > 0:
+            # Picks from the FREE index are only good until someone else
+            # takes the same books, so pick them as the one writer.
+            self.db.hold_writes()
             policy = BookPolicy(self, shelf, cmdict['context'])
             freebooks = policy(books_needed)
             self.errno = errno.ENOSPC
@@ -609,16 +1016,48 @@ class LibrarianCommandEngine(object):
             'OOBmsg': cmdict['msg']
         }
 
+    # Bulk queries.  Without paging parameters they answer in one piece as
+    # always; see cmdproto._PAGING for the rest.
+
+    STREAM_CHUNK = 1000     # page size of a stream that doesn't give one
+
+    def _paging(self, cmdict):
+        '''(after_id, limit) for the backend.  The limit is one more than
+           the page so _paged() can tell if there is another.'''
+        after_id = cmdict.get('after_id', None)
+        limit = cmdict.get('limit', None)
+        if limit is None and cmdict.get('stream', False):
+            limit = self.STREAM_CHUNK
+        self.errno = errno.EINVAL
+        assert after_id is None or isinstance(after_id, int), \
+            'after_id must be an integer'
+        assert limit is None or (isinstance(limit, int) and limit > 0), \
+            'limit must be a positive integer'
+        self.errno = 0
+        return after_id, None if limit is None else limit + 1
+
+    def _paged(self, entries, cmdict):
+        after_id, limit = self._paging(cmdict)
+        if limit is None:
+            return entries
+        return Page(entries, limit - 1, after_id)
+
     def cmd_get_book_ig(self, cmdict):
         allocated = [ TMBook.ALLOC_FREE,
                       TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE ]
-        return self.db.get_books_by_intlv_group(9999, cmdict['intlv_group'], allocated)
+        after_id, limit = self._paging(cmdict)
+        return self._paged(self.db.get_books_by_intlv_group(
+            9999 if limit is None else limit, cmdict['intlv_group'],
+            allocated, after_id=after_id), cmdict)
 
     def cmd_get_book_all(self, cmdict):
-        return self.db.get_book_all()
+        after_id, limit = self._paging(cmdict)
+        return self._paged(self.db.get_book_all(after_id, limit), cmdict)
 
     def cmd_get_book_info_all(self, cmdict):
-        return self.db.get_book_info_all(cmdict['intlv_group'])
+        after_id, limit = self._paging(cmdict)
+        return self._paged(self.db.get_book_info_all(
+            cmdict['intlv_group'], after_id, limit), cmdict)
 
     def cmd_mkdir(self, cmdict):
         # currently similar to cmd_create_shelf with slight modifications
@@ -638,6 +1077,7 @@ class LibrarianCommandEngine(object):
         self.errno = errno.EINVAL
         shelf = TMShelf(cmdict)
         self.db.create_shelf(shelf)
+        self.dentries.invalidate(shelf.parent_id, shelf.name)
 
         # parent directory shelf has to also have link count incremented
         parent_shelf.link_count += 1
@@ -652,6 +1092,7 @@ class LibrarianCommandEngine(object):
         self.errno = errno.ENOTEMPTY
         assert not children, 'Directory is not empty'
         shelf = self.db.delete_shelf(shelf)
+        self.dentries.invalidate(shelf.parent_id, shelf.name)
 
         # handle link counts. put after the delete call, so that if
         # the delete fails, the link counts remain consistent
@@ -674,7 +1115,7 @@ class LibrarianCommandEngine(object):
         cmdict['mode'] = self._MODE_DEFAULT_LNK
         path_list = self._path2list(cmdict['path'])
         cmdict['name'] = path_list[-1]
-        parent_shelf = self._path2shelf(path_list[:-1])
+        parent_shelf = self._path2shelf(path_list[:-1], fresh=False)
         cmdict['parent_id'] = parent_shelf.id
         cmdict['link_count'] = 1  # I think?
 
@@ -688,6 +1129,7 @@ class LibrarianCommandEngine(object):
         self.errno = errno.EINVAL
         shelf = TMShelf(cmdict)
         self.db.create_shelf(shelf)
+        self.dentries.invalidate(shelf.parent_id, shelf.name)
 
         self.db.create_symlink(shelf, cmdict['target'])
 
@@ -700,31 +1142,22 @@ class LibrarianCommandEngine(object):
             Output(string)---
                 path to where symlink points
         """
-        shelf = self._path2shelf(cmdict['path'])
+        shelf = self._path2shelf(cmdict['path'], fresh=False)
         return self.db.get_symlink_target(shelf)
 
     def cmd_get_shelf_path(self, cmdict):
         ''' Retrieves path to any given shelf
             "shelf" is an incomplete shelf generated from cmdict
-            "current_shelf" is complete shelf fetched from db
         '''
-        path = ['/']
         shelf = TMShelf(cmdict)
         shelf.matchfields = ('name', 'parent_id')
-        current_shelf = self.db.get_shelf(shelf)  # shelf who needs path
-        path.insert(1, current_shelf.name)
-        while current_shelf.parent_id != 2:
-            # modify passing command dict
-            cmdict['id'] = current_shelf.parent_id
-            shelf = TMShelf(cmdict)
-            shelf.matchfields = ('id', )
-            current_shelf = self.db.get_shelf(shelf)
-            path.insert(1, '/')
-            path.insert(1, current_shelf.name)
-
-        return str().join(path)
+        path = self.db.get_shelf_path(shelf)    # one trip, all ancestors
+        self.errno = errno.ENOENT
+        assert path is not None, 'no such shelf %s' % shelf.name
+        return path
 
-    def _path2list(self, path):
+    @staticmethod
+    def _path2list(path):
         """ Splits path strings into list of names """
         # if path is already a list, just clean it up
         if type(path) is list:
@@ -746,6 +1179,55 @@ class LibrarianCommandEngine(object):
         self.db.modify_node_mc_status(
             cmdict['context']['node_id'], cmdict['status'])
 
+    _UNBATCHABLE = ('batch', 'send_OOB')
+
+    def cmd_batch(self, cmdict):
+        """ Run several commands, in order, as one unit of work.
+            In (dict)---
+                commands: list of cmdicts; the batch's context is used
+                stop_on_error: at the first failure, stop and keep nothing
+            Out (list) ---
+                a reply per command as for a lone command but without
+                context, or None for a command that never ran
+        """
+        subcmds = cmdict['commands']
+        self.errno = errno.EINVAL
+        assert isinstance(subcmds, list), 'batch commands must be a list'
+        stop_on_error = cmdict.get('stop_on_error', True)
+        freebooks_changes = self.freebooks.changes
+        results = [ None ] * len(subcmds)
+        for i, subcmd in enumerate(subcmds):
+            self.errno = 0
+            errmsg = ''
+            self.db.begin_command()     # nested: a failure undoes only it
+            try:
+                name = subcmd.get('command', None)
+                command = self._commands.get(name, None)
+                self.errno = errno.ENOSYS
+                assert command is not None and \
+                    name not in self._UNBATCHABLE, \
+                    'cannot batch "%s"' % name
+                self.errno = 0
+                subcmd['context'] = cmdict['context']
+                ret = command(self, subcmd)
+            except (AssertionError, RuntimeError) as e:
+                errmsg = str(e)
+            except Exception as e:
+                traceback.print_exception(*sys.exc_info())
+                errmsg = 'INTERNAL CODING ERROR: %s' % str(e)
+            if self.db.end_command(ok=not errmsg):
+                self._undone(freebooks_changes)
+            if not errmsg:
+                results[i] = self._value(ret)
+                continue
+            results[i] = { 'errmsg': errmsg, 'errno': self.errno }
+            if stop_on_error:
+                self.db.rollback()      # all of it, back to __call__
+                self._undone(freebooks_changes)
+                break
+        self.errno = 0
+        return results
+
     #######################################################################
 
     _commands = None
@@ -764,6 +1246,8 @@ class LibrarianCommandEngine(object):
 
             self.__class__.nodes = self.db.get_nodes()
             assert self.nodes, 'Database has no nodes'
+            # Checked on every command; an FRDnode costs MC construction.
+            self.__class__.node_ids = frozenset(n.node_id for n in self.nodes)
             if self.verbose:
                 racknum = 1
                 racknodes = [ n for n in self.nodes if n.rack == racknum ]
@@ -803,17 +1287,16 @@ class LibrarianCommandEngine(object):
                 # Here, "IG" is synonymous with "chunk of contiguous memory".
                 # Right now there's just one per compute partition but
                 # expansion is possible.  Or barefoot nodes.
+                per_IG = { }
+                for (ig, allocated), books in \
+                        self.db.get_book_counts().items():
+                    ignum = ig & 0xffff
+                    per_IG[ignum] = per_IG.get(ignum, 0) + books
                 for ignum in range(0, 100):     # Plenty for 990x
-                    self.db.execute('''SELECT COUNT(*) FROM books
-                                       WHERE intlv_group & 0xffff = ?''',
-                                       (ignum,))
-                    tmp = self.db.fetchone()
-                    assert len(tmp) == 1, 'BIImode unexpected DB return'
-                    tmp = tmp[0]
-                    if tmp:
+                    if per_IG.get(ignum, 0):
                         IGs.append(GenericObject(
                             groupId=ignum,
-                            total_books=tmp))
+                            total_books=per_IG[ignum]))
                 # Idiot check, probably books with ignum > 100
                 self.db.execute('''SELECT COUNT(*) FROM books''')
                 tmp = self.db.fetchone()[0]
@@ -850,6 +1333,18 @@ class LibrarianCommandEngine(object):
                     assert len(tmp) == 1, 'Books table is corrupt'
                     elems[1] = tmp[0].id
 
+            # FREE books by IG for BookPolicy, kept current by
+            # _set_book_alloc().  The books table remains authoritative.
+            self.freebooks = FreeBooks(self.db)
+            if self.verbose:
+                print(self.freebooks)
+
+            # (parent_id, name) -> shelf, for path walks
+            self.dentries = DentryCache()
+            self.writer = self      # vs. reader() and worker() copies
+            self.readers = self.workers = None
+            self.locks = LockTable()
+
             # Create method lookup table by stripping the 'cmd_' prefix
 
             self.__class__._commands = dict(
@@ -886,17 +1381,30 @@ class LibrarianCommandEngine(object):
             errmsg = 'engine failed lookup on "%s"' % str(e)
             print('!' * 20, errmsg, file=sys.stderr)
             # Higher-order internal error
-            return { 'errmsg': errmsg, 'errno': errno.ENOSYS }, None
+            return { 'errmsg': errmsg, 'errno': errno.ENOSYS,
+                     'context': cmdict.get('context', None) }, None
 
+        began = False
         try:
-            # If this is a performance problem, cache node_id
-            assert FRDnode(int(cmdict['context']['node_id'])) in self.nodes, \
+            node_id = int(cmdict['context']['node_id'])
+            assert node_id in self.node_ids, \
                 'Node is not configured in Librarian topology'
-            # Advance the last-known-contact timestamp.
-            self.db.modify_node_soc_status(cmdict['context']['node_id'])
+            # Advance the last-known-contact timestamp (in memory).
+            # offload() already did that for a reader.
+            if self.writer is self:
+                self.db.modify_node_soc_status(cmdict['context']['node_id'])
             errmsg = ''  # High-level internal errors, not LFS state errors
             self.errno = 0
             ret = OOBmsg = None
+            freebooks_changes = self.freebooks.changes
+            # A reader's command needs its transaction for one snapshot
+            # across all its SELECTs.  The writer without workers is the
+            # only one changing the database, so it sees one state anyway
+            # and a read-only command can skip BEGIN and its SAVEPOINT.
+            if cmdict['command'] not in self.READ_ONLY or \
+               self.writer is not self or self.workers is not None:
+                self.db.begin_command()
+                began = True
             ret = command(self, cmdict)
         except (AssertionError, RuntimeError) as e:  # programmed checks
             errmsg = str(e)
@@ -904,6 +1412,9 @@ class LibrarianCommandEngine(object):
             traceback.print_exception(*sys.exc_info())
             errmsg = 'INTERNAL CODING ERROR: %s' % str(e)
 
+        if began and self.db.end_command(ok=not errmsg):
+            self._undone(freebooks_changes)
+
         if errmsg:  # Looks better _cooked
             if self.verbose > 2:
                 print('%s failed: %s: %s' %
@@ -911,7 +1422,8 @@ class LibrarianCommandEngine(object):
                        errno.errorcode.get(self.errno, ''),
                        errmsg),
                       file=sys.stderr)
-            return { 'errmsg': errmsg, 'errno': self.errno }, None
+            return { 'errmsg': errmsg, 'errno': self.errno,
+                     'context': context }, None     # has sequence
 
         if isinstance(ret, dict):
             OOBmsg = ret.get('OOBmsg', None)
@@ -922,17 +1434,247 @@ class LibrarianCommandEngine(object):
             return ret, OOBmsg
 
         # Create a dict to which context will be added
+        value = self._value(ret)
+        value['context'] = context  # has sequence
+        return value, OOBmsg
+
+    def _value(self, ret):
+        '''A command's return as the "value" of a reply'''
+        if self._cooked:
+            return ret
         if type(ret) in (dict, str) or ret is None:
-            value = { 'value': ret }
-        elif isinstance(ret, list):
+            return { 'value': ret }
+        if isinstance(ret, list):
             try:
                 value = { 'value': [ r.dict for r in ret ] }
             except Exception as e:
                 value = { 'value': ret }
+            if isinstance(ret, Page):
+                value['after_id'] = ret.after_id
+                value['more'] = ret.more
+            return value
+        return { 'value': ret.dict }
+
+    def _undone(self, freebooks_changes):
+        '''A failed command leaves no trace in the DB, so nothing in memory
+           may remember what it did either.'''
+        self.dentries.clear()
+        if self.freebooks.changes != freebooks_changes:
+            self.db.begin_command()     # as the writer, so no worker is
+            self.db.hold_writes()       # in the middle of an allocation
+            self.freebooks.rebuild()
+            self.db.end_command()
+
+    # Never change state: safe for reader threads.  Anything they call,
+    # down to BookPolicy.xattr_assist(), must only read.
+    READ_ONLY = frozenset((
+        'get_book_all',
+        'get_book_ig',
+        'get_book_info_all',
+        'get_fs_stats',
+        'get_shelf',
+        'get_shelf_path',
+        'get_xattr',
+        'list_shelf_books',
+        'list_shelves',
+        'list_open_shelves',
+        'list_moves',
+        'list_xattrs',
+        'readlink',
+    ))
+
+    # Cheap, and they only touch this engine's in-memory SoC status
+    _INLINE = frozenset((
+        'update_node_mc_status',
+        'update_node_soc_status',
+        'version',
+    ))
+
+    # Commands that add or remove names in the directory of their path(s)
+    _DIR_CHANGES = frozenset((
+        'create_shelf',
+        'destroy_shelf',
+        'mkdir',
+        'rename_shelf',
+        'rmdir',
+        'symlink',
+    ))
+
+    def reader(self, backend):
+        '''A copy of this engine for running READ_ONLY commands on another
+           thread over a read-only backend.  Topology and policy are shared.
+           The dentry cache is not: it follows this engine's writes, which
+           may be ahead of what the reader's snapshot can see.'''
+        reader = copy(self)
+        reader.db = backend
+        reader.dentries = DentryCache(max_entries=0)
+        reader.readers = reader.workers = reader.locks = None
+        return reader
+
+    def worker(self, backend):
+        '''A copy of this engine for running any command on another thread.
+           The backend must be lazy (see SQLite3assist): workers read side
+           by side, each under the locks from lock_keys(), and take turns
+           as SQLite's writer.  The FREE book index is shared, so picks from
+           it are made as the writer (see cmd_resize_shelf()).  Commands
+           commit as they end, so a reader can't miss a write that's been
+           replied to.'''
+        worker = self.reader(backend)
+        worker.freebooks = self.freebooks.view(backend)
+        worker.locks = self.locks
+        backend.group_commit_secs = 0.0
+        return worker
+
+    def start_readers(self, backend_factory, nthreads):
+        if nthreads > 0:
+            self.readers = EnginePool(
+                self.reader, backend_factory, nthreads, 'reader')
+
+    def start_workers(self, backend_factory, nthreads):
+        if nthreads > 0:
+            self.workers = EnginePool(
+                self.worker, backend_factory, nthreads, 'worker')
+
+    @classmethod
+    def lock_keys(cls, cmdict):
+        '''Each shelf a command names, by path and by id, and each
+           directory whose entries it changes.  An rmdir changes its own
+           directory too, as far as a create in it is concerned.  A shelf
+           named only by path gets its id key from shelf_lock_keys().'''
+        name = cmdict['command']
+        if name == 'batch':
+            keys = set()
+            for subcmd in cmdict['commands']:
+                keys |= cls.lock_keys(subcmd)
+            return keys
+        keys = set()
+        if cmdict.get('id', None) is not None:
+            keys.add(('shelf', str(cmdict['id'])))
+        for field in ('path', 'newpath'):
+            if field not in cmdict:
+                continue
+            path_list = cls._path2list(cmdict[field])
+            keys.add(('path', '/' + '/'.join(path_list)))
+            if name in cls._DIR_CHANGES:
+                keys.add(('dir', '/' + '/'.join(path_list[:-1])))
+            if name == 'rmdir':
+                keys.add(('dir', '/' + '/'.join(path_list)))
+        return keys
+
+    def shelf_lock_keys(self, cmdict):
+        '''lock_keys() plus the id key of each shelf named by path, so
+           close_shelf by id and destroy_shelf by path, say, take the same
+           lock for the same shelf.'''
+        keys = self.lock_keys(cmdict)
+        for kind, name in list(keys):
+            if kind == 'path':
+                shelf = self._path2shelf(name, fresh=False)
+                if shelf is not None:
+                    keys.add(('shelf', str(shelf.id)))
+        return keys
+
+    def run(self, cmdict):
+        '''__call__ for a pool thread, under the command's locks if any.
+           A path can name another shelf by the time its locks are held,
+           so the ids are looked up again under them, until they match.'''
+        if self.locks is None:
+            return self(cmdict)
+        try:
+            keys = self.shelf_lock_keys(cmdict)
+        except Exception as e:
+            keys = set()    # malformed: let __call__ say what's wrong
+        while True:
+            with self.locks.held(keys):
+                try:
+                    again = self.shelf_lock_keys(cmdict)
+                except Exception as e:
+                    again = keys
+                if again <= keys:
+                    return self(cmdict)
+            keys |= again
+
+    @property
+    def lock_stats(self):
+        stats = self.locks.stats
+        if self.workers is not None:
+            db = dict(acquired=0, contended=0, wait_secs=0.0,
+                      max_wait_secs=0.0)
+            for worker in self.workers.engines:
+                waits = worker.db.write_waits
+                db['acquired'] += waits['acquired']
+                db['contended'] += waits['contended']
+                db['wait_secs'] += waits['wait_secs']
+                db['max_wait_secs'] = max(db['max_wait_secs'],
+                                          waits['max_wait_secs'])
+            stats['db'] = db
+        return stats
+
+    @property
+    def statement_stats(self):
+        '''Executions and seconds per SQL statement over this engine and
+           its pools.  Whitespace is squeezed out of the SQL to make a key
+           that reads well in a JSON reply.'''
+        dbs = [ self.db ]
+        for pool in (self.readers, self.workers):
+            if pool is not None:
+                dbs.extend(engine.db for engine in pool.engines)
+        stats = { }
+        for db in dbs:
+            # Pool threads add statements as they go: copy first
+            for sql, (count, secs) in dict(db.statement_stats).items():
+                total = stats.setdefault(' '.join(sql.split()),
+                                         dict(count=0, secs=0.0))
+                total['count'] += count
+                total['secs'] += secs
+        return stats
+
+    def offload(self, cmdict, done):
+        '''Hand cmdict to a reader or worker thread if that's safe, in which
+           case done(reply, OOBmsg) will be called from there.  Returns
+           False if the caller must run it as usual.
+
+           A node must never read stale data after its own write.  Writes
+           wait for the group commit, and readers can't see them until
+           then, so nothing goes to a reader while any is uncommitted.
+           Otherwise a reader's snapshot starts after every write it could
+           have been sent behind was committed.'''
+        command = cmdict.get('command', None)
+        if (self.readers is not None and
+            command in self.READ_ONLY and
+            not self.db.pending):
+            pool = self.readers
+        elif (self.workers is not None and
+              command in self._commands and
+              command not in self._INLINE):
+            pool = self.workers
         else:
-            value = { 'value': ret.dict }
-        value['context'] = context  # has sequence
-        return value, OOBmsg
+            return False
+        try:
+            node_id = int(cmdict['context']['node_id'])
+        except Exception as e:
+            return False    # let __call__ say what's wrong with it
+        if node_id in self.node_ids:
+            self.db.modify_node_soc_status(cmdict['context']['node_id'])
+        pool.submit(cmdict, done)
+        return True
+
+    def close(self):
+        for pool in (self.readers, self.workers):
+            if pool is not None:
+                pool.close()
+        self.readers = self.workers = None
+
+    def flush(self, force=False):
+        '''Give the DB a chance to close its group commit window.  Returns
+           seconds until it wants to be called again, or None.'''
+        return self.db.flush(force)
+
+    def commit_token(self):
+        '''For Server.serv(), to hold a reply until its work is committed'''
+        return self.db.commit_token()
+
+    def committed(self, token):
+        return self.db.committed(token)
 
     @property
     def commandset(self):
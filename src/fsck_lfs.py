@@ -289,6 +289,41 @@ def _70_fix_link_counts(db):
 ###########################################################################
 
 
+def _80_recount_books(db):
+    '''Check the book_counts summary against the books themselves'''
+    db.execute('''SELECT intlv_group, allocated, COUNT(*) FROM books
+                  GROUP BY intlv_group, allocated''')
+    actual = dict(((ig, allocated), books)
+                  for ig, allocated, books in db.fetchall())
+    counted = db.get_book_counts()
+    wrong = [ key for key in set(actual) | set(counted)
+              if actual.get(key, 0) != counted.get(key, 0) ]
+    print('%d inconsistency(ies)' % len(wrong))
+    if not wrong:
+        return
+    db.execute('DELETE FROM book_counts')
+    db.execute('''INSERT INTO book_counts
+                  SELECT intlv_group, allocated, COUNT(*) FROM books
+                  GROUP BY intlv_group, allocated''')
+    db.commit()
+
+###########################################################################
+# A rename between shards that a crash interrupted leaves its half here on
+# each shard.  Only shard_router.py sees both halves, and it finishes or
+# undoes them when it starts, so just say what's waiting.
+
+
+def _90_pending_moves(db):
+    '''Report renames between shards awaiting shard_router.py recovery'''
+    moves = db.get_moves()
+    print('%d detected' % len(moves))
+    for move in moves:
+        print('\t%s: %s %s (shelf %s)' % (
+            move['txn'], move['direction'], move['state'], move['shelf_id']))
+
+###########################################################################
+
+
 def capacity(db):
     '''Print stats until a problem occurs'''
     db.execute('SELECT books_total FROM globals')
@@ -324,7 +359,9 @@ if __name__ == '__main__':
               _40_verify_shelves_return_orphaned_books,
               _50_clear_orphaned_xattrs,
               _60_find_lost_shelves,
-              _70_fix_link_counts):
+              _70_fix_link_counts,
+              _80_recount_books,
+              _90_pending_moves):
         try:
             print(f.__doc__, end=': ')
             f(db)
@@ -21,6 +21,7 @@
 import argparse
 import errno
 import glob
+import itertools
 import os
 import psutil
 import shlex
@@ -36,10 +37,10 @@ from pdb import set_trace
 
 from tm_fuse import TMFS, TmfsOSError, Operations, LoggingMixIn, tmfs_get_context
 
-from book_shelf_bos import TMShelf
+from book_shelf_bos import BookColumns, TMShelf
 from cmdproto import LibrarianCommandProtocol
 from frdnode import FRDnode, FRDFAModule
-from socket_handling import Client, lfsLogger
+from socket_handling import Client, Demux, lfsLogger
 
 from lfs_shadow import the_shadow_knows
 
@@ -79,10 +80,10 @@ def prentry(func):
         self.logger.info('----------------------------------')
         if self.verbose:
             tmp = ', '.join([str(a) for a in args[1:]])
-            p_data = str(self.lcp._context['pid'])
+            p_data = str(tmfs_get_context()[2])
             if self.verbose > 1:
                 # Could use psutil if we need more functionality
-                comm = '/proc/' + str(self.lcp._context['pid']) + '/comm'
+                comm = '/proc/' + p_data + '/comm'
                 try:
                     with open(comm, 'r') as f:
                         p_data += '/' + f.read().replace('\n', '')
@@ -157,15 +158,24 @@ class LibrarianFS(Operations):  # Name shows up in mount point
             'physloc': physloc,
         }
         self.lcp = LibrarianCommandProtocol(context)
-        self.inflight = threading.Lock()
 
         # Command-line miscues like a bad shadow path.  However that needs a
         # socket, so do it now.
 
-        # connect() has an infinite retry
-        self.torms = Client(selectable=False, verbose=self.verbose)
-        self.torms.connect(host=self.host, port=self.port)
-        self.logger.info('%s: connected' % self.torms)
+        # connect() has an infinite retry.  The first connection is for
+        # FuSE operations.  Heartbeats and zeroing bookkeeping take turns on
+        # the others so they never queue in front of a getattr or open,
+        # here or in the librarian (which serves connections round-robin).
+        # Every connection hears the OOB broadcast; listen on one.
+        self.channels = [ ]
+        for i in range(max(1, args.connections)):
+            client = Client(selectable=False, verbose=self.verbose)
+            client.connect(host=self.host, port=self.port)
+            self.logger.info('%s: connected' % client)
+            self.channels.append(Demux(client, None if i else self.handleOOB))
+        self.torms = self.channels[0].client
+        self.background = itertools.cycle(
+            self.channels[1:] or self.channels)
 
         lfs_globals = self.librarian(self.lcp('get_fs_stats'))
         self.bsize = lfs_globals['book_size_bytes']
@@ -217,14 +227,16 @@ class LibrarianFS(Operations):  # Name shows up in mount point
         self.librarian(self.lcp('update_node_mc_status',
                                 status=FRDFAModule.MC_STATUS_OFFLINE))
         assert threading.current_thread() is threading.main_thread()
-        self.torms.close()
+        for channel in self.channels:
+            channel.client.close()
         del self.torms
 
     # helpers
 
     def get_bos(self, shelf):
         path = self.get_shelf_path(shelf)
-        shelf.bos = self.librarian(self.lcp('list_shelf_books', path=path))
+        shelf.bos = BookColumns.from_wire(self.librarian(
+            self.lcp('list_shelf_books', path=path, columns='delta')))
         # Replaced a per-book loop of lcp('get_book') which was done
         # in anticipation of drilling down on more info.  Turns out
         # we have everything we need.   This could easily be in the
@@ -253,14 +265,16 @@ class LibrarianFS(Operations):  # Name shows up in mount point
     # Third level:  shelves
 
     def handleOOB(self):
+        # Called by whichever thread is reading for the Demux.
         # ALTERNATIVE: Put the message on a Queue for the main thread.
-        assert threading.current_thread() is threading.main_thread()
         for oob in self.torms.inOOB:
             self.logger.warning('\t\t!!!!!!!!!!!!!!!!!!!!!!!! %s' % oob)
         self.torms.clearOOB()
 
-    def librarian(self, cmdict, errorOK=False):
-        '''Dictionary in, dictionary out'''
+    def librarian(self, cmdict, errorOK=False, background=False):
+        '''Dictionary in, dictionary out.  Background work, including
+           anything done to a shelf that's being zeroed, goes on a
+           connection of its own.'''
         # There are times when the process that invoked an action,
         # notably release(), has died by the time this point is reached.
         # In that case uid/gid/pid will all be zero.
@@ -284,59 +298,87 @@ class LibrarianFS(Operations):  # Name shows up in mount point
         # first approximation, just do a (re) connect on detection.   Better
         # attempts need to add a reconnect timeout, split send_all from
         # recv_all error processing, put a "while" around certain things...
+        # Several requests can be in flight on each socket; the Demux
+        # sorts the replies out by seq.  Seqs are unique across all of
+        # them (one LibrarianCommandProtocol), which is more than needed.
+        if background or self._ZERO_PREFIX in str(cmdict.get('path', '')):
+            demux = next(self.background)
+        else:
+            demux = self.channels[0]
         errmsg = { }
         rspdict = None
-        with self.inflight:
-            try:
-                self.torms.send_all(cmdict)
-                while rspdict is None:
-                    rspdict = self.torms.recv_all()
-                    if self.torms.inOOB:
-                        self.handleOOB()
-                if 'errmsg' in rspdict:  # higher-order librarian internal error
-                    errmsg['errmsg'] = rspdict['errmsg']
-                    errmsg['errno'] = rspdict['errno']
-            except OSError as e:
-                errmsg['errmsg'] = 'Communications error with librarian'
-                errmsg['errno'] = e.errno   # was always HOSTDOWN
-                if e.errno in (errno.ECONNABORTED, ):
-                    tmp = self.torms.connect(reconnect=True)
-                    if tmp:
-                        # If request is idempotent, re-issue (need a while loop)
-                        pass  # for now
-            except MemoryError as e:  # OOB storm and internal error not pull instr
-                errmsg['errmsg'] = 'OOM BOOM'
-                errmsg['errno'] = errno.ENOMEM
-            except Exception as e:
-                errmsg['errmsg'] = str(e)
-                errmsg['errno'] = errno.EREMOTEIO
-
-            # if rspdict is None a comms error occurred and it's game over.
-            # Otherwise an error occurred in evaluating the request (ie, shelf
-            # not found).  In general quitting here is sufficent.
-            if errmsg:
-                self.logger.error('%s failed: %s' % (command, errmsg['errmsg']))
-                if rspdict is not None and errorOK:
-                    return rspdict
-                raise TmfsOSError(errmsg['errno'])
+        generation = demux.generation
+        try:
+            rspdict = demux.transact(cmdict)
+            if 'errmsg' in rspdict:  # higher-order librarian internal error
+                errmsg['errmsg'] = rspdict['errmsg']
+                errmsg['errno'] = rspdict['errno']
+        except OSError as e:
+            errmsg['errmsg'] = 'Communications error with librarian'
+            errmsg['errno'] = e.errno   # was always HOSTDOWN
+            if e.errno in (errno.ECONNABORTED, ):
+                tmp = demux.reconnect(generation)
+                if tmp:
+                    # If request is idempotent, re-issue (need a while loop)
+                    pass  # for now
+        except MemoryError as e:  # OOB storm and internal error not pull instr
+            errmsg['errmsg'] = 'OOM BOOM'
+            errmsg['errno'] = errno.ENOMEM
+        except Exception as e:
+            errmsg['errmsg'] = str(e)
+            errmsg['errno'] = errno.EREMOTEIO
+
+        # if rspdict is None a comms error occurred and it's game over.
+        # Otherwise an error occurred in evaluating the request (ie, shelf
+        # not found).  In general quitting here is sufficent.
+        if errmsg:
+            self.logger.error('%s failed: %s' % (command, errmsg['errmsg']))
+            if rspdict is not None and errorOK:
+                return rspdict
+            raise TmfsOSError(errmsg['errno'])
+
+        try:
+            value = rspdict['value']
+            rspseq = rspdict['context']['seq']
+            if seq != rspseq:
+                msg = 'Response not for me %s != %s' % (seq, rspseq)
+                self.logger.error(msg)
+                # raise OSError(errno.EILSEQ, msg)
+                raise TmfsOSError(errno.EILSEQ)
+        except KeyError as e:
+            raise OSError(errno.ERANGE, 'Bad response format')
+
+        return value  # None is legal, let the caller deal with it.
 
+    _batching = True    # until the librarian turns out to be too old
+
+    def librarian_batch(self, *cmdicts):
+        '''Several commands in one round trip and one transaction; returns
+           their values in order.  The first failure raises just as
+           librarian() does, and then none of them took effect.'''
+        if self._batching:
             try:
-                value = rspdict['value']
-                rspseq = rspdict['context']['seq']
-                if seq != rspseq:
-                    msg = 'Response not for me %s != %s' % (seq, rspseq)
-                    self.logger.error(msg)
-                    # raise OSError(errno.EILSEQ, msg)
-                    raise TmfsOSError(errno.EILSEQ)
-            except KeyError as e:
-                raise OSError(errno.ERANGE, 'Bad response format')
-
-            return value  # None is legal, let the caller deal with it.
+                rsps = self.librarian(self.lcp.batch(*cmdicts))
+            except TmfsOSError as e:
+                if e.errno != errno.ENOSYS:
+                    raise
+                self.logger.warning('librarian cannot batch commands')
+                self._batching = False
+        if not self._batching:
+            return [ self.librarian(cmdict) for cmdict in cmdicts ]
+        values = [ ]
+        for cmdict, rsp in zip(cmdicts, rsps):
+            if 'errmsg' in rsp:     # and the rest never ran
+                self.logger.error('%s failed: %s' % (
+                    cmdict['command'], rsp['errmsg']))
+                raise TmfsOSError(rsp['errno'])
+            values.append(rsp['value'])
+        return values
 
     def send_heartbeat(self):
         try:
             net_io = psutil.net_io_counters(pernic=False)
-            self.librarian(self.lcp('update_node_soc_status',
+            cmdict = self.lcp('update_node_soc_status',
                             status=self.lfs_status,
                             cpu_percent=int(psutil.cpu_percent(interval=None)),
                             rootfs_percent=int(psutil.disk_usage('/')[-1]),
@@ -344,7 +386,8 @@ class LibrarianFS(Operations):  # Name shows up in mount point
                                 self.prev_net_io_in)/self.heartbeat_interval),
                             network_out=int((net_io.bytes_sent -
                                 self.prev_net_io_out)/self.heartbeat_interval),
-                            mem_percent=int(psutil.virtual_memory().percent)))
+                            mem_percent=int(psutil.virtual_memory().percent))
+            self.librarian(cmdict, background=True)
             self.prev_net_io_in = net_io.bytes_recv
             self.prev_net_io_out = net_io.bytes_sent
         except Exception as e:
@@ -667,6 +710,7 @@ class LibrarianFS(Operations):  # Name shows up in mount point
         tmp = self.lcp('create_shelf', path=path, mode=tmpmode)
         rsp = self.librarian(tmp)
         shelf = TMShelf(rsp)                # This is an open shelf...
+        shelf.bos = BookColumns()           # ...with no books yet...
         fx = self.shadow.create(shelf, mode)     # ...added to the cache...
         return fx            # ...with this value.
 
@@ -717,12 +761,15 @@ class LibrarianFS(Operations):  # Name shows up in mount point
             z_shelf = TMShelf(z_rsp)
             threading.Thread(target=self._zero, args=(z_shelf,)).start()
 
-        # Refresh shelf info
-        rsp = self.librarian(self.lcp('get_shelf', path=path))
+        # Refresh shelf info and its books in one trip
+        rsp, bos = self.librarian_batch(
+            self.lcp('get_shelf', path=path),
+            self.lcp('list_shelf_books', path=path, columns='delta'))
         shelf = TMShelf(rsp)
         if shelf.size_bytes < length:
             raise TmfsOSError(errno.EINVAL)
-        self.get_bos(shelf)
+        shelf.bos = BookColumns.from_wire(bos)
+        self.logger.info('%s BOS: %s' % (shelf.name, shelf.bos))
         return self.shadow.truncate(shelf, length, fh)
 
     @prentry
@@ -1006,6 +1053,12 @@ if __name__ == '__main__':
         help='do not zero deallocated books; use short sleep in zombie state',
         action='store_true',
         default=False)
+    parser.add_argument(
+        '--connections',
+        help='Librarian connections: one for FuSE operations, the rest for '
+             'heartbeats and zeroing (1 shares it for everything)',
+        type=int,
+        default=2)
     args = parser.parse_args(sys.argv[1:])
 
     msg = 0
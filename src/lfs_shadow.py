@@ -181,11 +181,7 @@ class shadow_support(object):
             # If it grew OR remained the same size, are the first "n" books
             # still the same?  Order matters.
             if shelf.size_bytes >= cached.size_bytes:
-                for i, book in enumerate(cached.bos):
-                    if book != shelf.bos[i]:
-                        break
-                else:
-                    invalidate = False  # the first "n" books match
+                invalidate = not shelf.bos.startswith(cached.bos)
 
             # Update cached object variant fields.  Beware references.
             cached.size_bytes = shelf.size_bytes
@@ -278,17 +274,15 @@ class shadow_support(object):
         bos_index = shelf_offset // self.book_size  # (0..n)
 
         # Stop FS read ahead past shelf, but what about writes?  Later.
-        try:
-            book = bos[bos_index]
-        except Exception as e:
+        if not 0 <= bos_index < len(bos):
             return -1
 
         # Offset into flat space has several contributors.  The concatenated
         # LZA field has already been broken down into constituent parts.
         # Note: in BII.MODE_LZA there are absolute values to work with in
-        # book['id'].  Turns out the IG-relative math works just fine.
-        intlv_group = book['intlv_group'] & BII.VALUE_MASK
-        book_num = book['book_num']                     # Relative to IG
+        # bos.id.  Turns out the IG-relative math works just fine.
+        intlv_group = bos.intlv_group[bos_index] & BII.VALUE_MASK
+        book_num = bos.book_num[bos_index]              # Relative to IG
         ig_base = self._igstart[intlv_group]            # absolute
         book_start = book_num * self.book_size          # relative to ig_base
         book_offset = shelf_offset % self.book_size     # relative to book
@@ -382,18 +376,12 @@ class shadow_support(object):
            longs that will fit into buflen'''
         # BII.MODE_PHYSADDR mode LZA contains starting physical book
         # address in bits [63:20] so the entire 64 bit address is passed.
-        response = bytearray()
         bos = self[(shelf.id, None)].bos
-        offset = 0
-        while buflen > offset + 7 and start_book < len(bos):
-            # FIXME: 33 should be "apertures._BOOK_SHIFT" but that's a
-            # circular import.  Is all the data in bos[] elements now after
-            # the 2017-10 'list_shelf_book' changes for 990x?
-            tmp = struct.pack('Q', bos[start_book]['id'])
-            response.extend(tmp)
-            offset += 8
-            start_book += 1
-        return response
+        # The id column is already 64-bit native ints, as packed 'Q's.
+        nbooks = min(buflen // 8, len(bos) - start_book)
+        if nbooks <= 0:
+            return bytearray()
+        return bytearray(bos.id[start_book:start_book + nbooks].tobytes())
 
     # Piggybacked for kernel to ask for stuff.  Even in --shadow_[dir|file]
     # it wants globals, handle that here.  During mmap fault handling it
@@ -704,9 +692,8 @@ class apertures(shadow_support):
 
             # tmfs is always looking for an LZA.  Calculate if necessary.
             # map_addr calculations should be rolled up across two spots.
-            baseBOS = bos[shelf_book_num]
             if self.BIImode in (BII.MODE_LZA, BII.MODE_PHYSADDR):
-                bookID = baseBOS['id']
+                bookID = bos.id[shelf_book_num]
             else:
                 return 'ERROR'
 
@@ -736,7 +723,7 @@ class apertures(shadow_support):
                     if phys_offset == -1:
                         return 'ERROR'
                     map_addr = self.aperture_base + phys_offset
-                    # tmp = baseBOS['id'] + PABO % self.book_size # yes it agrees
+                    # tmp = bookID + PABO % self.book_size # yes it agrees
             elif self.addr_mode == self._MODE_1906_DESC:
                 # Should match kernel calculations.  # books <= # descriptors
                 # and DESBK is preprogrammed so LZA -> aperture number.
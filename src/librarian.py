@@ -52,6 +52,8 @@ def main():
 
     backend = LBE(parseargs)
     lce = LCE(backend, parseargs)
+    lce.start_readers(backend.reader, parseargs.readers)
+    lce.start_workers(lambda: LBE(parseargs, lazy=True), parseargs.workers)
     server = Server(parseargs)
 
     try:
@@ -59,6 +61,7 @@ def main():
     except Exception as e:
         print(str(e))
 
+    lce.close()
     backend.close()
 
 if __name__ == '__main__':
@@ -16,7 +16,11 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 from function_chain import Link, Chain
+from array import array
+from collections import OrderedDict
 import json
+import struct
+import sys
 
 from pdb import set_trace
 
@@ -44,7 +48,9 @@ class JSONDumpsLoadsLink(Link):
         Returns:
             Python dictionary object
         """
-        return json.loads(obj)
+        return self._decoder.decode(obj)
+
+    _decoder = json.JSONDecoder(strict=False)   # allow chars such as CRLF
 
 
 class StrEncDecLink(Link):
@@ -62,12 +68,12 @@ class StrEncDecLink(Link):
     def reverse(self, obj):
         """ Decode encoding
         Args:
-            obj: Byte string, like from Socket.recv()
+            obj: Byte string (or memoryview), like from Socket.recv()
 
         Returns:
             Python3 string
         """
-        return obj.decode("utf-8")
+        return str(obj, "utf-8")
 
 
 class LibrarianChain(Chain):
@@ -82,3 +88,365 @@ class LibrarianChain(Chain):
         super().__init__()
         self.append(JSONDumpsLoadsLink())
         self.append(StrEncDecLink())
+
+
+###########################################################################
+# A compact binary alternative to JSON, in the spirit of msgpack: a type
+# byte, then a fixed-size or length-prefixed body, all little-endian.
+#
+#   0x00-0x7f   int 0..127          0xe0-0xff   int -32..-1
+#   0x80-0x8f   map, < 16 pairs     0xde/0xdf   map, u16/u32 pairs
+#   0x90-0x9f   list, < 16 items    0xdc/0xdd   list, u16/u32 items
+#   0xa0-0xbf   str, < 32 bytes     0xd9-0xdb   str, u8/u16/u32 bytes
+#   0xc0 None   0xc2 False   0xc3 True   0xcb float64
+#   0xd0-0xd3   int8/16/32/64       0xcf uint64    0xc1 bigint (u16 + ascii)
+#   0xd4/0xd5   map key seen before, u8/u16 index into the key table
+#   0xc5        table: a list of maps sharing one key list
+#
+# Map keys are strings (others are converted the way json.dumps does) and
+# every new one goes in a per-message key table, so repeated keys cost one
+# or two bytes.  A table is the shape of every bulk reply (books, shelves):
+# u32 rows, u8 columns, then per column its key and either a type code
+# from 'bhiq' followed by packed integers, or 'g' followed by one encoded
+# value per row.
+
+
+def _intcode(size):
+    for code in 'bhilq':
+        if array(code).itemsize == size:
+            return code
+    raise RuntimeError('No array typecode for %d-byte integers' % size)
+
+
+class CompactCodecLink(Link):
+    """ Link between Python objects and the compact binary encoding """
+
+    _INTCOLS = (    # wire code, array typecode, min, max
+        ('b', _intcode(1), -(1 << 7), (1 << 7) - 1),
+        ('h', _intcode(2), -(1 << 15), (1 << 15) - 1),
+        ('i', _intcode(4), -(1 << 31), (1 << 31) - 1),
+        ('q', _intcode(8), -(1 << 63), (1 << 63) - 1),
+    )
+    _INTCODES = dict((c[0], c[1]) for c in _INTCOLS)
+    _SWAP = sys.byteorder != 'little'
+
+    _I8 = struct.Struct('<b')
+    _I16 = struct.Struct('<h')
+    _I32 = struct.Struct('<i')
+    _I64 = struct.Struct('<q')
+    _U8 = struct.Struct('<B')
+    _U16 = struct.Struct('<H')
+    _U32 = struct.Struct('<I')
+    _U64 = struct.Struct('<Q')
+    _F64 = struct.Struct('<d')
+
+    def forward(self, obj):
+        """ Python object -> compact bytes
+
+        Args:
+            obj: anything json.dumps() could take
+
+        Returns:
+            bytearray
+        """
+        out = bytearray()
+        self._pack(obj, out, { })
+        return out
+
+    def reverse(self, obj):
+        """ compact bytes -> Python object
+
+        Args:
+            obj: bytes-like, like from Socket.recv()
+
+        Returns:
+            Python object, with lists where tuples went in
+        """
+        buf = memoryview(obj)
+        try:
+            result, offset = self._unpack(buf, 0, [ ])
+        finally:
+            buf.release()
+        if offset != len(obj):
+            raise ValueError('%d trailing bytes' % (len(obj) - offset))
+        return result
+
+    # Encoding
+
+    def _pack(self, obj, out, keys):
+        t = type(obj)
+        if t is str:
+            self._pack_str(obj, out)
+        elif t is int:
+            self._pack_int(obj, out)
+        elif t is dict:
+            self._pack_map(obj, out, keys)
+        elif t is list or t is tuple:
+            if len(obj) > 1 and type(obj[0]) is dict and \
+               self._pack_table(obj, out, keys):
+                return
+            self._pack_len(len(obj), 0x90, 16, 0xdc, out)
+            for item in obj:
+                self._pack(item, out, keys)
+        elif obj is None:
+            out.append(0xc0)
+        elif t is bool:
+            out.append(0xc3 if obj else 0xc2)
+        elif t is float:
+            out.append(0xcb)
+            out += self._F64.pack(obj)
+        elif isinstance(obj, (str, int, float, dict, list, tuple)):
+            self._pack(self._plain(obj), out, keys)   # subclasses
+        else:
+            raise TypeError('Object of type %s is not serializable' %
+                            t.__name__)
+
+    @staticmethod
+    def _plain(obj):
+        for t in (bool, int, float, str, dict, list):
+            if isinstance(obj, t):
+                return t(obj)
+        return list(obj)
+
+    def _pack_int(self, i, out):
+        if 0 <= i < 0x80:
+            out.append(i)
+        elif -32 <= i < 0:
+            out.append(i & 0xff)
+        elif -(1 << 15) <= i < (1 << 15):
+            if -(1 << 7) <= i < (1 << 7):
+                out.append(0xd0)
+                out += self._I8.pack(i)
+            else:
+                out.append(0xd1)
+                out += self._I16.pack(i)
+        elif -(1 << 31) <= i < (1 << 31):
+            out.append(0xd2)
+            out += self._I32.pack(i)
+        elif -(1 << 63) <= i < (1 << 63):
+            out.append(0xd3)
+            out += self._I64.pack(i)
+        elif 0 <= i < (1 << 64):
+            out.append(0xcf)
+            out += self._U64.pack(i)
+        else:
+            digits = str(i).encode()
+            out.append(0xc1)
+            out += self._U16.pack(len(digits))
+            out += digits
+
+    def _pack_str(self, s, out):
+        b = s.encode('utf-8')
+        n = len(b)
+        if n < 32:
+            out.append(0xa0 | n)
+        elif n < (1 << 8):
+            out.append(0xd9)
+            out.append(n)
+        elif n < (1 << 16):
+            out.append(0xda)
+            out += self._U16.pack(n)
+        else:
+            out.append(0xdb)
+            out += self._U32.pack(n)
+        out += b
+
+    def _pack_len(self, n, fixbase, fixlimit, tag16, out):
+        if n < fixlimit:
+            out.append(fixbase | n)
+        elif n < (1 << 16):
+            out.append(tag16)
+            out += self._U16.pack(n)
+        else:
+            out.append(tag16 + 1)
+            out += self._U32.pack(n)
+
+    def _pack_key(self, key, out, keys):
+        if type(key) is not str:
+            if isinstance(key, str):
+                key = str(key)
+            elif key is None or isinstance(key, (int, float)):
+                key = json.dumps(key)   # as json.dumps() converts keys
+            else:
+                raise TypeError('keys must be str, int, float, bool or None')
+        index = keys.get(key, None)
+        if index is None:
+            if len(keys) < (1 << 16):
+                keys[key] = len(keys)
+            self._pack_str(key, out)
+        elif index < (1 << 8):
+            out.append(0xd4)
+            out.append(index)
+        else:
+            out.append(0xd5)
+            out += self._U16.pack(index)
+
+    def _pack_map(self, d, out, keys):
+        self._pack_len(len(d), 0x80, 16, 0xde, out)
+        for k, v in d.items():
+            self._pack_key(k, out, keys)
+            self._pack(v, out, keys)
+
+    def _pack_table(self, rows, out, keys):
+        names = tuple(rows[0])
+        if not 0 < len(names) < (1 << 8) or len(rows) >= (1 << 32):
+            return False
+        for row in rows:
+            if type(row) is not dict or tuple(row) != names:
+                return False
+        out.append(0xc5)
+        out += self._U32.pack(len(rows))
+        out.append(len(names))
+        for name, column in zip(names, zip(*(r.values() for r in rows))):
+            self._pack_key(name, out, keys)
+            code = self._intcolumn(column)
+            out.append(ord(code))
+            if code == 'g':
+                for value in column:
+                    self._pack(value, out, keys)
+                continue
+            packed = array(self._INTCODES[code], column)
+            if self._SWAP:
+                packed.byteswap()
+            out += packed.tobytes()
+        return True
+
+    def _intcolumn(self, column):
+        for value in column:
+            if type(value) is not int:
+                return 'g'
+        lo, hi = min(column), max(column)
+        for code, _, cmin, cmax in self._INTCOLS:
+            if cmin <= lo and hi <= cmax:
+                return code
+        return 'g'
+
+    # Decoding.  Returns (object, next offset).
+
+    def _unpack(self, buf, offset, keys):
+        tag = buf[offset]
+        offset += 1
+        if tag < 0x80:
+            return tag, offset
+        if tag >= 0xe0:
+            return tag - 0x100, offset
+        if tag <= 0x8f:
+            return self._unpack_map(buf, offset, tag & 0x0f, keys)
+        if tag <= 0x9f:
+            return self._unpack_list(buf, offset, tag & 0x0f, keys)
+        if tag <= 0xbf:
+            end = offset + (tag & 0x1f)
+            return str(buf[offset:end], 'utf-8'), end
+        try:
+            unpacker = self._unpackers[tag]
+        except KeyError:
+            raise ValueError('Bad type byte 0x%02x at %d' % (tag, offset - 1))
+        return unpacker(self, buf, offset, keys)
+
+    def _unpack_key(self, buf, offset, keys):
+        tag = buf[offset]
+        if tag == 0xd4:
+            return keys[buf[offset + 1]], offset + 2
+        if tag == 0xd5:
+            return keys[self._U16.unpack_from(buf, offset + 1)[0]], offset + 3
+        key, offset = self._unpack(buf, offset, keys)
+        if type(key) is not str:
+            raise ValueError('Map key is a %s' % type(key).__name__)
+        if len(keys) < (1 << 16):
+            keys.append(key)
+        return key, offset
+
+    def _unpack_map(self, buf, offset, n, keys):
+        d = { }
+        for _ in range(n):
+            k, offset = self._unpack_key(buf, offset, keys)
+            d[k], offset = self._unpack(buf, offset, keys)
+        return d, offset
+
+    def _unpack_list(self, buf, offset, n, keys):
+        items = [ ]
+        for _ in range(n):
+            item, offset = self._unpack(buf, offset, keys)
+            items.append(item)
+        return items, offset
+
+    def _unpack_table(self, buf, offset, keys):
+        nrows = self._U32.unpack_from(buf, offset)[0]
+        ncols = buf[offset + 4]
+        offset += 5
+        names = [ ]
+        columns = [ ]
+        for _ in range(ncols):
+            name, offset = self._unpack_key(buf, offset, keys)
+            names.append(name)
+            code = chr(buf[offset])
+            offset += 1
+            if code == 'g':
+                column, offset = self._unpack_list(buf, offset, nrows, keys)
+            else:
+                column = array(self._INTCODES[code])
+                end = offset + nrows * column.itemsize
+                if end > len(buf):
+                    raise ValueError('Table column runs off the end')
+                column.frombytes(buf[offset:end])
+                if self._SWAP:
+                    column.byteswap()
+                offset = end
+            columns.append(column)
+        return [ dict(zip(names, row)) for row in zip(*columns) ], offset
+
+    def _unpack_sized(fmt, then):
+        def unpacker(self, buf, offset, keys):
+            n = fmt.unpack_from(buf, offset)[0]
+            return then(self, buf, offset + fmt.size, n, keys)
+        return unpacker
+
+    def _unpack_fixed(fmt):
+        def unpacker(self, buf, offset, keys):
+            return fmt.unpack_from(buf, offset)[0], offset + fmt.size
+        return unpacker
+
+    def _str_body(self, buf, offset, n, keys):
+        return str(buf[offset:offset + n], 'utf-8'), offset + n
+
+    def _bigint_body(self, buf, offset, n, keys):
+        return int(str(buf[offset:offset + n], 'ascii')), offset + n
+
+    _unpackers = {
+        0xc0: lambda self, buf, offset, keys: (None, offset),
+        0xc2: lambda self, buf, offset, keys: (False, offset),
+        0xc3: lambda self, buf, offset, keys: (True, offset),
+        0xcb: _unpack_fixed(_F64),
+        0xd0: _unpack_fixed(_I8),
+        0xd1: _unpack_fixed(_I16),
+        0xd2: _unpack_fixed(_I32),
+        0xd3: _unpack_fixed(_I64),
+        0xcf: _unpack_fixed(_U64),
+        0xc1: _unpack_sized(_U16, _bigint_body),
+        0xd9: _unpack_sized(_U8, _str_body),
+        0xda: _unpack_sized(_U16, _str_body),
+        0xdb: _unpack_sized(_U32, _str_body),
+        0xdc: _unpack_sized(_U16, _unpack_list),
+        0xdd: _unpack_sized(_U32, _unpack_list),
+        0xde: _unpack_sized(_U16, _unpack_map),
+        0xdf: _unpack_sized(_U32, _unpack_map),
+        0xc5: _unpack_table,
+    }
+    del _unpack_sized, _unpack_fixed
+
+
+class CompactChain(Chain):
+    """ Chain for the compact binary wire codec """
+
+    def __init__(self, parseargs=None):
+        super().__init__()
+        self.append(CompactCodecLink())
+
+
+# Wire codecs a framed connection can agree on, most preferred first.
+# Both ends must produce and accept the same bytes for a given name.
+
+CODECS = OrderedDict((
+    ('compact', CompactChain),
+    ('json', LibrarianChain),
+))
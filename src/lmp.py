@@ -144,22 +144,15 @@ def show_global():
         b_size = cur.fetchone()[0]
         cur.execute('SELECT books_total FROM globals')
         m_total = cur.fetchone()[0] * b_size
+        # The librarian keeps these counts as books change state
         cur.execute('''
-            SELECT COUNT(*) FROM books
-            WHERE allocated=?''', TMBook.ALLOC_FREE)
-        m_free = cur.fetchone()[0] * b_size
-        cur.execute('''
-            SELECT COUNT(*) FROM books
-            WHERE allocated=?''', TMBook.ALLOC_INUSE)
-        m_inuse = cur.fetchone()[0] * b_size
-        cur.execute('''
-            SELECT COUNT(*) FROM books
-            WHERE allocated=?''', TMBook.ALLOC_ZOMBIE)
-        m_zombie = cur.fetchone()[0] * b_size
-        cur.execute('''
-            SELECT COUNT(*) FROM books
-            WHERE allocated=?''', TMBook.ALLOC_OFFLINE)
-        m_offline = cur.fetchone()[0] * b_size
+            SELECT allocated, TOTAL(books) FROM book_counts
+            GROUP BY allocated''')
+        books = dict(cur.fetchall())
+        m_free = int(books.get(TMBook.ALLOC_FREE, 0)) * b_size
+        m_inuse = int(books.get(TMBook.ALLOC_INUSE, 0)) * b_size
+        m_zombie = int(books.get(TMBook.ALLOC_ZOMBIE, 0)) * b_size
+        m_offline = int(books.get(TMBook.ALLOC_OFFLINE, 0)) * b_size
 
         d_memory = {
             'total': m_total,
@@ -173,26 +166,22 @@ def show_global():
 
         ts = int(time.time() - FRDnode.SOC_HEARTBEAT_SECS)
 
+        # The librarian writes all SOCs rows at once every few seconds.
+        # One statement reads one snapshot, so the counts always agree.
         cur.execute('''
-            SELECT COUNT(*) FROM SOCs
-            WHERE status=? and heartbeat>=?''',
-                    (FRDnode.SOC_STATUS_ACTIVE, ts))
-        s_active = cur.fetchone()[0]
-
-        cur.execute('''
-            SELECT COUNT(*) FROM SOCs
-            WHERE status=? AND heartbeat<?''',
-                    (FRDnode.SOC_STATUS_ACTIVE, ts))
-        s_indeterminate = cur.fetchone()[0]
-
-        cur.execute('''
-            SELECT COUNT(*) FROM SOCs
-            WHERE status=?''',
-                    FRDnode.SOC_STATUS_OFFLINE)
-        s_offline = cur.fetchone()[0]
-
-        cur.execute('SELECT AVG(cpu_percent) FROM SOCs')
-        s_cpu_percent = cur.fetchone()[0]
+            SELECT TOTAL(status=? AND heartbeat>=?),
+                   TOTAL(status=? AND heartbeat<?),
+                   TOTAL(status=?),
+                   AVG(cpu_percent)
+            FROM SOCs''',
+                    (FRDnode.SOC_STATUS_ACTIVE, ts,
+                     FRDnode.SOC_STATUS_ACTIVE, ts,
+                     FRDnode.SOC_STATUS_OFFLINE))
+        (s_active, s_indeterminate, s_offline,
+         s_cpu_percent) = cur.fetchone()
+        s_active = int(s_active)
+        s_indeterminate = int(s_indeterminate)
+        s_offline = int(s_offline)
 
         d_socs = {
             'total': s_total,
@@ -266,12 +255,16 @@ def show_nodes():
         cur.execute('SELECT * FROM FRDnodes')
         cur.iterclass = 'default'
         nodes = [ r for r in cur ]
+        # All SOCs in one read so every node comes from the same flush.
+        cur.execute('SELECT * FROM SOCs')
+        cur.iterclass = 'default'
+        socs = { }
+        for r in cur:
+            assert r.node_id not in socs, 'Only 1 SOC/node can be handled'
+            socs[r.node_id] = r
         for n in nodes:
-            cur.execute('SELECT * FROM SOCs WHERE node_id=?', n.node_id)
-            cur.iterclass = 'default'
-            socs = [ r for r in cur ]
-            assert len(socs) == 1, 'Only 1 SOC/node can be handled'
-            s = socs[0]
+            s = socs.get(n.node_id, None)
+            assert s is not None, 'Only 1 SOC/node can be handled'
             # Only partial coords are returned, it's up to the caller to
             # keep track of upstack.  Add the n.data to assist matryoshka
             # which for some reason (in 2019) is expecting full coord string.
@@ -0,0 +1,507 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Front end for a sharded Librarian.
+
+    Each shard is an ordinary librarian.py (--shard K/N) with its own
+    database, so each has its own SQLite writer.  The namespace is split
+    by top-level name: everything under /a lives on the shard that "a"
+    hashes to.  Book allocation is split by IG: shard K owns every Nth IG
+    and sees the others' books as OFFLINE.  Shelf ids are striped so an
+    id alone finds its shard.  Node status (heartbeats and the rest) is
+    shard 0's.
+
+    The router is a handler for Server.serv() like the engine.  Most
+    commands go to one shard as they are; a few are asked of every shard
+    and the replies merged.  Renaming a file between shards is two-phase
+    (see engine.cmd_prepare_move()); a directory can't change shards, so
+    that gets EXDEV and mv(1) copies instead.  A batch must stay on one
+    shard.  Moves a crash or a lost shard left half done are finished or
+    undone by recover(), before the first request is routed and again
+    after any move that couldn't be finished.
+
+    Set up: book_register.py as usual, then
+        shard_router.py --split N --db_file librarian.db
+    makes librarian-shard0.db ... for librarian.py --shard 0/N ... and
+        shard_router.py --shards host:port,... --port 9093
+    serves the whole thing.
+"""
+
+import argparse
+import errno
+import itertools
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from queue import Queue
+
+from pdb import set_trace
+
+from book_shelf_bos import TMBook
+from engine import LibrarianCommandEngine as LCE, LockTable
+from frdnode import BooksIGInterpretation as BII
+from socket_handling import Client, Demux, Server, lfsLogger
+
+_ZERO_PREFIX = '.lfs_pending_zero_'     # agree with engine.py
+
+# The other shelves every shard starts with, all at the root
+_RESERVED = { 1: 'garbage', 3: 'lost+found' }
+
+#--------------------------------------------------------------------------
+
+
+def shard_db_file(db_file, k):
+    root, ext = os.path.splitext(db_file)
+    return '%s-shard%d%s' % (root, k, ext)
+
+
+def ig_owner(intlv_group, nshards):
+    return (intlv_group & BII.VALUE_MASK) % nshards
+
+
+def split(db_file, nshards):
+    '''One copy of a new database per shard, each owning every nshards'th
+       IG.  Returns the file names.'''
+    src = sqlite3.connect(db_file)
+    nfiles = src.execute('SELECT COUNT(*) FROM shelves WHERE id > 3')
+    assert not nfiles.fetchone()[0], '%s is not empty' % db_file
+    db_files = [ ]
+    for k in range(nshards):
+        db_files.append(shard_db_file(db_file, k))
+        dst = sqlite3.connect(db_files[-1])
+        src.backup(dst)
+        dst.create_function(
+            'ig_owner', 1, lambda ig: ig_owner(ig, nshards))
+        dst.execute('''UPDATE books SET allocated=?
+                       WHERE allocated=? AND ig_owner(intlv_group) != ?''',
+                    (TMBook.ALLOC_OFFLINE, TMBook.ALLOC_FREE, k))
+        dst.commit()
+        dst.close()
+    src.close()
+    return db_files
+
+#--------------------------------------------------------------------------
+
+
+class ShardRouter(object):
+    '''shards[k] is anything with a Demux-style transact(cmdict) for shard
+       k.  Commands run on nthreads threads (via offload()), or on the
+       caller's if that's 0.'''
+
+    # Asked of every shard: the reply merge
+    _FAN_OUT = {
+        'get_book': '_merge_book',
+        'get_book_all': '_merge_books',
+        'get_book_ig': '_merge_books',
+        'get_book_info_all': '_merge_books',
+        'get_fs_stats': '_merge_stats',
+        'kill_zombie_books': '_merge_first',
+        'list_open_shelves': '_merge_lists',
+    }
+
+    def __init__(self, shards, nthreads=0):
+        self.shards = shards
+        self.locks = LockTable()
+        self.moves = dict(committed=0, failed=0, stranded=0, recovered=0)
+        self._seq = itertools.count(1)
+        self._txn = itertools.count(1)
+        self._mutex = threading.Lock()
+        self._live = set()          # txns of moves being made right now
+        self._unrecovered = True    # see recover()
+        self._recovery = threading.Lock()
+        self._queue = Queue()
+        self._threads = [ ]
+        for i in range(nthreads):
+            thread = threading.Thread(
+                target=self._run, name='router%d' % i, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            work = self._queue.get()
+            if work is None:
+                break
+            cmdict, done = work
+            done(*self(cmdict))
+
+    def offload(self, cmdict, done):
+        if not self._threads:
+            return False
+        self._queue.put((cmdict, done))
+        return True
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = [ ]
+
+    def __call__(self, cmdict):
+        '''Returns (reply, OOBmsg) like the engine.'''
+        try:
+            name = cmdict['command']
+            context = cmdict['context']
+        except (KeyError, TypeError) as e:
+            return { 'errmsg': 'router failed lookup on "%s"' % str(e),
+                     'errno': errno.ENOSYS,
+                     'context': cmdict.get('context', None) }, None
+        if name == 'send_OOB':  # to the router's clients, not the shards'
+            return { 'value': context['node_id'], 'context': context }, \
+                   { 'OOBmsg': cmdict['msg'] }
+        if self._unrecovered:
+            self.recover(context)
+
+        # Enough to keep anything that changes a shelf, or a directory's
+        # entries, out of the way of a move.  Reads might see a moving
+        # file on both shards, or on neither, for a moment.
+        try:
+            keys = () if name in LCE.READ_ONLY else LCE.lock_keys(cmdict)
+        except Exception as e:
+            keys = ()   # malformed: let the shard say what's wrong with it
+        with self.locks.held(keys):
+            return self._route(name, cmdict), None
+
+    def _route(self, name, cmdict):
+        nshards = len(self.shards)
+        if name in self._FAN_OUT:
+            # A stream is paged here, by this router's serv(): the shards
+            # just answer one page each.
+            request = dict(cmdict)
+            if request.pop('stream', False) and \
+               request.get('limit', None) is None:
+                request['limit'] = LCE.STREAM_CHUNK
+            replies = [ self._forward(k, request) for k in range(nshards) ]
+            failed = [ r for r in replies if 'errmsg' in r ]
+            if failed:
+                return failed[0]
+            value = getattr(self, self._FAN_OUT[name])(
+                [ r['value'] for r in replies ])
+            if request.get('limit', None) is None:
+                return { 'value': value, 'context': cmdict['context'] }
+            return self._page(value, request, replies)
+
+        if name == 'batch':
+            where = set(self._shard_of(c) for c in cmdict['commands'])
+            if len(where) != 1 or None in where:
+                return { 'errmsg': 'batch spans shards',
+                         'errno': errno.EXDEV,
+                         'context': cmdict['context'] }
+            return self._forward(where.pop(), cmdict)
+
+        if name == 'rename_shelf':
+            src = self._shard_of_path(cmdict['path'])
+            dst = self._shard_of_path(cmdict['newpath'])
+            if None not in (src, dst) and src != dst:
+                return self._move(cmdict, src, dst)
+
+        if name == 'list_shelves' and not LCE._path2list(cmdict['path']):
+            return self._list_root(cmdict)
+
+        k = self._shard_of(cmdict)
+        if k is not None:
+            return self._forward(k, cmdict)
+        for k in range(nshards):    # wherever it is
+            reply = self._forward(k, cmdict)
+            if reply.get('errno', None) != errno.ENOENT:
+                break
+        return reply
+
+    def _shard_of(self, cmdict):
+        '''None if it could be anywhere'''
+        if 'path' in cmdict:
+            return self._shard_of_path(cmdict['path'])
+        name = cmdict.get('command', None)
+        if name == 'close_shelf':
+            return int(cmdict['id']) % len(self.shards)
+        if name == 'get_shelf_path':
+            parent_id = int(cmdict['parent_id'])
+            if parent_id == 2:
+                return self._shard_of_path(cmdict['name'])
+            if parent_id in _RESERVED:
+                return self._shard_of_path(_RESERVED[parent_id])
+            return parent_id % len(self.shards)
+        return 0
+
+    def _shard_of_path(self, path):
+        names = LCE._path2list(path)
+        if not names:
+            return 0
+        top = names[0]
+        if top.startswith(_ZERO_PREFIX):
+            # lfs_fuse names these after the shelf id (see unlink()), and
+            # the engine's from resize_shelf() could be anywhere.
+            try:
+                return int(top[len(_ZERO_PREFIX):]) % len(self.shards)
+            except ValueError as e:
+                return None
+        return zlib.crc32(top.encode()) % len(self.shards)
+
+    def _forward(self, k, cmdict):
+        '''The request with a seq of the router's, the reply with the
+           caller's context back in it.'''
+        request = dict(cmdict)
+        request['context'] = dict(cmdict['context'], seq=next(self._seq))
+        try:
+            reply = self.shards[k].transact(request)
+        except Exception as e:
+            logging.error('shard %d: %s' % (k, str(e)))
+            reply = { 'errmsg': 'shard %d: %s' % (k, str(e)),
+                      'errno': errno.EREMOTEIO }
+        reply['context'] = cmdict['context']
+        return reply
+
+    def _move(self, cmdict, src, dst):
+        '''Both paths, and the shelf id, stay locked throughout.  Each
+           shard records its half of the move as it prepares and finishes,
+           and the destination keeps its record until the source is done,
+           so recover() can always tell which way to go.  Once the
+           destination has committed, the rename has happened: a source
+           that can't finish now is finished by recover() later.'''
+        txn = '%x.%d.%d' % (int(time.time()), os.getpid(), next(self._txn))
+
+        def ask(k, command, **parms):
+            parms.update(command=command, context=cmdict['context'])
+            return self._forward(k, parms)
+
+        with self._mutex:
+            self._live.add(txn)
+        try:
+            out = ask(src, 'prepare_move',
+                      path=cmdict['path'], txn=txn, record=None)
+            if 'errmsg' in out:
+                into = out
+            else:
+                into = ask(dst, 'prepare_move', path=cmdict['newpath'],
+                           txn=txn, record=out['value'])
+                prepared = 'errmsg' not in into
+                if prepared:
+                    into = ask(dst, 'finish_move', txn=txn, commit=True)
+                if 'errmsg' in into:
+                    undone = [ ask(k, 'finish_move', txn=txn, commit=False)
+                               for k in ((dst, src) if prepared else (src, )) ]
+                    if any('errmsg' in r for r in undone):
+                        with self._mutex:
+                            self._unrecovered = True
+            if 'errmsg' in into:
+                with self._mutex:
+                    self.moves['failed'] += 1
+                return into
+
+            gone = ask(src, 'finish_move', txn=txn, commit=True)
+            if 'errmsg' not in gone:
+                ask(dst, 'finish_move', txn=txn, commit=True)   # forget
+            with self._mutex:
+                if 'errmsg' in gone:
+                    self.moves['stranded'] += 1
+                    self._unrecovered = True
+                    logging.critical(
+                        'move %s: %s is still on shard %d until recovery: '
+                        '%s' % (txn, cmdict['path'], src, gone['errmsg']))
+                else:
+                    self.moves['committed'] += 1
+            return into
+        finally:
+            with self._mutex:
+                self._live.discard(txn)
+
+    def recover(self, context):
+        '''Finish every move the destination committed and undo the rest,
+           from what the shards recorded, except those in progress here.
+           Returns True if nothing is left to do.'''
+        with self._recovery:
+            with self._mutex:
+                self._unrecovered = False
+                live = set(self._live)
+            halves = { }    # txn: { direction: (shard, state) }
+            for k in range(len(self.shards)):
+                reply = self._forward(
+                    k, { 'command': 'list_moves', 'context': context })
+                if 'errmsg' in reply:
+                    logging.error('shard %d: no moves to recover: %s' %
+                                  (k, reply['errmsg']))
+                    with self._mutex:
+                        self._unrecovered = True
+                    return False
+                for move in reply['value']:
+                    if move['txn'] not in live:
+                        halves.setdefault(move['txn'], { })[
+                            move['direction']] = (k, move['state'])
+            done = True
+            for txn in sorted(halves):
+                half = halves[txn]
+                commit = half.get('in', (None, None))[1] == 'committed'
+                for direction in ('out', 'in'):     # source first
+                    if direction not in half:
+                        continue
+                    k = half[direction][0]
+                    reply = self._forward(k, {
+                        'command': 'finish_move', 'txn': txn,
+                        'commit': commit, 'context': context })
+                    if 'errmsg' in reply:
+                        logging.error('move %s on shard %d: %s' %
+                                      (txn, k, reply['errmsg']))
+                        done = False
+                        break
+                logging.warning('move %s: %s' %
+                                (txn, 'finished' if commit else 'undone'))
+                with self._mutex:
+                    self.moves['recovered'] += 1
+            if not done:
+                with self._mutex:
+                    self._unrecovered = True
+            return done
+
+    def _list_root(self, cmdict):
+        '''Every shard's root entries, . and .. from the first'''
+        value = [ ]
+        seen = set()
+        for k in range(len(self.shards)):
+            reply = self._forward(k, cmdict)
+            if 'errmsg' in reply:
+                return reply
+            entries = reply['value']
+            if not value:
+                value = entries[:2]
+            for entry in entries[2:]:
+                if entry['name'] not in seen:
+                    seen.add(entry['name'])
+                    value.append(entry)
+        return { 'value': value, 'context': cmdict['context'] }
+
+    # Merges of the values from each shard, in shard order
+
+    @staticmethod
+    def _page(entries, request, replies):
+        '''The first "limit" of the merged pages is the true first page:
+           no shard left out anything with a smaller id.  Open handle ids
+           repeat across shards, so a page never ends inside a run of one
+           id or the next page (after_id) would skip the rest of it.'''
+        entries = sorted(entries, key=lambda e: e['id'])
+        n = request['limit']
+        while 0 < n < len(entries) and \
+                entries[n]['id'] == entries[n - 1]['id']:
+            n += 1
+        page = entries[:n]
+        return {
+            'value': page,
+            'after_id': page[-1]['id'] if page else request.get(
+                'after_id', None),
+            'more': n < len(entries) or any(
+                r.get('more', False) for r in replies),
+            'context': request['context'],
+        }
+
+    @staticmethod
+    def _merge_first(values):
+        return values[0]
+
+    @staticmethod
+    def _merge_lists(values):
+        return list(itertools.chain(*values))
+
+    @staticmethod
+    def _merge_books(values):
+        '''Each book once, as its owner sees it'''
+        books = { }
+        for book in itertools.chain(*values):
+            if book['id'] not in books or \
+               books[book['id']]['allocated'] == TMBook.ALLOC_OFFLINE:
+                books[book['id']] = book
+        return [ books[i] for i in sorted(books) ]
+
+    @staticmethod
+    def _merge_book(values):
+        for book in values:
+            if book and book['allocated'] != TMBook.ALLOC_OFFLINE:
+                return book
+        return values[0]
+
+    def _merge_stats(self, values):
+        stats = dict(values[0])
+        stats['books_used'] = sum(v['books_used'] for v in values)
+        stats['shards'] = values
+        with self._mutex:
+            stats['router'] = { 'locks': self.locks.stats,
+                                'moves': dict(self.moves) }
+        return stats
+
+#--------------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Route Librarian requests to its shards')
+    parser.add_argument(
+        '--verbose',
+        help='level of runtime output (0=ERROR, 1=PERF, 2=NOTICE, 3=INFO, 4=DEBUG, 5=OOB)',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--shards',
+        help='comma-separated host:port of each shard, shard 0 first',
+        type=str,
+        default='')
+    parser.add_argument(
+        '--threads',
+        help='requests in flight to the shards at once',
+        type=int,
+        default=16)
+    parser.add_argument(
+        '--split',
+        help='make this many shard databases from --db_file, then exit',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--db_file',
+        help='database from book_register.py, for --split',
+        type=str,
+        default='/var/hpetm/librarian.db')
+    Server.argparse_extend(parser)
+    parseargs = parser.parse_args()
+
+    if parseargs.split:
+        for db_file in split(parseargs.db_file, parseargs.split):
+            print(db_file)
+        raise SystemExit(0)
+
+    if not parseargs.shards:
+        raise SystemExit('No --shards')
+    lfsLogger('Librarian', parseargs.verbose)   # stderr
+    shards = [ ]
+    for hostport in parseargs.shards.split(','):
+        host, port = hostport.rsplit(':', 1)
+        client = Client(selectable=False)
+        client.connect(host=host, port=int(port))
+        shards.append(Demux(client))
+    router = ShardRouter(shards, parseargs.threads)
+    server = Server(parseargs)
+
+    try:
+        server.serv(router)
+    except Exception as e:
+        print(str(e))
+
+    router.close()
+
+if __name__ == '__main__':
+    main()
@@ -20,13 +20,20 @@ import errno
 import logging
 import logging.handlers
 import socket
-import select
+import selectors
+import struct
 import sys
+import threading
 import time
 
+from collections import deque, OrderedDict
+from itertools import islice
 from pdb import set_trace
 from json import dumps, loads, JSONDecoder
 
+from function_chain import BadChainForward, BadChainReverse
+from librarian_chain import CODECS
+
 ###########################################################################
 # Located here because we have no utils module, this is low-level to client
 # and server, and tying it directly to sockets might make sense.
@@ -107,7 +114,26 @@ class SocketReadWrite(object):
         base class for the Client and Server, or an instance for nodes.
         Logging is done against root logger.
     """
-    blocking_retry_max = 5
+
+    # Unsent bytes a non-blocking socket may hold before serv() stops
+    # reading its requests (HIWAT) until it drains below LOWAT.  Past MAX
+    # the far end is considered wedged and the connection is dropped.
+    BACKLOG_LOWAT = 1 << 20
+    BACKLOG_HIWAT = 8 << 20
+    BACKLOG_MAX = 256 << 20
+
+    # Framed mode, negotiated per connection (see Client.negotiate).  Each
+    # message is a fixed header then exactly "length" bytes of payload, so
+    # the receiver decodes every message once instead of rescanning a stream.
+    # The first header byte is zero for any sane length, which can never
+    # be mistaken for the '{' that starts a JSON stream.  The payload codec
+    # is a librarian_chain CODECS entry, also negotiated; JSON until then.
+    FRAMING_VERSION = 1
+    FRAME_CMD = 1
+    FRAME_REPLY = 2
+    FRAME_OOB = 3
+    _FRAME = struct.Struct('!IBxxxQ')    # length, type, seq
+    _FRAME_MAX = 1 << 30
 
     def __init__(self, **kwargs):
         self.verbose = kwargs.get('verbose', 0)
@@ -133,10 +159,19 @@ class SocketReadWrite(object):
         else:  # A dead socket can't getpeername so cache it now
             self._host, self._port = peertuple
             self._str = '{0}:{1}'.format(*peertuple)
+        self.framed = False
+        self.negotiated = False     # has said something, framed or not
+        self.set_codec('json')
+        self._rbuf = bytearray(self._RBUF_MIN)
+        self._rview = memoryview(self._rbuf)
         self.clear()
         self.inOOB = []
-        self.outbytes = bytes()
-        self.blocking_retry = 0
+        self._outq = deque()        # memoryviews not yet on the wire
+        self.backlog = 0            # bytes in _outq
+        self.throttled = False      # serv() has stopped reading from it
+        self.oob_cursor = 0         # next OOBBroadcast number it needs
+        self.OOBcoalesced = 0       # duplicates not sent, or not kept
+        self.OOBdropped = 0         # fell out of the OOBBroadcast log
 
     def __str__(self):
         return self._str
@@ -163,14 +198,6 @@ class SocketReadWrite(object):
         '''Allows this object to be used in select'''
         return -1 if self._sock is None else self._sock.fileno()
 
-    def check_blocking_retry_max(self):
-        self.blocking_retry += 1
-        time.sleep(.2)
-        return (self.blocking_retry > self.blocking_retry_max)
-
-    def reset_blocking_retry(self):
-        self.blocking_retry = 0
-
     #----------------------------------------------------------------------
     # Send stuff
 
@@ -181,36 +208,51 @@ class SocketReadWrite(object):
             obj: the object to be sent, None means work off backlog
 
         Returns:
-               True or raised error.
+               True if it all went out, False if some is still queued
+               (only on a non-blocking socket), or raised error.
         """
 
         self.sent = 0
-        if JSON:
+        if JSON and self.framed:
+            outbufs = self._frame(obj)
+        elif JSON:
             # Error possible here: "not JSON serializable", let it raise
-            outbytes = dumps(obj).encode()
+            outbufs = (dumps(obj).encode(), )
         else:
-            outbytes = obj.encode()
+            outbufs = (obj.encode(), )
+        nbytes = sum(len(b) for b in outbufs)
         logging.info('%s: sending %s' % (self,
-                                         'NULL' if obj is None else '%d bytes' % len(outbytes)))
+                                         'NULL' if obj is None else '%d bytes' % nbytes))
 
         # socket.sendall will do so and return None on success.  If not,
         # an error is raised with no clue on byte count.  Do it myself.
-        self.outbytes += outbytes
+        # Whatever doesn't go now stays queued as memoryviews, so a
+        # partial send never copies the remainder.
+        for b in outbufs:
+            if b:
+                self._outq.append(memoryview(b))
+        self.backlog += nbytes
         try:
-            while len(self.outbytes):
+            while self._outq:
                 # This seems to throw errno 11 on its own, but just in case
                 # do it myself.  BTW, EAGAIN == EWOULDBLOCK
-                n = self._sock.send(self.outbytes)
+                n = self._sock.sendmsg(islice(self._outq, self._IOV_MAX))
                 if not n:
                     raise OSError(errno.EWOULDBLOCK, 'full')
                 self.sent += n
-                self.outbytes = self.outbytes[n:]
-            self.reset_blocking_retry()
+                self.backlog -= n
+                while n:
+                    head = self._outq[0]
+                    if len(head) > n:
+                        self._outq[0] = head[n:]
+                        break
+                    n -= len(head)
+                    self._outq.popleft()
             return True
         except BlockingIOError as e:
-            # Far side is full.  FIXME: raising OSError is a weak response
-            if self.check_blocking_retry_max():
-                raise OSError(errno.EWOULDBLOCK, 'blocking_retry_max')
+            # Far side is full.  The rest stays queued until the socket
+            # is writable again; the caller watches backlog for that.
+            return False
         except OSError as e:
             if e.errno == errno.EPIPE:
                 msg = 'closed by client'
@@ -228,6 +270,27 @@ class SocketReadWrite(object):
             raise
         return False
 
+    def _frame(self, obj):
+        '''Header and payload as separate buffers for sendmsg()'''
+        try:
+            payload = self.codec.forward_traverse(obj)
+        except BadChainForward as e:
+            raise TypeError('%s cannot encode %s' %
+                            (self.codec_name, type(obj).__name__))
+        mtype = self.FRAME_REPLY
+        seq = 0
+        if isinstance(obj, dict):
+            if 'OOBmsg' in obj:
+                mtype = self.FRAME_OOB
+            elif 'command' in obj:
+                mtype = self.FRAME_CMD
+            context = obj.get('context', None)
+            if isinstance(context, dict):
+                seq = context.get('seq', 0)
+                if not isinstance(seq, int) or seq < 0:
+                    seq = 0
+        return self._FRAME.pack(len(payload), mtype, seq), payload
+
     def send_result(self, result, JSON=True):
         try:
             self.last_errmsg = ''
@@ -243,6 +306,15 @@ class SocketReadWrite(object):
     _bufsz = 8192           # max recv.  FIXME: preallocate this?
     _bufhi = 2 * _bufsz     # Not sure I'll keep this
     _OOBlimit = 20          # when to dump a flood
+    _IOV_MAX = 1024         # Linux limit on sendmsg() buffers
+
+    # Framed mode receives into _rbuf with recv_into() and decodes straight
+    # out of it through _rview, so bytes are copied in from the kernel once
+    # no matter how TCP fragments them.  Consumed space is reclaimed by
+    # sliding the (partial) remainder down when the tail runs out of room.
+    # The buffer grows to the largest frame seen and drops back when idle.
+    _RBUF_MIN = _bufhi
+    _RBUF_IDLE_MAX = 1 << 20
 
     def recv_all(self):
         """ Receive the next part of a message and decode it to a
@@ -251,6 +323,9 @@ class SocketReadWrite(object):
         Returns:
         """
 
+        if self.framed:
+            return self._recv_frame()
+
         needmore = False  # Should be entered with an empty buffer
         while True:
             if self.inOOB:  # make caller deal with OOB first
@@ -316,7 +391,7 @@ class SocketReadWrite(object):
                         continue
                     OOBmsg = result.get('OOBmsg', False)
                     if OOBmsg:  # and that's the whole result
-                        self.inOOB.append(OOBmsg)
+                        self._addOOB(OOBmsg)
                         continue
                     return result
                 except ValueError as e:
@@ -365,8 +440,131 @@ class SocketReadWrite(object):
                 raise RuntimeError(
                     'Unexpectedly reached end of JSON parsing loop')
 
+    def _recv_frame(self):
+        '''recv_all() for framed mode.  Returns None (instead of blocking)
+           on a partial frame from a non-blocking socket.'''
+        hdrsz = self._FRAME.size
+        while True:
+            if self.inOOB:  # make caller deal with OOB first
+                return None
+            needed = hdrsz
+            while self._rtail - self._rhead >= hdrsz:
+                length, mtype, seq = self._FRAME.unpack_from(
+                    self._rbuf, self._rhead)
+                start = self._rhead + hdrsz
+                end = start + length
+                if length > self._FRAME_MAX:
+                    self._bad_frame('bad frame length %d' % length)
+                if end > self._rtail:
+                    needed = end - self._rtail
+                    break
+                try:
+                    result = self.codec.reverse_traverse(
+                        self._rview[start:end])
+                except BadChainReverse as e:
+                    self._bad_frame('undecodable %s frame' % self.codec_name)
+                self._rhead = end
+                if self._rhead == self._rtail:
+                    self._rempty()
+                if mtype == self.FRAME_OOB:
+                    self._addOOB(result['OOBmsg'])
+                    continue
+                return result
+
+            self._rreserve(needed)
+            try:
+                n = self._sock.recv_into(self._rview[self._rtail:])
+            except BlockingIOError as e:
+                return None     # back to select for the rest
+            except AttributeError as e:
+                raise OSError(errno.ECONNABORTED, str(self))
+            logging.info('%s: recvd %d bytes' % (self._str, n))
+            if not n:
+                msg = '%s: closed by remote' % str(self)
+                self.close()
+                raise OSError(errno.ECONNABORTED, msg)
+            self._rtail += n
+
+    def _addOOB(self, OOBmsg):
+        '''The caller only needs to hear about each thing once'''
+        if OOBmsg in self.inOOB:
+            self.OOBcoalesced += 1
+        else:
+            self.inOOB.append(OOBmsg)
+
+    def _bad_frame(self, why):
+        msg = '%s: %s' % (self, why)
+        self.close()
+        raise OSError(errno.ECONNABORTED, msg)
+
+    def _rempty(self):
+        '''Everything received has been consumed'''
+        self._rhead = self._rtail = 0
+        if len(self._rbuf) > self._RBUF_IDLE_MAX:
+            self._rresize(self._RBUF_MIN)
+
+    def _rresize(self, size):
+        live = self._rtail - self._rhead
+        rbuf = bytearray(size)
+        rbuf[:live] = self._rview[self._rhead:self._rtail]
+        self._rview.release()
+        self._rbuf = rbuf
+        self._rview = memoryview(rbuf)
+        self._rhead, self._rtail = 0, live
+
+    def _rreserve(self, needed):
+        '''At least "needed" (and hopefully _bufsz) free bytes at the tail'''
+        room = len(self._rbuf) - self._rtail
+        if room >= max(needed, self._bufsz):
+            return
+        live = self._rtail - self._rhead
+        if live + max(needed, self._bufsz) > len(self._rbuf):
+            size = len(self._rbuf)
+            while size < live + needed:
+                size *= 2
+            if size > len(self._rbuf):
+                self._rresize(size)
+                return
+        if self._rhead:     # memmove the partial frame to the front
+            self._rview[:live] = self._rview[self._rhead:self._rtail]
+            self._rhead, self._rtail = 0, live
+
+    def set_codec(self, name):
+        self.codec_name = name
+        self.codec = CODECS[name]()
+
+    def accept_framing(self, request):
+        '''Server side of Client.negotiate().  The answer is the first
+           framed message (always JSON), or plain JSON turning the offer
+           down.  The first codec offered that is known here takes over
+           after that.'''
+        self.framed = request.get('framing', 0) == self.FRAMING_VERSION
+        if not self.framed:
+            return self.send_result({ 'framing': 0 })
+        codec = 'json'
+        for name in request.get('codecs', ( )):
+            if name in CODECS:
+                codec = name
+                break
+        ok = self.send_result(
+            { 'framing': self.FRAMING_VERSION, 'codec': codec })
+        self.set_codec(codec)
+        return ok
+
+    @property
+    def ready(self):
+        '''A whole message is already buffered, so recv_all() will not
+           touch the socket.  select() can't know about it.'''
+        if not self.framed:
+            return bool(self.instr)
+        if self._rtail - self._rhead < self._FRAME.size:
+            return False
+        length = self._FRAME.unpack_from(self._rbuf, self._rhead)[0]
+        return self._rhead + self._FRAME.size + length <= self._rtail
+
     def clear(self):
         self.instr = ''
+        self._rhead = self._rtail = 0
 
     def clearOOB(self):
         self.inOOB = []
@@ -378,7 +576,8 @@ class Client(SocketReadWrite):
     def __init__(self, **kwargs):
         super(self.__class__, self).__init__(**kwargs)
 
-    def connect(self, host='localhost', port=9093, retry=True, reconnect=False):
+    def connect(self, host='localhost', port=9093, retry=True, reconnect=False,
+                framing=True, codecs=None):
         """ Connect socket to port on host
 
         Args:
@@ -386,6 +585,9 @@ class Client(SocketReadWrite):
             port: the port to connect to
             retry: enter an infinite loop (cuz why not)
             reconnect: assumes an existing connection was broken
+            framing: try to negotiate framed mode
+            codecs: wire codecs to offer in framed mode, best first;
+                    default is every one in librarian_chain.CODECS
 
         Returns:
             True if it worked, False otherwise
@@ -420,8 +622,251 @@ class Client(SocketReadWrite):
 
         self._host, self._port = peertuple
         self._str = '{0}:{1}'.format(*peertuple)
+        if framing:
+            self.negotiate(codecs)
         return True
 
+    def negotiate(self, codecs=None):
+        """ Offer framed mode.  A server that knows about it answers with
+        a frame; an older one hands it to the engine, which answers in JSON
+        (ENOSYS) and the connection stays a JSON stream.  The answer names
+        the codec for every frame after it, JSON if it says nothing.
+
+        Args:
+            codecs: names from librarian_chain.CODECS, best first
+
+        Returns:
+            True if the connection is now framed.
+        """
+        if codecs is None:
+            codecs = list(CODECS.keys())
+        self.send_all({ 'command': 'framing',
+                        'framing': self.FRAMING_VERSION,
+                        'codecs': codecs })
+        n = self._sock.recv_into(self._rview)
+        if not n:
+            msg = '%s: closed by remote' % str(self)
+            self.close()
+            raise OSError(errno.ECONNABORTED, msg)
+        if self._rbuf[0] == ord('{'):
+            self.instr += str(self._rview[:n], 'utf-8')
+        else:
+            self.framed = True
+            self._rtail = n
+        stash = self.inOOB  # an old server may slip in some OOB first
+        self.inOOB = []
+        rsp = None
+        while rsp is None:
+            rsp = self.recv_all()
+            stash += self.inOOB
+            self.inOOB = []
+        self.inOOB = stash
+        assert not self.framed or \
+            rsp.get('framing', 0) == self.FRAMING_VERSION, \
+            'Framing negotiation botched'
+        if self.framed:
+            self.set_codec(rsp.get('codec', 'json'))
+        logging.info('%s: %s mode' % (self,
+            'framed %s' % self.codec_name if self.framed else 'JSON'))
+        return self.framed
+
+
+class Demux(object):
+    """ Several threads sharing one blocking Client, each with its own
+        request in flight.  Replies are matched to requests by context seq,
+        so the server may answer them in any order.  Whichever waiter finds
+        nobody else reading does the recv_all() and hands out what arrives;
+        the rest sleep on the condition.  No extra thread is needed.
+    """
+
+    def __init__(self, client, OOBhandler=None):
+        self.client = client
+        self.OOBhandler = OOBhandler    # called by the reader of the moment
+        self.generation = 0             # bumped by every reconnect
+        self._cond = threading.Condition()
+        self._sendlock = threading.Lock()
+        self._waiting = OrderedDict()   # seq: reply, None until it arrives
+        self._streams = { }             # seq: deque of replies not yet taken
+        self._reading = False
+
+    def transact(self, cmdict):
+        """ Send a request and wait for the reply carrying its seq
+
+        Args:
+            cmdict: request with a context seq unique among those in flight
+
+        Returns:
+            The reply, or raised error which goes to everyone in flight.
+        """
+        seq = cmdict['context']['seq']
+        with self._cond:
+            assert seq not in self._waiting, 'seq %s already in flight' % seq
+            self._waiting[seq] = None
+        try:
+            with self._sendlock:
+                self.client.send_all(cmdict)
+        except Exception as e:
+            with self._cond:
+                del self._waiting[seq]
+            # Wake up a reader that might be sitting on a dead connection.
+            self.client.close()
+            raise
+        with self._cond:
+            while self._waiting[seq] is None:
+                if self._reading:
+                    self._cond.wait()
+                else:
+                    self._read()
+            rsp = self._waiting.pop(seq)
+        if isinstance(rsp, Exception):
+            raise rsp
+        return rsp
+
+    def stream(self, cmdict):
+        """ Send a request with "stream" set and yield the entries of every
+            page of its reply as they arrive.
+
+        Args:
+            cmdict: request with a context seq unique among those in flight
+
+        Returns:
+            Generator of reply "value" entries.  An errmsg reply, or a
+            connection error, is raised from it as RuntimeError/the error.
+        """
+        seq = cmdict['context']['seq']
+        with self._cond:
+            assert seq not in self._waiting and seq not in self._streams, \
+                'seq %s already in flight' % seq
+            self._streams[seq] = deque()
+        try:
+            try:
+                with self._sendlock:
+                    self.client.send_all(cmdict)
+            except Exception as e:
+                self.client.close()
+                raise
+            more = True
+            while more:
+                with self._cond:
+                    while not self._streams[seq]:
+                        if self._reading:
+                            self._cond.wait()
+                        else:
+                            self._read()
+                    rsp = self._streams[seq].popleft()
+                if isinstance(rsp, Exception):
+                    raise rsp
+                if 'errmsg' in rsp:
+                    raise RuntimeError(rsp['errmsg'])
+                more = rsp.get('more', False)
+                for entry in rsp['value']:
+                    yield entry
+        finally:
+            with self._cond:
+                del self._streams[seq]
+
+    def _read(self):
+        '''Called and returns with _cond held, but not across recv_all()'''
+        self._reading = True
+        self._cond.release()
+        rsp = error = None
+        try:
+            rsp = self.client.recv_all()
+            if self.client.inOOB:   # recv_all() holds off until it's gone
+                if self.OOBhandler is not None:
+                    self.OOBhandler()
+                self.client.clearOOB()
+        except Exception as e:
+            error = e
+        finally:
+            self._cond.acquire()
+            self._reading = False
+        if error is not None:
+            for seq in self._waiting:
+                if self._waiting[seq] is None:
+                    self._waiting[seq] = error
+            for replies in self._streams.values():
+                replies.append(error)
+        elif rsp is not None:
+            self._deliver(rsp)
+        self._cond.notify_all()
+
+    def _deliver(self, rsp):
+        try:
+            seq = rsp['context']['seq']
+        except (KeyError, TypeError) as e:
+            # A reply without context (from a server error path) can only
+            # be matched the old way: the oldest request.
+            seq = next((s for s, r in self._waiting.items() if r is None),
+                       None)
+        if seq in self._streams:
+            self._streams[seq].append(rsp)
+            return
+        if self._waiting.get(seq, False) is not None:
+            logging.error('%s: dropped reply for seq %s' % (self.client, seq))
+            return
+        self._waiting[seq] = rsp
+
+    def reconnect(self, generation):
+        '''Once per broken connection no matter how many requests notice.
+           Returns True if the connection (possibly a new one) is usable.'''
+        with self._sendlock, self._cond:
+            while self._reading:
+                self._cond.wait()
+            if generation != self.generation:
+                return True
+            self.generation += 1
+            return self.client.connect(reconnect=True)
+
+
+class OOBBroadcast(object):
+    """ Out-of-band messages on their way to every client but the one
+        whose command raised them.  post() only logs the message; serv()
+        calls catch_up() for a few clients per pass, and only for clients
+        with nothing else queued, so one OOB never costs a pass of sends
+        over every socket.  Each client keeps a cursor into the log and
+        gets whatever piled up since, each distinct message once.
+    """
+
+    LOG_MAX = 1024      # a client further behind than this loses some
+    CHUNK = 64          # clients caught up per serv() pass
+
+    def __init__(self):
+        self.log = deque(maxlen=self.LOG_MAX)  # (number, sender, OOBmsg)
+        self.next = 0                           # number of the next post
+        self.due = deque()                      # clients maybe behind
+
+    def post(self, sender, OOBmsg, clients):
+        self.log.append((self.next, sender, OOBmsg))
+        self.next += 1
+        self.due = deque(clients)
+
+    def backlog(self, client):
+        '''OOB messages not yet queued for client'''
+        return self.next - client.oob_cursor
+
+    def catch_up(self, client):
+        '''Queue what client hasn't had.  Returns the number of messages.'''
+        first = self.log[0][0] if self.log else self.next
+        if client.oob_cursor < first:
+            client.OOBdropped += first - client.oob_cursor
+            logging.warning('%s: missed %d OOB messages' %
+                            (client, first - client.oob_cursor))
+            client.oob_cursor = first
+        unsent = OrderedDict()
+        nmsgs = 0
+        for number, sender, OOBmsg in islice(
+                self.log, client.oob_cursor - first, None):
+            if sender is not client:
+                unsent[dumps(OOBmsg, sort_keys=True)] = OOBmsg
+                nmsgs += 1
+        client.oob_cursor = self.next
+        client.OOBcoalesced += nmsgs - len(unsent)
+        for OOBmsg in unsent.values():
+            if not client.send_result(OOBmsg) and client.last_errmsg:
+                break
+        return len(unsent)
+
 
 class Server(SocketReadWrite):
     """ A simple asynchronous server for the Librarian """
@@ -469,11 +914,48 @@ class Server(SocketReadWrite):
     # returns.  The Python socket module still has the old fd, so on the
     # first EBADF, "socketmodule" first puts -1 in the internal Python
     # fd which will force EBADF.  Finally it closes the real socket fd.
-    # Hence the explicit searches for fileno == -1 below.
+    # The selector remembers each registration by object, not just by fd,
+    # so a client whose fileno() has already gone to -1 can still be
+    # unregistered.  A hangup comes back as a read event; recv_all() then
+    # gets zero bytes and raises, and the client is dropped right there.
 
     def serv(self, handler):
         """ "event-loop" for the server this is where the server starts
-        listening and serving requests.
+        listening and serving requests.  Every socket is registered once
+        with the selector (epoll on Linux) so a wakeup costs the number of
+        ready sockets, not the number of connected ones.
+
+        A client may pipeline requests.  Each pass takes one request from
+        every client that has one, so a deep pipeline can't starve anyone;
+        the rest wait in the receive buffer.  Every reply carries the seq
+        from its request's context and clients must match on that: replies
+        on one connection are NOT promised to come back in request order.
+
+        Nothing here ever blocks on a slow client.  What it won't take now
+        stays on its queue and goes out when select() says it's writable.
+        A client that lets its replies pile up past BACKLOG_HIWAT gets no
+        more requests read until it catches up, and past BACKLOG_MAX it's
+        dropped.  OOB messages wait in an OOBBroadcast until a client has
+        nothing else queued.
+
+        With a group commit window (see flush) a command's work can still
+        be uncommitted when the handler returns.  If the handler has
+        commit_token() and committed(token) methods, the reply is held
+        until the commit that covers it, and so is every reply behind it,
+        so nobody hears about work a crash could still lose.  Work that
+        gets rolled back instead is answered with EIO.
+
+        If the handler has an offload(cmdict, done) method it may take a
+        command to run elsewhere.  done(result, OOBmsg) can then be called
+        from any thread; the reply goes out from here on the next pass.
+        Offloaded requests in flight together may run in any order, so a
+        client that needs one done before the next must await its reply.
+
+        A request with "stream" set whose reply says there's "more" is
+        run again for the next page (the reply's "after_id") once its
+        client's backlog is under BACKLOG_LOWAT, one page per stream per
+        pass.  So a whole table goes out a page at a time, as fast as the
+        client takes it, and everyone else gets served in between.
 
         Args:
             handler: commands received by the server are sent here
@@ -481,41 +963,199 @@ class Server(SocketReadWrite):
             Nothing.
         """
 
+        sel = selectors.DefaultSelector()
+        sel.register(self, selectors.EVENT_READ)
         clients = []
         XLO = 50
         XHI = 2000
         xlimit = XLO
         transactions = 0
         t0 = time.time()
-        to_write = []
+        flush = getattr(handler, 'flush', None)  # group commit, if any
+        commit_token = getattr(handler, 'commit_token', None)
+        wait = None
+        held = deque()  # (token, client, cmdict, result, OOBmsg) to commit
+        pending = []    # clients with a whole request already buffered
+        broadcast = OOBBroadcast()
+        offload = getattr(handler, 'offload', None)
+        finished = deque()  # (client, cmdict, result, OOBmsg) from offload
+        streams = deque()   # (client, cmdict for its next page)
+        wakeup, waker = socket.socketpair()
+        waker.setblocking(False)
+        wakeup.setblocking(False)
+        sel.register(wakeup, selectors.EVENT_READ)
+
+        def interest(sock):
+            '''Write interest only while there is a backlog, read interest
+               only while it's not too big.  False if sock got dropped.'''
+            if sock.backlog > sock.BACKLOG_MAX:
+                logging.error('%s: %d bytes unsent, dropping' %
+                              (sock, sock.backlog))
+                drop(sock)
+                return False
+            if sock.throttled:
+                if sock.backlog <= sock.BACKLOG_LOWAT:
+                    sock.throttled = False
+                    if sock.ready:
+                        pending.append(sock)
+            elif sock.backlog >= sock.BACKLOG_HIWAT:
+                logging.warning('%s: %d bytes unsent, holding requests' %
+                                (sock, sock.backlog))
+                sock.throttled = True
+            events = 0 if sock.throttled else selectors.EVENT_READ
+            if sock.backlog:
+                events |= selectors.EVENT_WRITE
+            elif broadcast.backlog(sock):
+                broadcast.due.append(sock)
+            if sel.get_key(sock).events != events:
+                sel.modify(sock, events)
+            return True
+
+        def drop(sock):
+            if sock not in clients:     # already gone this pass
+                return
+            clients.remove(sock)
+            sel.unregister(sock)
+            sock.close()
+
+        def reply(sock, cmdict, result, OOBmsg):
+            # A holdoff (False, no errmsg) is just a backlog for later.
+            if not sock.send_result(result) and sock.last_errmsg:
+                if not sock.sent:  # nothing queued, nothing sent: error
+                    sock.send_result(
+                        { 'errmsg': sock.last_errmsg,
+                          'errno': errno.EPROTO,
+                          'context': cmdict.get('context', None) }
+                    )
+            interest(sock)
+
+            if OOBmsg:
+                logging.debug('OOB: %s' % OOBmsg['OOBmsg'])
+                broadcast.post(sock, OOBmsg, clients)
+
+            if cmdict.get('stream', False) and isinstance(result, dict) \
+               and result.get('more', False):
+                follow = dict(cmdict)
+                follow['after_id'] = result['after_id']
+                streams.append((sock, follow))
+
+        def dispatch(sock, cmdict):
+            if offload is not None and \
+               offload(cmdict, offloaded(sock, cmdict)):
+                return
+            result, OOBmsg = handler(cmdict)
+            token = None if commit_token is None else commit_token()
+            if token is None and not held:
+                reply(sock, cmdict, result, OOBmsg)
+                return
+            held.append((token, sock, cmdict, result, OOBmsg))
+            release()
+
+        def release():
+            '''Replies whose work is committed go out, in order.'''
+            while held:
+                token, sock, cmdict, result, OOBmsg = held[0]
+                if token is not None:
+                    committed = handler.committed(token)
+                    if committed is None:
+                        return
+                    if not committed:
+                        result = { 'errmsg': 'not committed',
+                                   'errno': errno.EIO,
+                                   'context': cmdict.get('context', None) }
+                        OOBmsg = None
+                held.popleft()
+                if sock in clients:     # not dropped while it waited
+                    reply(sock, cmdict, result, OOBmsg)
+
+        def offloaded(sock, cmdict):
+            def done(result, OOBmsg):
+                finished.append((sock, cmdict, result, OOBmsg))
+                try:
+                    waker.send(b'.')
+                except BlockingIOError:
+                    pass        # plenty of wakeups already on the way
+            return done
 
         while True:
 
             logging.info('Waiting for request...')
+            if flush is not None:
+                wait = flush()
+                release()
+            if pending or broadcast.due or any(
+                    c.backlog <= c.BACKLOG_LOWAT for c, _ in streams):
+                wait = 0
             try:
-                readable, writeable, _ = select.select(
-                    [ self ] + clients, to_write, [], 5.0)
+                ready = sel.select(5.0 if wait is None else wait)
             except Exception as e:
-                # Usually ValueError on a negative fd from a remote close
                 assert self.fileno() != -1, 'Server socket has died'
-                dead = [sock for sock in clients if sock.fileno() == -1]
-                for d in dead:
-                    if d in clients:  # avoid error
-                        clients.remove(d)
+                logging.error('select failed: %s' % str(e))
                 continue
 
-            if not readable and not writeable:  # timeout: reset counters
+            # Wakeups first so one that comes in after this can't be lost
+            if any(key.fileobj is wakeup for key, _ in ready):
+                try:
+                    while wakeup.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            while finished:
+                s, cmdict, result, OOBmsg = finished.popleft()
+                if s in clients:    # not dropped while it was away
+                    reply(s, cmdict, result, OOBmsg)
+
+            for _ in range(len(streams)):
+                s, cmdict = streams.popleft()
+                if s not in clients:
+                    continue
+                if s.backlog > s.BACKLOG_LOWAT:     # still on the last one
+                    streams.append((s, cmdict))
+                    continue
+                dispatch(s, cmdict)
+
+            for _ in range(min(len(broadcast.due), broadcast.CHUNK)):
+                c = broadcast.due.popleft()
+                # Closed, mid-negotiation or busy: it'll come around again
+                if c.fileno() == -1 or not c.negotiated or c.backlog:
+                    continue
+                if broadcast.catch_up(c) and c.last_errmsg:
+                    drop(c)
+                else:
+                    interest(c)
+
+            if not ready and not pending:  # timeout: reset counters
+                if wait is not None:    # just the group commit window
+                    continue
                 transactions = 0
                 t0 = time.time()
                 xlimit = XLO
                 continue
 
-            # Something remains in the outbytes buffer, give it another shot
-            for w in writeable:
-                if w.send_result('', JSON=False):
-                    to_write.remove(w)
+            # Something remains in the send queue, give it another shot
+            readable = []
+            for key, events in ready:
+                w = key.fileobj
+                if w is wakeup:
+                    continue
+                if events & selectors.EVENT_READ:
+                    readable.append(w)
+                if not events & selectors.EVENT_WRITE or w is self:
+                    continue
+                if w.send_result('', JSON=False) or not w.last_errmsg:
+                    interest(w)
+                else:                   # not a holdoff, it's gone
+                    drop(w)
+                    if w in readable:
+                        readable.remove(w)
+            for s in pending:
+                if s not in readable and s in clients:
+                    readable.append(s)
+            pending = []
 
             for s in readable:
+                if s.throttled:     # since select() or pending
+                    continue
                 transactions += 1
 
                 if transactions > xlimit:
@@ -536,6 +1176,8 @@ class Server(SocketReadWrite):
                             sock=sock,
                             peertuple=peertuple,
                             verbose=self.verbose)
+                        sel.register(newsock, selectors.EVENT_READ)
+                        newsock.oob_cursor = broadcast.next
                         clients.append(newsock)
                         logging.info('%s: new connection' % newsock)
                     except Exception as e:
@@ -547,6 +1189,13 @@ class Server(SocketReadWrite):
                     cmdict = s.recv_all()
                     if cmdict is None:  # need more, not available now
                         continue
+                    s.negotiated = True
+                    if cmdict['command'] == 'framing':
+                        s.accept_framing(cmdict)
+                        interest(s)     # OOB held during negotiation
+                        continue
+                    if s.ready:
+                        pending.append(s)
 
                     if self.verbose == 1:
                         logging.critical('%s: %s' % (s, cmdict['command']))
@@ -578,9 +1227,7 @@ class Server(SocketReadWrite):
                                 print('Unhandled OSError during response')
                                 set_trace()
                             continue    # Don't yet have a reason to kill it
-                    clients.remove(s)
-                    if s in to_write:
-                        to_write.remove(s)
+                    drop(s)
                     continue
                 except Exception as e:  # Shouldn't happen
                     msg = 'UNEXPECTED SOCKET ERROR: %s' % str(e)
@@ -591,33 +1238,13 @@ class Server(SocketReadWrite):
                     raise
 
                 try:    # process the next command
-                    result, OOBmsg = handler(cmdict)
+                    dispatch(s, cmdict)
                 except Exception as e:  # Shouldn't happen
                     set_trace()
                     msg = 'UNEXPECTED HANDLER ERROR: %s' % str(e)
                     logging.error('%s: %s' % (s, msg))
                     raise
 
-                # NO "finally": it circumvents "continue" in error clause(s)
-                if not s.send_result(result):   # holdoff or error?
-                    if s.outbytes:  # conversion was ok
-                        to_write.append(s)
-                    else:
-                        if not s.sent:  # nothing queued, nothing sent: error
-                            s.send_result(
-                                { 'errmsg': s.last_errmsg,
-                                  'errno': errno.EPROTO }
-                            )
-                            pass
-                    continue  # no need to check OOB for now
-
-                if OOBmsg:
-                    logging.debug('-' * 20, 'OOB:', OOBmsg['OOBmsg'])
-                    for c in clients:
-                        if str(c) != str(s):
-                            logging.debug(str(c))
-                            c.send_result(OOBmsg)
-
 
 def main():
     """ Run simple echo server to exercise the module """
@@ -19,6 +19,7 @@
 import os
 import sys
 import getpass
+import time
 from datetime import date, datetime
 from decimal import Decimal
 from pdb import set_trace
@@ -112,6 +113,9 @@ class SQLassist(object):
                 kwargs[k] = self._defaults[k]
         for k, v in kwargs.items():
             setattr(self, k, v)
+        self._rows = iter(())       # current chunk of the current query
+        self._makers = {}           # (iterclass, column names): row maker
+        self.statement_stats = {}   # SQL text: [ executions, seconds ]
         self.DBconnect()            # In the derived class
         self._iterclass = None
 
@@ -153,16 +157,41 @@ class SQLassist(object):
         return self
 
     def __next__(self):
-        '''Fancier than fetchone/many'''
-        r = self._cursor.fetchone()
-        if not r:
+        '''Fancier than fetchone/many.  Rows come over in chunks and
+           each chunk is turned into iterclass objects by a maker built
+           once per query shape; don't mix this with fetchone().'''
+        for r in self._rows:
+            return r
+        rows = self._cursor.fetchmany(self._FETCH_CHUNK)
+        if not rows:
             self._iterclass = None  # yes, force problems "next time"
             raise StopIteration
         if self._iterclass is None:
-            return r
-        cur = self._cursor
-        asdict = dict(zip([f[0] for f in cur.description], r))
-        return self._iterclass(**asdict)
+            self._rows = iter(rows)
+        else:
+            self._rows = map(self._maker(), rows)
+        return next(self._rows)
+
+    _FETCH_CHUNK = 256
+
+    def _maker(self):
+        '''Callable turning one row of the current query into an
+           iterclass object.  Classes with a row_factory(names) classmethod
+           supply their own, else it's __init__(**kwargs) by column name.'''
+        cls = self._iterclass
+        names = tuple(f[0] for f in self._cursor.description)
+        try:
+            return self._makers[(cls, names)]
+        except KeyError:
+            pass
+        factory = getattr(cls, 'row_factory', None)
+        if factory is not None:
+            maker = factory(names)
+        else:
+            def maker(r):
+                return cls(**dict(zip(names, r)))
+        self._makers[(cls, names)] = maker
+        return maker
 
     # Act like a cursor, except for the commit() method, because a cursor
     # doesn't have one.   Don't invoke methods here; rather, return a
@@ -188,8 +217,12 @@ class SQLassist(object):
 
         # Wrap it to use the internal attrs in a callback, hidden from user.
         # This is where actual execute() occurs and errors can be trapped.
+        # Time is what execute() took, which for a SELECT is up to its
+        # first row; iterating the rest isn't counted.
         def exec_wrapper(query, parms=None):
             self.execfail = ''
+            self._rows = iter(())
+            t0 = time.perf_counter()
             try:
                 if parms is None:
                     self._cursor.execute(query)
@@ -202,5 +235,11 @@ class SQLassist(object):
                 self.execfail = str(e)
                 if self.raiseOnExecFail:
                     raise
+            finally:
+                stats = self.statement_stats.get(query)
+                if stats is None:
+                    stats = self.statement_stats[query] = [ 0, 0.0 ]
+                stats[0] += 1
+                stats[1] += time.perf_counter() - t0
             return
         return exec_wrapper
@@ -31,12 +31,14 @@
 # "HAS-A" relationship via self._cur.
 #---------------------------------------------------------------------------
 
+import json
 import stat
 import time
 
 from pdb import set_trace
 
 from book_shelf_bos import TMBook, TMShelf, TMBos, TMOpenedShelves
+from book_shelf_bos import BookColumns
 
 from frdnode import FRDnode, FRDFAModule, FRDintlv_group
 
@@ -45,10 +47,14 @@ from frdnode import FRDnode, FRDFAModule, FRDintlv_group
 
 class LibrarianDBackendSQL(object):
 
-    SCHEMA_VERSION = 'LIBRARIAN 0.997'
+    SCHEMA_VERSION = 'LIBRARIAN 1.000'
     # 0.995     Added heartbeat to SOC
     # 0.996     Added CPU and root FS percent to SOC; add link table
     # 0.997     Added network_in, network_out and mem_percent to SOC
+    # 0.998     Indexes for the per-command queries.  From here on
+    #           db_migrate.py upgrades an existing database.
+    # 0.999     book_counts, kept by triggers on books
+    # 1.000     moves, the intents of renames between shards
 
     @staticmethod
     def argparse_extend(parser):
@@ -77,6 +83,121 @@ class LibrarianDBackendSQL(object):
     def _getnextid(self, table):
         return self._cur.getnextid(table)
 
+    #
+    # Transactions.  Each engine command runs between begin_command() and
+    # end_command(), so it succeeds or fails as a unit no matter how many
+    # commit=True calls it makes.  Successful commands are committed after
+    # at most group_commit_secs, for fewer fsyncs.  Their replies wait for
+    # that commit (see commit_token()) so a crash can't lose anything a
+    # client has been told is done.
+    #
+
+    group_commit_secs = 0.0
+    _commit_due = None
+
+    # SoC heartbeats and telemetry arrive with every request.  They are
+    # kept in memory per node and written to the SOCs table together every
+    # SOC_FLUSH_SECS, well inside the FRDnode.SOC_HEARTBEAT_SECS that LMP
+    # allows before it calls a node indeterminate.
+
+    SOC_FLUSH_SECS = FRDnode.SOC_HEARTBEAT_SECS / 4
+    _soc_status = None
+    _soc_flush_due = 0
+
+    # Shard k of n (see shard_router.py) only hands out shelf ids that
+    # are k mod n, so an id alone says which shard a shelf lives on.
+
+    shard = (0, 1)
+
+    def begin_command(self):
+        self._cur.begin()
+
+    def hold_writes(self):
+        ''' From here to end_command(), be the database's only writer.
+            Only needed where the command reads something it then relies
+            on not changing, and only on a connection that doesn't already
+            start out that way.
+        '''
+        self._cur.hold_writes()
+
+    def end_command(self, ok=True):
+        ''' Finish the unit of work started by begin_command().
+            Input---
+              ok - False discards the command's changes
+            Output---
+              True if changes were discarded (caches may need a resync)
+        '''
+        undone = self._cur.end(ok)
+        if self._cur.batching:      # one command of a batch
+            return undone
+        if self._cur.pending and self._commit_due is None:
+            self._commit_due = time.time() + self.group_commit_secs
+        self.flush()
+        return undone
+
+    def flush(self, force=False):
+        ''' Commit the pending work if its group commit window has closed,
+            writing out SoC status first if that is due.
+            Input---
+              force - do it all now regardless of the timers
+            Output---
+              Seconds until flush() should be called again, or None if
+              nothing pends.
+        '''
+        now = time.time()
+        soc_remaining = None
+        if self._soc_status:
+            soc_remaining = self._soc_flush_due - now
+            if force or soc_remaining <= 0:
+                self._flush_soc_status()
+                self._soc_flush_due = now + self.SOC_FLUSH_SECS
+                soc_remaining = None
+                if self._commit_due is None:
+                    self._commit_due = now
+        if not self._cur.pending:
+            self._commit_due = None
+            return soc_remaining
+        remaining = self._commit_due - now if self._commit_due else 0
+        if force or remaining <= 0:
+            self._cur.commit()
+            self._commit_due = None
+            return soc_remaining
+        if soc_remaining is None:
+            return remaining
+        return min(remaining, soc_remaining)
+
+    def commit_token(self):
+        ''' Where the work done so far stands, for committed().
+            Input---
+              None
+            Output---
+              None if it's all committed already, else a token
+        '''
+        if not self._cur.pending:
+            return None
+        return (self._cur.commits, self._cur.aborts)
+
+    def committed(self, token):
+        ''' Has the work pending at commit_token() been committed?  Commits
+            only happen as a command ends or in flush(), after anything
+            that lost the transaction, so a loss since the token was taken
+            was this work's.
+            Input---
+              token - from commit_token()
+            Output---
+              True once committed, False if it was lost, None while pending
+        '''
+        commits, aborts = token
+        if self._cur.aborts != aborts:
+            return False
+        if self._cur.commits != commits:
+            return True
+        return None
+
+    def close(self):
+        self.flush(force=True)
+        self._cur.close()
+
     #
     # DB globals
     #
@@ -107,12 +228,28 @@ class LibrarianDBackendSQL(object):
         except Exception as e:
             raise RuntimeError(str(e))
 
-        self._cur.execute('SELECT COUNT() FROM books WHERE allocated > 0')
-        r.books_used = self._cur.fetchone()[0]
-        if r.books_used is None:    # empty DB
-            r.books_used = 0
+        # OFFLINE books aren't used, and on a shard they're another's
+        self._cur.execute('''SELECT TOTAL(books) FROM book_counts
+                             WHERE allocated IN (?,?)''',
+                          (TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE))
+        r.books_used = int(self._cur.fetchone()[0])
         return r
 
+    def get_book_counts(self):
+        ''' How many books there are in each allocation state, per
+            interleave group.  Read from a summary table, so it costs the
+            same however many books there are.
+            Input---
+              None
+            Output---
+              dict of { (intlv_group, allocated): number of books }
+        '''
+        self._cur.execute('''SELECT intlv_group, allocated, books
+                             FROM book_counts WHERE books > 0''')
+        self._cur.iterclass = None
+        return dict(((ig, allocated), books)
+                    for ig, allocated, books in self._cur.fetchall())
+
     def get_nodes(self):
         ''' Retrieve info about all nodes configured into the DB.
             Input---
@@ -167,6 +304,23 @@ class LibrarianDBackendSQL(object):
         q = [ '%s=?' % f for f in fields ]
         return joiner.join(q)
 
+    # SQL that depends on matchfields, IN list lengths and the like.  Each
+    # shape is put together once and the same text used every time after,
+    # which is also what the connection's statement cache is keyed on.
+    # Values are always ? parameters, never part of the text.
+
+    _statements = { }
+
+    @classmethod
+    def _statement(cls, key, build):
+        ''' SQL text for key, from build() the first time.  key is
+            (operation, whatever else shapes the text).
+        '''
+        try:
+            return cls._statements[key]
+        except KeyError:
+            return cls._statements.setdefault(key, build())
+
     # matchfields provide the core of the SET clause and were set by
     # the importer.  Localmods fields were done in the direct caller
     # of this routine.  Those two field sets must be disjoint.
@@ -182,8 +336,9 @@ class LibrarianDBackendSQL(object):
             assert not tmp, 'Bad matchfields %s' % str(tmp)
 
         fields = obj.matchfields + localmods
-        qmarks = self._fields2qmarks(fields, ', ')
-        setwhere = '%s WHERE id=?' % qmarks
+        setwhere = self._statement(
+            ('modify', table, fields),
+            lambda: '%s WHERE id=?' % self._fields2qmarks(fields, ', '))
         self._cur.UPDATE(table, setwhere, obj.tuple(fields + objid))
         if commit:
             self._cur.commit()
@@ -265,18 +420,28 @@ class LibrarianDBackendSQL(object):
     def modify_node_soc_status(self, node_id,
             status=None, cpu_percent=-44, rootfs_percent=-45, network_in=-46,
                    network_out=-47, mem_percent=-48):
-        ''' Update the current heartbeat status for the SoC
+        ''' Update the current heartbeat status for the SoC.  Nothing is
+            written here; flush() persists it.
         '''
-        if status is None:      # Just advance the last-known-contact time
-            self._cur.UPDATE('SOCs', 'heartbeat=?WHERE node_id=?',
-                (int(time.time()), node_id))
-        else:
-            self._cur.UPDATE(
-                'SOCs',
-                'status=?, heartbeat=?, cpu_percent=?, rootfs_percent=?, network_in=?, network_out=?, mem_percent=?  WHERE node_id=?',
-                (status, int(time.time()), cpu_percent, rootfs_percent,
-                    network_in, network_out, mem_percent, node_id))
-        self._cur.commit()
+        if self._soc_status is None:
+            self._soc_status = { }
+        soc = self._soc_status.setdefault(node_id, { })
+        soc['heartbeat'] = int(time.time())  # last-known-contact time
+        if status is not None:
+            soc.update(status=status, cpu_percent=cpu_percent,
+                       rootfs_percent=rootfs_percent, network_in=network_in,
+                       network_out=network_out, mem_percent=mem_percent)
+
+    def _flush_soc_status(self):
+        '''Write every node touched since the last time in one go.'''
+        for node_id, soc in sorted(self._soc_status.items()):
+            fields = tuple(sorted(soc.keys()))
+            sql = self._statement(
+                ('soc_status', fields),
+                lambda: 'UPDATE SOCs SET %s WHERE node_id=?' %
+                    self._fields2qmarks(fields, ', '))
+            self._cur.execute(sql, tuple(soc[f] for f in fields) + (node_id, ))
+        self._soc_status = { }
 
     def modify_node_mc_status(self, node_id, status):
         ''' Update the current status for a media controller
@@ -309,10 +474,53 @@ class LibrarianDBackendSQL(object):
         assert len(books) <= 1, 'Matched more than one book'
         return books[0] if books else None
 
+    # SQLite3 has a compile-time limit on host parameters, historically 999.
+    # An IN list is padded with NULL, which matches nothing, to the next
+    # of these lengths, so there are only a few shapes of the statement.
+    _IN_SIZES = (8, 64, 500)
+    _IN_CHUNK = _IN_SIZES[-1]
+
+    def get_books_by_ids(self, book_ids):
+        """ Retrieve a set of books by their book_ids.
+            Input---
+              book_ids - sequence of book ids
+            Output---
+              list of TMBook objects in the order of book_ids; ids that
+              don't exist are silently dropped.
+        """
+        found = { }
+        book_ids = list(book_ids)
+        for i in range(0, len(book_ids), self._IN_CHUNK):
+            chunk = tuple(book_ids[i:i + self._IN_CHUNK])
+            size = min(n for n in self._IN_SIZES if n >= len(chunk))
+            sql = self._statement(
+                ('get_books_by_ids', size),
+                lambda: 'SELECT * FROM books WHERE id IN (%s)' %
+                    ','.join(['?'] * size))
+            self._cur.execute(sql, chunk + (None, ) * (size - len(chunk)))
+            self._cur.iterclass = TMBook
+            for r in self._cur:
+                found[r.id] = r
+        return [ found[i] for i in book_ids if i in found ]
+
+    def get_book_ids(self, allocated=TMBook.ALLOC_FREE):
+        """ Retrieve the bare (id, intlv_group) of books in one allocation
+            state.  Much cheaper than TMBook objects for building indices.
+            Input---
+              allocated - the allocation state to match
+            Output---
+              list of (id, intlv_group) tuples sorted by id
+        """
+        self._cur.execute('''SELECT id, intlv_group FROM books
+                             WHERE allocated=? ORDER BY id''', (allocated,))
+        self._cur.iterclass = None
+        return self._cur.fetchall()
+
     def get_books_by_intlv_group(self, max_books, IGs,
                                  allocated=None,
                                  exclude=False,
-                                 ascending=True):
+                                 ascending=True,
+                                 after_id=None):
         """ Retrieve available book(s) from given interleave group.
             Input---
               max_books - maximum number of books
@@ -322,37 +530,49 @@ class LibrarianDBackendSQL(object):
                           'ANY'=any
               exclude - treat IGs as exclusion filter: NOT IN (....)
               ascending - order by book_id == LZA
+              after_id - cursor: only books past this id in that order
             Output---
               List of TMBooks up to max_books or raised error
         """
         if allocated is None:
-            allocated = [TMBook.ALLOC_FREE]
+            allocated = (TMBook.ALLOC_FREE, )
         elif allocated == 'ANY':
             allocated = range(6)    # get them all and then some
-        if IGs:
-            INclause = 'AND intlv_group %%s IN (%s)' % ','.join(
-                (str(i) for i in IGs))
-            INclause = INclause % ('NOT' if exclude else '')
-        else:
+        allocated = tuple(allocated)
+        IGs = tuple(IGs) if IGs else ()
+        exclude = bool(exclude and IGs)
+        paged = after_id is not None
+
+        def build():
             INclause = ''
-        ALLOCclause = 'WHERE allocated IN (%s)' % ','.join(
-            (str(i) for i in allocated))
-        order = 'ASC' if ascending else 'DESC'
-        # SQL injection yeah yeah yeah can't avoid these
-        sql = '''SELECT * from books
-                 %s
-                 %s
-                 ORDER BY id %s
-                 LIMIT ?''' % (ALLOCclause, INclause, order)
-        self._cur.execute(sql, (max_books))
+            if IGs:
+                INclause = 'AND intlv_group %s IN (%s)' % (
+                    'NOT' if exclude else '', ','.join(['?'] * len(IGs)))
+            if paged:
+                INclause += ' AND id %s ?' % ('>' if ascending else '<')
+            return '''SELECT * from books
+                      WHERE allocated IN (%s)
+                      %s
+                      ORDER BY id %s
+                      LIMIT ?''' % (','.join(['?'] * len(allocated)),
+                                     INclause,
+                                     'ASC' if ascending else 'DESC')
+
+        sql = self._statement(
+            ('get_books_by_intlv_group', len(allocated), len(IGs), exclude,
+             bool(ascending), paged), build)
+        parms = allocated + IGs + ((after_id, ) if paged else ()) + \
+            (max_books, )
+        self._cur.execute(sql, parms)
         self._cur.iterclass = TMBook
         book_data = [ r for r in self._cur ]
         return book_data
 
-    def get_books_on_shelf(self, shelf):
+    def get_books_on_shelf(self, shelf, columns=False):
         """ Retrieve all books on a shelf.
             Input---
               shelf
+              columns - return a BookColumns instead of a list
             Output---
               book data or None
         """
@@ -361,27 +581,46 @@ class LibrarianDBackendSQL(object):
             FROM books JOIN books_on_shelves ON books.id = book_id
             WHERE shelf_id = ? ORDER BY seq_num''',
             shelf.id)
+        if columns:     # straight from the row tuples, no TMBooks
+            return BookColumns(self._cur.fetchall())
         self._cur.iterclass = TMBook
         books = [ r for r in self._cur ]
         return books
 
-    def get_book_all(self):
+    @staticmethod
+    def _page(after_id, limit, column='id'):
+        '''WHERE/LIMIT tail and its parms for a keyset page on column'''
+        where = '' if after_id is None else 'AND %s > ?' % column
+        parms = () if after_id is None else (after_id, )
+        tail = ''
+        if limit is not None:
+            tail = 'LIMIT ?'
+            parms += (limit, )
+        return where, tail, parms
+
+    def get_book_all(self, after_id=None, limit=None):
         """ Retrieve book-level info about all books in all interleave groups.
             Input---
-              None
+              after_id - cursor: only books with a larger id
+              limit - maximum number of books, None for all
             Output---
               list of TMBook objects or raise error
         """
-        self._cur.execute('SELECT * FROM books ORDER BY id')
+        where, tail, parms = self._page(after_id, limit)
+        self._cur.execute(
+            'SELECT * FROM books WHERE 1 %s ORDER BY id %s' % (where, tail),
+            parms)
         self._cur.iterclass = TMBook
         books = [ r for r in self._cur ]
         return books
 
-    def get_book_info_all(self, intlv_group):
+    def get_book_info_all(self, intlv_group, after_id=None, limit=None):
         """ Retrieve maximum info on all books in an interleave group,
             including shelf ownership if applicable.
             Input---
               intlv_group
+              after_id - cursor: only books with a larger id
+              limit - maximum number of books, None for all
             Output---
               list of objects of book data (could be emtpy) or raise error
         """
@@ -404,9 +643,11 @@ class LibrarianDBackendSQL(object):
                              ON books.id = books_on_shelves.book_id
                              LEFT OUTER JOIN shelves
                              ON books_on_shelves.shelf_id = shelves.id
-                             WHERE books.intlv_group = ?
+                             WHERE books.intlv_group = ? %s
+                             ORDER BY books.id %s
             """
-        self._cur.execute(db_query, (intlv_group))
+        where, tail, parms = self._page(after_id, limit, 'books.id')
+        self._cur.execute(db_query % (where, tail), (intlv_group, ) + parms)
         self._cur.iterclass = 'default'
         book_data = [ r for r in self._cur ]
         return(book_data)
@@ -424,6 +665,8 @@ class LibrarianDBackendSQL(object):
               shelf_data or error message
         """
         shelf.id = None     # DB engine will autochoose next id
+        if self.shard[1] > 1:
+            shelf.id = self._next_shard_id()
         if not shelf.mode:
             shelf.mode = stat.S_IFREG + 0o666
         tmp = int(time.time())
@@ -433,6 +676,13 @@ class LibrarianDBackendSQL(object):
         shelf.id = self._cur.INSERT('shelves', shelf.tuple())
         return shelf
 
+    def _next_shard_id(self):
+        self.hold_writes()      # nobody else gets the same MAX(id)
+        self._cur.execute('SELECT MAX(id) FROM shelves')
+        nextid = self._cur.fetchone()[0] + 1
+        k, n = self.shard
+        return nextid + (k - nextid) % n
+
     def create_symlink(self, shelf, target):
         """ Creates a link entry to hold symlink path in link table
             Input---
@@ -456,6 +706,62 @@ class LibrarianDBackendSQL(object):
         tmp = self._cur.fetchone()
         return tmp[0]
 
+    def delete_symlink(self, shelf):
+        self._cur.DELETE('links', 'shelf_id=?', (shelf.id, ))
+
+    #
+    # Renames between shards (see engine.cmd_prepare_move()).  Each shard
+    # keeps its half of a move here from prepare to finish.
+    #
+
+    _MOVE_COLUMNS = ('txn', 'direction', 'state', 'shelf_id', 'name',
+                     'parent_id', 'record')
+
+    def create_move(self, txn, direction, shelf, record=None):
+        """ Record a prepared move.
+            Input---
+              txn - the router's name for the move
+              direction - 'out' on the source, 'in' on the destination
+              shelf - the shelf leaving, or name and parent_id to arrive as
+              record - what the source sent the destination, if any
+            Output---
+              None
+        """
+        self._cur.INSERT('moves', (txn, direction, 'prepared', shelf.id,
+                                   shelf.name, shelf.parent_id,
+                                   json.dumps(record)))
+
+    def get_moves(self, txn=None, shelf_id=None):
+        """ Prepared or committed moves.
+            Input---
+              txn - just this one
+              shelf_id - just the one taking this shelf off this shard
+            Output---
+              list of dicts keyed by _MOVE_COLUMNS, record decoded
+        """
+        if txn is not None:
+            self._cur.execute('SELECT * FROM moves WHERE txn=?', (txn, ))
+        elif shelf_id is not None:
+            self._cur.execute('''SELECT * FROM moves
+                                 WHERE shelf_id=? AND direction='out' ''',
+                              (shelf_id, ))
+        else:
+            self._cur.execute('SELECT * FROM moves ORDER BY txn')
+        self._cur.iterclass = None
+        moves = [ dict(zip(self._MOVE_COLUMNS, r))
+                  for r in self._cur.fetchall() ]
+        for move in moves:
+            move['record'] = json.loads(move['record'])
+        return moves
+
+    def commit_move(self, txn, shelf):
+        """ The destination's half is done; shelf is what arrived. """
+        self._cur.UPDATE('moves', 'state=?, shelf_id=? WHERE txn=?',
+                         ('committed', shelf.id, txn))
+
+    def delete_move(self, txn):
+        self._cur.DELETE('moves', 'txn=?', (txn, ))
+
     def get_shelf(self, shelf):
         """ Retrieve one shelf from the database
             Input---
@@ -465,8 +771,10 @@ class LibrarianDBackendSQL(object):
               shelf object with details or RAISED error message
         """
         fields = shelf.matchfields
-        qmarks = self._fields2qmarks(fields, ' AND ')
-        sql = 'SELECT * FROM shelves WHERE %s' % qmarks
+        sql = self._statement(
+            ('get_shelf', fields),
+            lambda: 'SELECT * FROM shelves WHERE %s' %
+                self._fields2qmarks(fields, ' AND '))
         self._cur.execute(sql, shelf.tuple(fields))
         self._cur.iterclass = TMShelf
         shelves = [ r for r in self._cur ]
@@ -479,6 +787,83 @@ class LibrarianDBackendSQL(object):
         # and may take surgery on the socket data return values.
         return shelf
 
+    # Paths live in the shelves table as (parent_id, name) links.  Root is
+    # id 2 and is its own parent.  Walk them with recursive CTEs so a deep
+    # path is one statement instead of one get_shelf per component.
+
+    _ROOT_ID = 2
+    _MAX_DEPTH = 4096   # cycle insurance against a corrupt table
+
+    def get_shelves_by_path(self, names, start_id=_ROOT_ID):
+        """ Resolve a list of path components starting below a directory.
+            Input---
+              names - list of path components, top down
+              start_id - shelf id of the directory holding names[0]
+            Output---
+              List of TMShelf objects, one per component that resolved.
+              It's short if a component is missing.
+        """
+        if not names:
+            return [ ]
+        # Depths are generated here, only the names are bound
+        sql = self._statement(('get_shelves_by_path', len(names)),
+                              lambda: self._path_walk(len(names)))
+        self._cur.execute(sql, tuple(names) + (start_id, ))
+        self._cur.iterclass = TMShelf
+        return [ r for r in self._cur ]
+
+    @staticmethod
+    def _path_walk(depth):
+        values = ', '.join([ '(%d, ?)' % (d + 1) for d in range(depth) ])
+        return '''WITH RECURSIVE
+                 names(depth, name) AS (VALUES %s),
+                 walk(depth, id) AS (
+                    SELECT 0, ?
+                    UNION ALL
+                    SELECT names.depth, shelves.id FROM walk
+                    JOIN names ON names.depth = walk.depth + 1
+                    JOIN shelves ON shelves.parent_id = walk.id
+                                AND shelves.name = names.name
+                 )
+                 SELECT shelves.* FROM walk
+                 JOIN shelves ON shelves.id = walk.id
+                 WHERE walk.depth > 0
+                 ORDER BY walk.depth''' % values
+
+    def get_shelf_path(self, shelf):
+        """ Reconstruct the full path of one shelf by walking up to root.
+            Input---
+              shelf - TMShelf object with minimum info to key a lookup.
+                      Key fields must be set in "matchfields" attribute.
+            Output---
+              Absolute path string or None if the shelf was not found.
+        """
+        fields = shelf.matchfields
+        sql = self._statement(('get_shelf_path', fields),
+                              lambda: self._path_up(fields))
+        self._cur.execute(
+            sql, shelf.tuple(fields) + (self._ROOT_ID, self._MAX_DEPTH))
+        self._cur.iterclass = None
+        rows = self._cur.fetchall()
+        if not rows:
+            return None
+        assert rows[0][0] == self._ROOT_ID, 'Shelf is not connected to root'
+        return '/' + '/'.join([ name for id, name in rows[1:] ])
+
+    @classmethod
+    def _path_up(cls, fields):
+        qmarks = cls._fields2qmarks(fields, ' AND ')
+        return '''WITH RECURSIVE
+                 up(id, parent_id, name, depth) AS (
+                    SELECT id, parent_id, name, 0 FROM shelves WHERE %s
+                    UNION ALL
+                    SELECT shelves.id, shelves.parent_id, shelves.name,
+                           up.depth + 1
+                    FROM shelves JOIN up ON shelves.id = up.parent_id
+                    WHERE up.id != ? AND up.depth < ?
+                 )
+                 SELECT id, name FROM up ORDER BY depth DESC''' % qmarks
+
     def get_shelf_openers(self, shelf, context, include_me=False):
         """ Retrieve a list of actors holding a shelf open.
             Input---
@@ -507,9 +892,9 @@ class LibrarianDBackendSQL(object):
             Output---
               List of TMShelf objects (could be empty) or raise error
         """
-        parent_id = parent_shelf.id
         self._cur.execute(
-            'SELECT * FROM shelves WHERE parent_id = %d ORDER BY id' % parent_id)
+            'SELECT * FROM shelves WHERE parent_id=? ORDER BY id',
+            parent_shelf.id)
         self._cur.iterclass = TMShelf
         shelves = [ r for r in self._cur ]
         return shelves
@@ -526,14 +911,18 @@ class LibrarianDBackendSQL(object):
         shelves = [ r for r in self._cur ]
         return shelves
 
-    def get_open_shelf_all(self):
+    def get_open_shelf_all(self, after_id=None, limit=None):
         """ Retrieve all open shelves.
             Input---
-              None
+              after_id - cursor: only open handles with a larger id
+              limit - maximum number of open handles, None for all
             Output---
               List of TMShelf objects (could be empty) or raise error
         """
-        self._cur.execute('SELECT * FROM opened_shelves ORDER BY id')
+        where, tail, parms = self._page(after_id, limit)
+        self._cur.execute(
+            'SELECT * FROM opened_shelves WHERE 1 %s ORDER BY id %s' % (
+                where, tail), parms)
         self._cur.iterclass = TMOpenedShelves
         shelves = [ r for r in self._cur ]
         return shelves
@@ -547,7 +936,9 @@ class LibrarianDBackendSQL(object):
             Output---
               TMShelf object or raise error
         """
-        where = self._fields2qmarks(shelf.schema, ' AND ')
+        where = self._statement(
+            ('delete', 'shelves'),
+            lambda: self._fields2qmarks(shelf.schema, ' AND '))
         self._cur.DELETE('shelves', where, shelf.tuple())
         if commit:
             self._cur.commit()
@@ -619,7 +1010,9 @@ class LibrarianDBackendSQL(object):
             Output---
               bos_data or error message
         """
-        where = self._fields2qmarks(bos.schema, ' AND ')
+        where = self._statement(
+            ('delete', 'books_on_shelves'),
+            lambda: self._fields2qmarks(bos.schema, ' AND '))
         self._cur.DELETE('books_on_shelves', where, bos.tuple())
         if commit:
             self._cur.commit()
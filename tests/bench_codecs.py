@@ -0,0 +1,62 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Size and speed of each wire codec on list_shelf_books replies.
+    Not a unit test: PYTHONPATH=src python3 tests/bench_codecs.py
+"""
+
+import sys
+import timeit
+
+try:
+    from librarian_chain import CODECS
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+
+def shelf_books_reply(nbooks):
+    '''What the engine sends back for list_shelf_books, TMBook dicts'''
+    books = [ { 'id': (i % 8) << 46 | (i << 33),
+                'intlv_group': i % 8,
+                'book_num': i,
+                'allocated': 2,
+                'attributes': 0 } for i in range(nbooks) ]
+    return { 'value': books,
+             'context': { 'seq': 12345, 'node_id': 7, 'uid': 1000,
+                          'gid': 1000, 'pid': 4242, 'tid': 4242 } }
+
+
+def main(sizes):
+    print('%6s %-8s %10s %10s %10s' %
+          ('books', 'codec', 'bytes', 'enc usec', 'dec usec'))
+    for nbooks in sizes:
+        reply = shelf_books_reply(nbooks)
+        loops = max(3, 20000 // (nbooks + 10))
+        for name, chain in CODECS.items():
+            chain = chain()
+            wire = chain.forward_traverse(reply)
+            assert chain.reverse_traverse(wire) == reply, name
+            enc = min(timeit.repeat(lambda: chain.forward_traverse(reply),
+                                    number=loops, repeat=3)) / loops
+            dec = min(timeit.repeat(lambda: chain.reverse_traverse(wire),
+                                    number=loops, repeat=3)) / loops
+            print('%6d %-8s %10d %10.1f %10.1f' %
+                  (nbooks, name, len(wire), enc * 1e6, dec * 1e6))
+
+
+if __name__ == '__main__':
+    main([ int(n) for n in sys.argv[1:] ] or (1, 10, 100, 1000, 10000))
@@ -0,0 +1,87 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Per-command dispatch overhead of LibrarianCommandEngine.__call__.
+    Not a unit test: PYTHONPATH=src python3 tests/bench_engine.py [config]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+try:
+    from backend_sqlite3 import LibrarianDBackendSQLite3
+    from engine import LibrarianCommandEngine
+    from frdnode import FRDnode
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+_CONFIG = os.path.join(_SRC, '..', 'configfiles', 'fame.json')
+
+
+def scratch_engine(config, db_file):
+    subprocess.check_call(
+        [ sys.executable, os.path.join(_SRC, 'book_register.py'),
+          '-d', db_file, config ], stdout=subprocess.DEVNULL)
+    args = argparse.Namespace(db_file=db_file, verbose=0)
+    return LibrarianCommandEngine(LibrarianDBackendSQLite3(args))
+
+
+def main(config):
+    fd, db_file = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(db_file)
+    try:
+        lce = scratch_engine(config, db_file)
+        node_id = max(lce.node_ids)
+        context = { 'seq': 1, 'node_id': node_id, 'uid': 0, 'gid': 0,
+                    'pid': 1, 'tid': 1 }
+        loops = 20000
+        print('%d nodes, caller is node %d' % (len(lce.node_ids), node_id))
+
+        checks = (
+            ('FRDnode in nodes',
+             lambda: FRDnode(node_id) in lce.nodes),
+            ('node_id in node_ids',
+             lambda: node_id in lce.node_ids),
+        )
+        for name, check in checks:
+            t = min(timeit.repeat(check, number=loops, repeat=3)) / loops
+            print('%-24s %8.2f usec' % (name, t * 1e6))
+
+        for command in ('version', 'get_fs_stats'):
+            cmdict = { 'command': command, 'context': context }
+            once = timeit.timeit(lambda: lce(cmdict), number=1)
+            n = max(10, min(loops, int(0.2 / once)))
+            t = min(timeit.repeat(lambda: lce(cmdict),
+                                  number=n, repeat=3)) / n
+            print('%-24s %8.2f usec' % ('__call__ ' + command, t * 1e6))
+        lce.db.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(db_file + suffix)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else _CONFIG)
@@ -0,0 +1,160 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Metadata write throughput through shard_router.py by shard count.
+    Not a unit test:
+        PYTHONPATH=src python3 tests/bench_shards.py [--shards 1,2,4] ...
+    Each client creates files under its own top-level directory, grows
+    each by a book at a time and closes it.  "direct" is one librarian.py
+    with no router in front, for the router's own cost.
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from cmdproto import LibrarianCommandProtocol
+    from shard_router import split
+    from socket_handling import Client, Demux
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+_CONFIG = os.path.join(_SRC, '..', 'configfiles', 'fame.json')
+
+
+def start(args, port, *more):
+    proc = subprocess.Popen(
+        [ sys.executable ] + list(args) + [ '--port', str(port) ] +
+        list(more), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        client = Client(selectable=False)
+        if client.connect(port=port, retry=False):
+            return proc, client
+        time.sleep(0.1)
+    proc.kill()
+    raise SystemExit('%s did not start' % args[0])
+
+
+def run_clients(port, nclients, nfiles, nbooks):
+    book_size = None
+    errors = [ ]
+
+    def client(k):
+        demux = Demux(start_client(port))
+        lcp = LibrarianCommandProtocol({ 'node_id': 1, 'pid': k })
+        go = lambda *a, **kw: demux.transact(lcp(*a, **kw))
+        top = '/top%d' % k
+        go('mkdir', path=top, mode=0o40777)
+        for i in range(nfiles):
+            path = '%s/f%d' % (top, i)
+            shelf = go('create_shelf', path=path, mode=0o100666)['value']
+            for n in range(1, nbooks + 1):
+                rsp = go('resize_shelf', path=path, id=shelf['id'],
+                         size_bytes=n * book_size, zero_enabled=False)
+                if 'errmsg' in rsp:
+                    errors.append(rsp['errmsg'])
+            go('close_shelf', id=shelf['id'],
+               open_handle=shelf['open_handle'])
+
+    def start_client(port):
+        client = Client(selectable=False)
+        client.connect(port=port)
+        return client
+
+    demux = Demux(start_client(port))
+    lcp = LibrarianCommandProtocol({ 'node_id': 1, 'pid': 0 })
+    book_size = demux.transact(lcp('get_fs_stats'))['value'][
+        'book_size_bytes']
+    threads = [ threading.Thread(target=client, args=(k, ))
+                for k in range(nclients) ]
+    t0 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - t0
+    ncommands = nclients * (2 + nfiles * (nbooks + 2))
+    return ncommands / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', default='1,2,4')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--books', type=int, default=4)
+    parser.add_argument('--durability', default='full')
+    parser.add_argument('--config', default=_CONFIG)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    db_file = os.path.join(tmpdir.name, 'librarian.db')
+    subprocess.check_call(
+        [ sys.executable, os.path.join(_SRC, 'book_register.py'),
+          '-d', db_file, args.config ], stdout=subprocess.DEVNULL)
+    librarian = os.path.join(_SRC, 'librarian.py')
+    router = os.path.join(_SRC, 'shard_router.py')
+    port = random.randint(20000, 40000)
+    print('%d clients x %d files x %d books, durability %s, %d CPUs' % (
+        args.clients, args.files, args.books, args.durability,
+        os.cpu_count()))
+
+    for nshards in [ 0 ] + [ int(n) for n in args.shards.split(',') ]:
+        procs = [ ]
+        try:
+            db_files = split(db_file, max(nshards, 1))
+            for k, shard_file in enumerate(db_files):
+                more = [ '--db_file', shard_file,
+                         '--durability', args.durability ]
+                if nshards:
+                    more += [ '--shard', '%d/%d' % (k, nshards) ]
+                port += 1
+                procs.append(start([ librarian ], port, *more))
+            if nshards:
+                shards = ','.join('localhost:%d' % (port - nshards + 1 + k)
+                                  for k in range(nshards))
+                port += 1
+                procs.append(start([ router ], port, '--shards', shards))
+            rate, errors = run_clients(
+                port, args.clients, args.files, args.books)
+            print('%-8s %8.0f commands/sec%s' % (
+                '%d shards' % nshards if nshards else 'direct', rate,
+                ', %d errors: %s' % (len(errors), errors[0]) if errors
+                else ''))
+        finally:
+            for proc, client in procs:
+                client.close()
+                proc.kill()
+                proc.wait()
+            for shard_file in db_files:
+                for suffix in ('', '-wal', '-shm'):
+                    try:
+                        os.unlink(shard_file + suffix)
+                    except OSError:
+                        pass
+    tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Rows to objects through SQLassist iteration, for bulk queries.
+    Not a unit test: PYTHONPATH=src python3 tests/bench_sqlassist.py [books]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+try:
+    from backend_sqlite3 import LibrarianDBackendSQLite3, SQLite3assist
+    from book_register import create_empty_db
+    from book_shelf_bos import TMBook
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+
+def scratch_backend(db_file, nbooks):
+    cur = SQLite3assist(db_file=db_file)
+    create_empty_db(cur)
+    cur.execute('INSERT INTO globals VALUES(?, ?, ?, ?, ?)', (
+                SQLite3assist.SCHEMA_VERSION, 1 << 33, nbooks << 33,
+                nbooks, 1))
+    cur._cursor.executemany(
+        'INSERT INTO books VALUES (?, ?, ?, ?, ?)',
+        (((i % 128) << 46 | (i // 128) << 33, i % 128, i // 128,
+          TMBook.ALLOC_FREE, 0) for i in range(nbooks)))
+    cur.execute('INSERT INTO shelves VALUES (2,0,0,0,0,0,".",?,2,2)',
+                (0o40777, ))
+    cur.commit()
+    cur.close()
+    return LibrarianDBackendSQLite3(argparse.Namespace(db_file=db_file))
+
+
+def main(nbooks):
+    fd, db_file = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(db_file)
+    try:
+        db = scratch_backend(db_file, nbooks)
+        checks = (
+            ('get_book_all()', lambda: db.get_book_all()),
+            ('get_books_by_intlv_group(all)', lambda:
+                db.get_books_by_intlv_group(nbooks, None, 'ANY')),
+            ('get_book_info_all(IG 0)', lambda: db.get_book_info_all(0)),
+            ('get_books_by_ids(1000)', lambda: db.get_books_by_ids(
+                [ b.id for b in db.get_book_all(limit=1000) ])),
+        )
+        print('%d books' % nbooks)
+        for name, check in checks:
+            n = len(check())
+            secs = min(timeit.repeat(check, number=1, repeat=5))
+            print('%-32s %8.1f ms %8.2f us/row' % (
+                name, secs * 1000, secs * 1e6 / n))
+        db.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(db_file + suffix)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,104 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for the FreeBooks index in book_policy.py """
+
+import unittest
+
+try:
+    from book_policy import FreeBooks
+    from book_shelf_bos import TMBook
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+
+class FakeBooksDB(object):
+    '''Just enough of LibrarianDBackendSQL for FreeBooks.'''
+
+    def __init__(self, IGs, books_per_IG):
+        self.books = { }
+        for ig in IGs:
+            for bn in range(books_per_IG):
+                book = TMBook(id=(ig << 16) + bn, intlv_group=ig,
+                              book_num=bn, allocated=TMBook.ALLOC_FREE,
+                              attributes=0)
+                self.books[book.id] = book
+
+    def get_book_ids(self, allocated):
+        return [ (b.id, b.intlv_group) for b in
+                 sorted(self.books.values(), key=lambda b: b.id)
+                 if b.allocated == allocated ]
+
+    def get_books_by_ids(self, book_ids):
+        return [ self.books[i] for i in book_ids if i in self.books ]
+
+
+class TestFreeBooks(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeBooksDB((0, 1, 2), 10)
+        self.fb = FreeBooks(self.db)
+
+    def test_free_books_1(self):
+        self.assertEqual(len(self.fb), 30)
+        self.assertEqual(self.fb.count(1), 10)
+
+    def test_free_books_2(self):
+        books = self.fb(5, (1, ), order=FreeBooks.ASCENDING)
+        self.assertEqual([b.book_num for b in books], [0, 1, 2, 3, 4])
+        self.assertTrue(all(b.intlv_group == 1 for b in books))
+
+    def test_free_books_3(self):
+        books = self.fb(3, (99999, ), exclude=True,
+                        order=FreeBooks.DESCENDING)
+        self.assertEqual([b.id for b in books],
+                         [(2 << 16) + 9, (2 << 16) + 8, (2 << 16) + 7])
+
+    def test_free_books_4(self):
+        books = self.fb(12, (0, 2))
+        self.assertEqual(len(books), 12)
+        self.assertEqual(len(set(b.id for b in books)), 12)
+        self.assertTrue(all(b.intlv_group in (0, 2) for b in books))
+
+    def test_free_books_5(self):
+        # Short return when the IG runs dry, nothing from elsewhere
+        self.assertEqual(len(self.fb(15, (0, ))), 10)
+        self.assertEqual(self.fb(1, (7, )), [])
+
+    def test_free_books_6(self):
+        book = self.db.books[0]
+        book.allocated = TMBook.ALLOC_INUSE
+        self.fb.discard(book)
+        self.assertEqual(self.fb.count(0), 9)
+        self.assertNotIn(book, self.fb(10, (0, )))
+        book.allocated = TMBook.ALLOC_FREE
+        self.fb.add(book)
+        self.fb.add(book)   # idempotent
+        self.assertEqual(self.fb.count(0), 10)
+
+    def test_free_books_7(self):
+        # SQL changed underneath the index: it must resync, not lie.
+        for book in self.db.books.values():
+            if book.intlv_group == 0:
+                book.allocated = TMBook.ALLOC_INUSE
+        books = self.fb(5, (0, 1), order=FreeBooks.ASCENDING)
+        self.assertTrue(all(b.intlv_group == 1 for b in books))
+        self.assertEqual(self.fb.count(0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
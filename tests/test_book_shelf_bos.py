@@ -0,0 +1,100 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for book_shelf_bos.py """
+
+import json
+import unittest
+
+try:
+    from book_shelf_bos import BookColumns, TMBook, TMShelf
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+_BOOK = 1 << 33
+
+
+def rows(ids):
+    return [ (i, i >> 46, (i >> 33) & 0x1FFF, TMBook.ALLOC_INUSE, 0)
+             for i in ids ]
+
+
+class TestBookColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = [ (1 << 46) + n * _BOOK for n in (5, 6, 7, 2, 3) ]
+        self.books = BookColumns(rows(self.ids))
+
+    def test_columns_1(self):
+        self.assertEqual(len(self.books), 5)
+        self.assertEqual(list(self.books.id), self.ids)
+        self.assertEqual(list(self.books.book_num), [ 5, 6, 7, 2, 3 ])
+        self.assertEqual(self.books[3]['id'], self.ids[3])
+        self.assertEqual(len(BookColumns()), 0)
+
+    def test_wire_1(self):
+        for delta in (False, True):
+            value = json.loads(json.dumps(self.books.wire(delta=delta)))
+            self.assertEqual(BookColumns.from_wire(value), self.books)
+        value = self.books.wire(delta=True)
+        self.assertEqual(value['id'][1:], [ _BOOK, _BOOK, -5 * _BOOK, _BOOK ])
+        self.assertEqual(BookColumns.from_wire(BookColumns().wire(True)),
+                         BookColumns())
+
+    def test_wire_2(self):
+        # Rows as an older librarian sends them
+        value = [ TMBook(*r).dict for r in rows(self.ids) ]
+        self.assertEqual(BookColumns.from_wire(value), self.books)
+
+    def test_startswith_1(self):
+        grown = BookColumns(rows(self.ids + [ 1 << 46 ]))
+        self.assertTrue(grown.startswith(self.books))
+        self.assertTrue(grown.startswith([ ]))
+        self.assertFalse(self.books.startswith(grown))
+        self.assertFalse(grown.startswith(BookColumns(rows(self.ids[1:]))))
+
+    def test_shelf_eq_1(self):
+        one = TMShelf(id=9, size_bytes=5 * _BOOK)
+        two = TMShelf(id=9, size_bytes=5 * _BOOK)
+        one.bos = self.books
+        two.bos = BookColumns(rows(reversed(self.ids)))
+        self.assertEqual(one, two)
+        two.bos = BookColumns(rows(self.ids[:4] + [ 1 << 46 ]))
+        self.assertNotEqual(one, two)
+
+
+class TestRowFactory(unittest.TestCase):
+
+    def test_row_factory_1(self):
+        names = ('intlv_group', 'id', 'junk', 'allocated')
+        row = (3, (3 << 46) + _BOOK, 'ignored', TMBook.ALLOC_INUSE)
+        made = TMBook.row_factory(names)(row)
+        self.assertEqual(made.dict, TMBook(**dict(zip(names, row))).dict)
+        self.assertEqual(made.book_num, 0)
+        self.assertIsNone(made.matchfields)
+
+    def test_row_factory_2(self):
+        make = TMShelf.row_factory(TMShelf._ordered_schema)
+        one, two = [ make((n, ) + (0, ) * 9) for n in (1, 2) ]
+        self.assertEqual(one.bos, [ ])
+        self.assertIsNot(one.bos, two.bos)
+        self.assertIsNone(one.open_handle)
+        self.assertEqual(one._fd, -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
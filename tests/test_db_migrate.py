@@ -0,0 +1,133 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for db_migrate.py """
+
+import argparse
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    from backend_sqlite3 import LibrarianDBackendSQLite3
+    from book_shelf_bos import TMBook
+    from db_migrate import MIGRATIONS, migrate
+    from sqlbackend import LibrarianDBackendSQL
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+_CONFIG = os.path.join(_SRC, '..', 'configfiles', 'fame.json')
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.new = os.path.join(self.tmpdir.name, 'new.db')
+        subprocess.check_call(
+            [ sys.executable, os.path.join(_SRC, 'book_register.py'),
+              '-d', self.new, _CONFIG ], stdout=subprocess.DEVNULL)
+        # What book_register.py made before any migration step
+        self.old = os.path.join(self.tmpdir.name, 'old.db')
+        shutil.copy(self.new, self.old)
+        conn = sqlite3.connect(self.old)
+        for step in reversed(MIGRATIONS):
+            for ddl in reversed(step.ddl):
+                made = re.match(r'CREATE (INDEX|TABLE|TRIGGER) (\w+)', ddl)
+                if made:    # else it filled in a table, gone with it
+                    conn.execute('DROP %s %s' % made.groups())
+        conn.execute('UPDATE globals SET schema_version=?',
+                     (MIGRATIONS[0].version, ))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def _schema(db_file):
+        conn = sqlite3.connect(db_file)
+        schema = set(conn.execute('SELECT type, name, sql FROM sqlite_master'))
+        version = conn.execute('SELECT schema_version FROM globals').fetchone()
+        conn.close()
+        return schema, version[0]
+
+    def _backend(self, db_file):
+        return LibrarianDBackendSQLite3(argparse.Namespace(db_file=db_file))
+
+    def test_migrate_1(self):
+        # Upgraded is the same as new, and then there's nothing to do.
+        with self.assertRaisesRegex(AssertionError, 'db_migrate.py'):
+            self._backend(self.old)
+        self.assertEqual(migrate(self.old), list(MIGRATIONS))
+        self.assertEqual(self._schema(self.old), self._schema(self.new))
+        self.assertEqual(self._schema(self.old)[1],
+                         LibrarianDBackendSQL.SCHEMA_VERSION)
+        self.assertEqual(migrate(self.old), [ ])
+        self._backend(self.old).close()
+
+    def test_migrate_2(self):
+        # A step that fails leaves nothing of itself behind.
+        conn = sqlite3.connect(self.old)
+        conn.execute('CREATE INDEX IDX_links ON links (target)')
+        conn.commit()
+        conn.close()
+        before = self._schema(self.old)
+        with self.assertRaisesRegex(RuntimeError, 'IDX_links'):
+            migrate(self.old)
+        self.assertEqual(self._schema(self.old), before)
+
+    def test_migrate_3(self):
+        conn = sqlite3.connect(self.old)
+        conn.execute("UPDATE globals SET schema_version='LIBRARIAN 0.5'")
+        conn.commit()
+        conn.close()
+        with self.assertRaisesRegex(RuntimeError, 'no migration'):
+            migrate(self.old)
+
+    def test_migrate_4(self):
+        # Counts start out right and the triggers keep them that way.
+        migrate(self.old)
+        db = self._backend(self.old)
+
+        def recount():
+            db.execute('''SELECT intlv_group, allocated, COUNT(*)
+                          FROM books GROUP BY intlv_group, allocated''')
+            return dict(((ig, allocated), books)
+                        for ig, allocated, books in db.fetchall())
+
+        self.assertEqual(db.get_book_counts(), recount())
+        books = db.get_book_all()
+        for book in books[:5]:
+            book.allocated = TMBook.ALLOC_INUSE
+            book.matchfields = ('allocated', )
+            db.modify_book(book)
+        db.execute('DELETE FROM books WHERE id=?', books[-1].id)
+        db.commit()
+        self.assertEqual(db.get_book_counts(), recount())
+        self.assertEqual(db.get_globals().books_used, 5)
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for engine.py helpers """
+
+import threading
+import time
+import unittest
+
+try:
+    from engine import DentryCache, LockTable
+    from book_shelf_bos import TMShelf
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+
+class TestDentryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dc = DentryCache(max_entries=3)
+
+    def test_dentry_cache_1(self):
+        self.assertIsNone(self.dc.get(2, 'a'))
+        self.dc.put(TMShelf(id=10, parent_id=2, name='a'))
+        self.assertEqual(self.dc.get(2, 'a').id, 10)
+        self.assertEqual((self.dc.hits, self.dc.misses), (1, 1))
+
+    def test_dentry_cache_2(self):
+        self.dc.put(TMShelf(id=10, parent_id=2, name='a'))
+        self.dc.invalidate(2, 'a')
+        self.dc.invalidate(2, 'nosuch')
+        self.assertIsNone(self.dc.get(2, 'a'))
+        self.assertEqual(len(self.dc), 0)
+
+    def test_dentry_cache_3(self):
+        for i, name in enumerate('abc'):
+            self.dc.put(TMShelf(id=10 + i, parent_id=2, name=name))
+        self.dc.get(2, 'a')     # now b is least recently used
+        self.dc.put(TMShelf(id=20, parent_id=2, name='d'))
+        self.assertEqual(len(self.dc), 3)
+        self.assertIsNone(self.dc.get(2, 'b'))
+        self.assertIsNotNone(self.dc.get(2, 'a'))
+
+
+class TestLockTable(unittest.TestCase):
+
+    def setUp(self):
+        self.locks = LockTable()
+
+    def _hold(self, keys, entered, secs):
+        with self.locks.held(keys):
+            entered.set()
+            time.sleep(secs)
+
+    def test_lock_table_1(self):
+        entered = threading.Event()
+        thread = threading.Thread(target=self._hold,
+                                  args=([('shelf', '1')], entered, 0.1))
+        thread.start()
+        entered.wait()
+        with self.locks.held([('shelf', '2')]):     # not contended
+            pass
+        with self.locks.held([('shelf', '1')]):
+            pass
+        thread.join()
+        stats = self.locks.stats['shelf']
+        self.assertEqual((stats['acquired'], stats['contended']), (3, 1))
+        self.assertGreater(stats['wait_secs'], 0.05)
+        self.assertEqual(len(self.locks._locks), 0)
+
+    def test_lock_table_2(self):
+        # Opposite orders, but taken sorted, so neither can deadlock.
+        keys = [ ('dir', '/a'), ('path', '/a/f') ]
+        threads = [ ]
+        for order in (keys, keys[::-1]) * 4:
+            threads.append(threading.Thread(
+                target=self._hold, args=(order, threading.Event(), 0.01)))
+            threads[-1].start()
+        for thread in threads:
+            thread.join(timeout=5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(self.locks.stats['dir']['acquired'], 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for the librarian_chain.py wire codecs """
+
+import unittest
+
+try:
+    from function_chain import BadChainReverse
+    from librarian_chain import CODECS, CompactChain, LibrarianChain
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+
+def json_roundtrip(obj):
+    chain = LibrarianChain()
+    return chain.reverse_traverse(chain.forward_traverse(obj))
+
+
+class TestCompactCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = CompactChain()
+
+    def roundtrip(self, obj):
+        return self.chain.reverse_traverse(self.chain.forward_traverse(obj))
+
+    def test_compact_scalars_1(self):
+        for obj in (None, True, False, 0, 127, 128, -32, -33, -129,
+                    1 << 15, -(1 << 31) - 1, 1 << 63, -(1 << 70), 2.5,
+                    '', 'x' * 31, 'y' * 32, 'z' * 70000, 'é\r\n'):
+            self.assertEqual(self.roundtrip(obj), obj)
+            self.assertIs(type(self.roundtrip(obj)), type(obj))
+
+    def test_compact_containers_1(self):
+        # Same answers as JSON, tuples and non-str keys included.
+        for obj in ([ ], { }, [ 1, (2, 3) ], list(range(70000)),
+                    { str(i): i for i in range(20) },
+                    { 1: 'a', True: 'b', None: 'c', 1.5: 'd' },
+                    { 'a': { 'a': { 'a': [ 'a' ] } } }):
+            self.assertEqual(self.roundtrip(obj), json_roundtrip(obj))
+
+    def test_compact_table_1(self):
+        books = [ { 'id': i, 'intlv_group': i % 4, 'book_num': i << 20,
+                    'allocated': 1, 'attributes': 0 }
+                  for i in range(1000) ]
+        rows = [ { 'a': 1, 'b': 'x' }, { 'a': 1 << 40, 'b': None } ]
+        mixed = [ { 'a': 1 }, { 'b': 2 }, 3 ]
+        for obj in (books, rows, mixed):
+            self.assertEqual(self.roundtrip(obj), obj)
+        reply = { 'value': books, 'context': { 'seq': 1 } }
+        compact = self.chain.forward_traverse(reply)
+        self.assertLess(len(compact),
+                        len(LibrarianChain().forward_traverse(reply)) / 4)
+
+    def test_compact_errors_1(self):
+        for junk in (b'', b'\xc6', b'\x92\x01', b'\x01\x02', b'\xd4\x00',
+                     b'\xc5\x02\x00\x00\x00\x01\xa1a' b'q\x00'):
+            with self.assertRaises(BadChainReverse):
+                self.chain.reverse_traverse(junk)
+
+    def test_codecs_1(self):
+        self.assertEqual(list(CODECS.keys())[-1], 'json')  # the fallback
+        for name, chain in CODECS.items():
+            obj = { 'command': 'get_book', 'id': 1, 'context': { } }
+            self.assertEqual(
+                chain().reverse_traverse(chain().forward_traverse(obj)), obj)
+
+
+if __name__ == '__main__':
+    unittest.main()
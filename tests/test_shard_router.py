@@ -0,0 +1,259 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for shard_router.py over two in-process shards """
+
+import argparse
+import errno
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    from backend_sqlite3 import LibrarianDBackendSQLite3
+    from book_shelf_bos import BookColumns, TMBook
+    from cmdproto import LibrarianCommandProtocol
+    from engine import LibrarianCommandEngine
+    from shard_router import ShardRouter, ig_owner, split
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+_CONFIG = os.path.join(_SRC, '..', 'configfiles', 'fame.json')
+
+
+class Direct(object):
+    '''A shard's engine where ShardRouter expects a Demux'''
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def transact(self, cmdict):
+        return self.engine(cmdict)[0]
+
+
+class Flaky(Direct):
+    '''Direct, but the next "fail" requests for the command get EIO'''
+
+    fail = 0
+    command = None
+
+    def transact(self, cmdict):
+        if self.fail and cmdict['command'] == self.command:
+            self.fail -= 1
+            return { 'errmsg': 'shard went away', 'errno': errno.EIO }
+        return super(Flaky, self).transact(cmdict)
+
+
+class TestShardRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_file = os.path.join(self.tmpdir.name, 'librarian.db')
+        subprocess.check_call(
+            [ sys.executable, os.path.join(_SRC, 'book_register.py'),
+              '-d', db_file, _CONFIG ], stdout=subprocess.DEVNULL)
+        self.engines = [ ]
+        for k, shard_file in enumerate(split(db_file, 2)):
+            args = argparse.Namespace(db_file=shard_file, shard='%d/2' % k,
+                                      verbose=0)
+            self.engines.append(LibrarianCommandEngine(
+                LibrarianDBackendSQLite3(args)))
+        self.router = ShardRouter([ Flaky(e) for e in self.engines ])
+        node_id = min(self.engines[0].node_ids)
+        self.lcp = LibrarianCommandProtocol({ 'node_id': node_id, 'pid': 1 })
+        self.book_size = self.engines[0].book_size_bytes
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.db.close()
+        self.tmpdir.cleanup()
+
+    def _do(self, *args, **kwargs):
+        return self.router(self.lcp(*args, **kwargs))[0]
+
+    def _top(self, shard, avoid=()):
+        '''A top-level name that lands on shard'''
+        for i in range(100):
+            name = 'f%d' % i
+            if name not in avoid and \
+               self.router._shard_of_path(name) == shard:
+                return name
+
+    def _create(self, path, nbooks):
+        shelf = self._do('create_shelf', path=path, mode=0o100666)['value']
+        self._do('resize_shelf', path=path, id=shelf['id'],
+                 size_bytes=nbooks * self.book_size, zero_enabled=False)
+        self._do('close_shelf', id=shelf['id'],
+                 open_handle=shelf['open_handle'])
+        return shelf['id']
+
+    def test_split_1(self):
+        # Every book belongs to exactly one shard: its IG's owner
+        books = [ e.db.get_book_all() for e in self.engines ]
+        for mine, theirs in zip(*books):
+            k = ig_owner(mine.intlv_group, 2)
+            owner, other = (mine, theirs) if k == 0 else (theirs, mine)
+            self.assertEqual(owner.allocated, TMBook.ALLOC_FREE)
+            self.assertEqual(other.allocated, TMBook.ALLOC_OFFLINE)
+        stats = self._do('get_fs_stats')['value']
+        self.assertEqual(stats['books_used'], 0)
+        self.assertEqual(len(stats['shards']), 2)
+
+    def test_route_1(self):
+        # Shelf ids say where the shelf lives; the root lists them all.
+        names = [ self._top(0), self._top(1) ]
+        for k, name in enumerate(names):
+            shelf_id = self._create('/' + name, 1)
+            self.assertEqual(shelf_id % 2, k)
+        self.assertEqual(self._do('get_fs_stats')['value']['books_used'], 2)
+        listed = [ s['name'] for s in
+                   self._do('list_shelves', path='/')['value'] ]
+        self.assertEqual(listed[:2], [ '.', '..' ])
+        self.assertEqual(sorted(set(names) & set(listed)), sorted(names))
+        self.assertEqual(listed.count('lost+found'), 1)
+        batch = self.lcp.batch(*[ self.lcp('get_shelf', path='/' + n)
+                                  for n in names ])
+        self.assertEqual(self.router(batch)[0]['errno'], errno.EXDEV)
+
+    def test_page_1(self):
+        # Pages through the router add up to the unpaged answer, with
+        # each book once, as its owner has it.
+        self._create('/' + self._top(0), 2)
+        self._create('/' + self._top(1), 1)
+        whole = self._do('get_book_all')['value']
+        self.assertEqual(len(set(b['id'] for b in whole)), len(whole))
+        paged = [ ]
+        after_id = None
+        more = True
+        while more:
+            page = self._do('get_book_all', after_id=after_id, limit=100)
+            self.assertLessEqual(len(page['value']), 100)
+            paged += page['value']
+            after_id, more = page['after_id'], page['more']
+        self.assertEqual(paged, whole)
+        self.assertEqual(sum(b['allocated'] == TMBook.ALLOC_INUSE
+                             for b in paged), 3)
+        self.assertEqual(self._do('get_book_all', limit=0)['errno'],
+                         errno.EINVAL)
+
+    def test_page_2(self):
+        # Open handle ids repeat across shards: a page can't split a run.
+        for k in (0, 1):
+            path = '/' + self._top(k)
+            self._create(path, 0)
+            self._do('open_shelf', path=path)
+        whole = self._do('list_open_shelves')['value']
+        self.assertEqual(len(whole), 2)
+        self.assertEqual(whole[0]['id'], whole[1]['id'])
+        page = self._do('list_open_shelves', limit=1)
+        self.assertEqual(len(page['value']), 2)
+        self.assertFalse(page['more'])
+
+    def test_move_1(self):
+        src = self._top(0)
+        dst = self._top(1)
+        self._create('/' + src, 3)
+        self._do('set_xattr', path='/' + src, xattr='user.a', value='1')
+        before = self._do('list_shelf_books', path='/' + src)['value']
+        reply = self._do('rename_shelf', path='/' + src, id=0,
+                         newpath='/' + dst)
+        self.assertNotIn('errmsg', reply)
+        self.assertEqual(reply['value']['id'] % 2, 1)
+        self.assertEqual(self._do('get_shelf', path='/' + src)['errno'],
+                         errno.ENOENT)
+        after = self._do('list_shelf_books', path='/' + dst)['value']
+        self.assertEqual([ b['id'] for b in after ],
+                         [ b['id'] for b in before ])
+        columns = self._do('list_shelf_books', path='/' + dst,
+                           columns='delta')['value']
+        self.assertEqual(list(BookColumns.from_wire(columns)), after)
+        self.assertEqual(self._do('get_xattr', path='/' + dst,
+                                  xattr='user.a')['value'], { 'value': '1' })
+        self.assertEqual(self._do('get_fs_stats')['value']['books_used'], 3)
+        book = self._do('get_book', id=after[0]['id'])['value']
+        self.assertEqual(book['allocated'], TMBook.ALLOC_INUSE)
+        self.assertEqual(self.router.moves['committed'], 1)
+
+    def test_move_2(self):
+        # Refused in prepare: nothing changes on either shard
+        src = self._top(0)
+        dst = self._top(1)
+        self._create('/' + src, 1)
+        self._create('/' + dst, 1)
+        reply = self._do('rename_shelf', path='/' + src, id=0,
+                         newpath='/' + dst)
+        self.assertEqual(reply['errno'], errno.EEXIST)
+        top = self._top(0, (src, ))
+        self._do('mkdir', path='/' + top, mode=0o40777)
+        reply = self._do('rename_shelf', path='/' + top, id=0,
+                         newpath='/' + self._top(1, (dst, )))
+        self.assertEqual(reply['errno'], errno.EXDEV)
+        self.assertNotIn('errmsg', self._do('get_shelf', path='/' + src))
+        self.assertEqual(self.router.moves['failed'], 2)
+        self.assertFalse(any(e.db.get_moves() for e in self.engines))
+
+    def test_move_3(self):
+        # The destination has it, but the source can't let go: the rename
+        # has happened, and the source's copy is fenced off until the
+        # next request recovers it.
+        src = self._top(0)
+        dst = self._top(1)
+        self._create('/' + src, 3)
+        shard = self.router.shards[0]
+        shard.command, shard.fail = 'finish_move', 1
+        reply = self._do('rename_shelf', path='/' + src, id=0,
+                         newpath='/' + dst)
+        self.assertNotIn('errmsg', reply)
+        self.assertEqual(self.router.moves['stranded'], 1)
+        reply = self.engines[0](self.lcp('open_shelf', path='/' + src))[0]
+        self.assertEqual(reply['errno'], errno.EBUSY)
+        self.assertEqual(self._do('get_shelf', path='/' + src)['errno'],
+                         errno.ENOENT)
+        self.assertEqual(self.router.moves['recovered'], 1)
+        self.assertEqual(self._do('get_fs_stats')['value']['books_used'], 3)
+        self.assertNotIn('errmsg', self._do('open_shelf', path='/' + dst))
+        self.assertFalse(any(e.db.get_moves() for e in self.engines))
+
+    def test_move_4(self):
+        # A router that died mid-move: the next one undoes what the
+        # destination didn't commit, and finishes what it did.
+        srcs, dsts = [ ], [ ]
+        for txn in range(2):
+            srcs.append(self._top(0, srcs))
+            dsts.append(self._top(1, dsts))
+            self._create('/' + srcs[-1], 1)
+            record = self.engines[0](self.lcp(
+                'prepare_move', path='/' + srcs[-1], txn=str(txn),
+                record=None))[0]['value']
+            self.engines[1](self.lcp(
+                'prepare_move', path='/' + dsts[-1], txn=str(txn),
+                record=record))
+        self.engines[1](self.lcp('finish_move', txn='1', commit=True))
+        router = ShardRouter([ Direct(e) for e in self.engines ])
+        listed = [ s['name'] for s in router(self.lcp(
+            'list_shelves', path='/'))[0]['value'] ]
+        self.assertEqual([ name in listed for name in srcs + dsts ],
+                         [ True, False, False, True ])
+        self.assertEqual(router.moves['recovered'], 2)
+        self.assertFalse(any(e.db.get_moves() for e in self.engines))
+
+
+if __name__ == '__main__':
+    unittest.main()
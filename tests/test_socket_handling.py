@@ -0,0 +1,443 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for socket_handling.py framing over a socketpair """
+
+import argparse
+import errno
+import select
+import socket
+import threading
+import time
+import unittest
+
+try:
+    from socket_handling import Client, Demux, OOBBroadcast, Server
+    from socket_handling import SocketReadWrite
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+
+class TestFraming(unittest.TestCase):
+
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.tx = SocketReadWrite(sock=a, selectable=False)
+        self.rx = SocketReadWrite(sock=b, selectable=True)  # like serv()
+        self.tx.framed = self.rx.framed = True
+
+    def tearDown(self):
+        self.tx.close()
+        self.rx.close()
+
+    def test_framing_1(self):
+        cmdict = { 'command': 'get_shelf', 'path': '/a{}b}{',
+                   'context': { 'seq': 42 } }
+        self.tx.send_all(cmdict)
+        self.assertEqual(self.rx.recv_all(), cmdict)
+        self.assertIsNone(self.rx.recv_all())   # nothing more, no block
+
+    def test_framing_2(self):
+        # Partial frame: None until the rest shows up
+        frame = b''.join(self.tx._frame({ 'value': 'x' * 10000 }))
+        self.tx._sock.sendall(frame[:100])
+        self.assertIsNone(self.rx.recv_all())
+        self.tx._sock.sendall(frame[100:])
+        self.assertEqual(len(self.rx.recv_all()['value']), 10000)
+
+    def test_framing_3(self):
+        self.tx.send_all({ 'OOBmsg': 'heads up' })
+        self.tx.send_all({ 'value': 1, 'context': { 'seq': 2 } })
+        self.assertEqual(self.rx.recv_all()['value'], 1)
+        self.assertEqual(self.rx.inOOB, [ 'heads up' ])
+        self.assertIsNone(self.rx.recv_all())   # until OOB is handled
+
+    def test_framing_4(self):
+        # Many frames per recv, then one much bigger than the buffer,
+        # fed a byte at a time at first to fragment it.
+        for i in range(100):
+            self.tx.send_all({ 'value': i })
+        for i in range(100):
+            self.assertEqual(self.rx.recv_all()['value'], i)
+        big = b''.join(self.tx._frame({ 'value': 'y' * (3 << 20) }))
+        for i in range(40):
+            self.tx._sock.sendall(big[i:i + 1])
+            self.assertIsNone(self.rx.recv_all())
+        self.tx._sock.setblocking(False)
+        view = memoryview(big)[40:]
+        result = None
+        while result is None:
+            try:
+                view = view[self.tx._sock.send(view):]
+            except BlockingIOError:
+                pass
+            result = self.rx.recv_all()
+        self.assertEqual(len(result['value']), 3 << 20)
+        self.assertEqual(len(self.rx._rbuf), self.rx._RBUF_MIN)  # shrunk
+
+    def test_framing_5(self):
+        self.tx.close()
+        with self.assertRaises(OSError):
+            self.rx.recv_all()
+
+    def test_framing_6(self):
+        self.tx.set_codec('compact')
+        self.rx.set_codec('compact')
+        books = [ { 'id': i, 'book_num': i, 'allocated': 1 }
+                  for i in range(1000) ]
+        self.tx.send_all({ 'value': books, 'context': { 'seq': 7 } })
+        self.assertEqual(self.rx.recv_all()['value'], books)
+        self.tx._sock.sendall(self.rx._FRAME.pack(1, self.rx.FRAME_REPLY, 0))
+        self.tx._sock.sendall(b'\xc6')     # not a type byte
+        with self.assertRaises(OSError):
+            self.rx.recv_all()
+
+    def test_framing_7(self):
+        for msg in ('one', 'two', 'one'):
+            self.tx.send_all({ 'OOBmsg': msg })
+        self.tx.send_all({ 'value': 1 })
+        self.assertEqual(self.rx.recv_all()['value'], 1)
+        self.assertEqual(self.rx.inOOB, [ 'one', 'two' ])
+        self.assertEqual(self.rx.OOBcoalesced, 1)
+
+    def test_ready_1(self):
+        self.assertFalse(self.rx.ready)
+        frame = b''.join(self.tx._frame({ 'value': 1 }))
+        self.tx._sock.sendall(frame * 2 + frame[:5])
+        self.assertEqual(self.rx.recv_all(), { 'value': 1 })
+        self.assertTrue(self.rx.ready)  # rest came in the same recv
+        self.assertEqual(self.rx.recv_all(), { 'value': 1 })
+        self.assertFalse(self.rx.ready)  # only part of the third
+
+
+class TestDemux(unittest.TestCase):
+
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.client = SocketReadWrite(sock=a, selectable=False)
+        self.server = SocketReadWrite(sock=b, selectable=False)
+        self.client.framed = self.server.framed = True
+        self.OOBs = [ ]
+        self.demux = Demux(self.client, self.handleOOB)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def handleOOB(self):
+        self.OOBs.extend(self.client.inOOB)
+
+    def serve(self, nrequests):
+        '''Collect them all, then answer newest first'''
+        requests = [ self.server.recv_all() for _ in range(nrequests) ]
+        self.server.send_all({ 'OOBmsg': 'reversing' })
+        for req in reversed(requests):
+            self.server.send_all({ 'value': req['n'],
+                                   'context': req['context'] })
+
+    def test_demux_1(self):
+        n = 8
+        results = { }
+
+        def request(i):
+            results[i] = self.demux.transact(
+                { 'command': 'x', 'n': i, 'context': { 'seq': 100 + i } })
+
+        threads = [ threading.Thread(target=request, args=(i, ))
+                    for i in range(n) ]
+        server = threading.Thread(target=self.serve, args=(n, ))
+        server.start()
+        for t in threads:
+            t.start()
+        for t in threads + [ server ]:
+            t.join(10)
+        self.assertEqual([ results[i]['value'] for i in range(n) ],
+                         list(range(n)))
+        self.assertEqual(self.OOBs, [ 'reversing' ])
+        self.assertFalse(self.demux._waiting)
+
+    def test_demux_2(self):
+        # A dead connection fails everything in flight, once each.
+        errors = [ ]
+
+        def request(i):
+            try:
+                self.demux.transact(
+                    { 'command': 'x', 'context': { 'seq': i } })
+            except OSError as e:
+                errors.append(i)
+
+        threads = [ threading.Thread(target=request, args=(i, ))
+                    for i in range(4) ]
+        for t in threads:
+            t.start()
+        for _ in range(4):
+            self.server.recv_all()
+        self.server.close()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(sorted(errors), list(range(4)))
+
+
+class TestOOBBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.node = SocketReadWrite(sock=a, selectable=False)
+        self.conn = SocketReadWrite(sock=b, selectable=True)  # server side
+        self.node.framed = self.conn.framed = True
+        self.broadcast = OOBBroadcast()
+
+    def tearDown(self):
+        self.node.close()
+        self.conn.close()
+
+    def test_broadcast_1(self):
+        other = object()
+        for sender, msg in ((other, 'a'), (self.conn, 'mine'),
+                            (other, 'b'), (other, 'a')):
+            self.broadcast.post(sender, { 'OOBmsg': msg }, [ self.conn ])
+        self.assertEqual(list(self.broadcast.due), [ self.conn ])
+        self.assertEqual(self.broadcast.backlog(self.conn), 4)
+        self.assertEqual(self.broadcast.catch_up(self.conn), 2)
+        self.assertEqual(self.broadcast.backlog(self.conn), 0)
+        self.assertEqual(self.conn.OOBcoalesced, 1)
+        self.conn.send_all({ 'value': 1 })
+        self.assertEqual(self.node.recv_all()['value'], 1)
+        self.assertEqual(self.node.inOOB, [ 'a', 'b' ])
+        self.assertEqual(self.broadcast.catch_up(self.conn), 0)
+
+    def test_broadcast_2(self):
+        for i in range(OOBBroadcast.LOG_MAX + 10):
+            self.broadcast.post(None, { 'OOBmsg': i % 3 }, [ ])
+        self.assertEqual(self.broadcast.catch_up(self.conn), 3)
+        self.assertEqual(self.conn.OOBdropped, 10)
+
+
+class TestServer(unittest.TestCase):
+    '''serv() in a thread on an ephemeral port.  It never returns, so the
+       thread is a daemon and each test gets its own server.'''
+
+    def setUp(self):
+        self.handled = [ ]
+        self.start(self.handler)
+
+    def start(self, handler):
+        self.server = Server(argparse.Namespace(port=0, verbose=0))
+        self.port = self.server._sock.getsockname()[1]
+        thread = threading.Thread(target=self.server.serv,
+                                  args=(handler, ), daemon=True)
+        thread.start()
+
+    handler_OOB = None
+
+    def handler(self, cmdict):
+        self.handled.append(cmdict['context']['seq'])
+        OOBmsg = None
+        if self.handler_OOB:
+            OOBmsg = { 'OOBmsg': self.handler_OOB }
+        return { 'value': 'x' * cmdict['size'],
+                 'context': cmdict['context'] }, OOBmsg
+
+    def connect(self):
+        client = Client(selectable=False)
+        client.connect('localhost', self.port, retry=False)
+        return client
+
+    def request(self, client, seq, size=0):
+        client.send_all({ 'command': 'x', 'size': size,
+                          'context': { 'seq': seq } })
+
+    def reply(self, client):
+        rsp = None
+        OOBs = [ ]
+        while rsp is None:
+            rsp = client.recv_all()
+            OOBs += client.inOOB
+            client.clearOOB()
+        client.inOOB = OOBs
+        return rsp
+
+    def test_backpressure_1(self):
+        # A client that doesn't read its replies gets its requests held,
+        # without holding up anyone else.
+        slow, fast = self.connect(), self.connect()
+        nslow = 4 * Server.BACKLOG_HIWAT // (1 << 20)
+        for seq in range(nslow):
+            self.request(slow, seq, 1 << 20)
+        t0 = time.time()
+        for seq in range(nslow, nslow + 20):
+            self.request(fast, seq)
+            self.assertEqual(self.reply(fast)['context']['seq'], seq)
+        self.assertLess(time.time() - t0, 1.0)
+        held = nslow - len([ s for s in self.handled if s < nslow ])
+        self.assertGreater(held, 0)
+        seqs = [ self.reply(slow)['context']['seq'] for _ in range(nslow) ]
+        self.assertEqual(seqs, list(range(nslow)))
+        slow.close()
+        fast.close()
+
+    def test_oob_1(self):
+        nodes = [ self.connect() for _ in range(3) ]
+        self.handler_OOB = 'news'
+        self.request(nodes[0], 1)
+        self.assertEqual(self.reply(nodes[0])['context']['seq'], 1)
+        self.handler_OOB = None
+        for node in nodes[1:]:
+            self.request(node, 2)
+            self.assertEqual(self.reply(node)['context']['seq'], 2)
+            self.assertEqual(node.inOOB, [ 'news' ])
+        self.assertEqual(nodes[0].inOOB, [ ])
+        for node in nodes:
+            node.close()
+
+    def test_offload_1(self):
+        # Offloaded commands don't hold up the ones behind them, and their
+        # replies go out whenever (and from whatever thread) they finish.
+        handler = Offloader()
+        self.start(handler)
+        client = self.connect()
+        for seq, command in ((1, 'slow'), (2, 'slow'), (3, 'x')):
+            client.send_all({ 'command': command, 'context': { 'seq': seq } })
+        self.assertEqual(self.reply(client)['value'], 'inline')
+        held = handler.held
+        while len(held) < 2:
+            time.sleep(0.01)
+        for cmdict, done in reversed(held):
+            thread = threading.Thread(
+                target=done, args=({ 'value': 'offloaded',
+                                     'context': cmdict['context'] }, None))
+            thread.start()
+            thread.join()
+        replies = [ self.reply(client) for _ in held ]
+        self.assertEqual([ r['context']['seq'] for r in replies ], [ 2, 1 ])
+        client.close()
+
+    def test_commit_1(self):
+        # Replies wait for the commit covering their work, and everything
+        # behind them waits too.  Lost work is answered with EIO.
+        handler = Committer()
+        self.start(handler)
+        client = self.connect()
+        for seq, command in ((1, 'write'), (2, 'read')):
+            client.send_all({ 'command': command, 'context': { 'seq': seq } })
+        while handler.commands < 2:
+            time.sleep(0.01)
+        self.assertEqual(select.select([ client ], [ ], [ ], 0.2)[0], [ ])
+        handler.outcome = 'commits'
+        self.assertEqual([ self.reply(client)['context']['seq']
+                           for _ in range(2) ], [ 1, 2 ])
+        client.send_all({ 'command': 'write', 'context': { 'seq': 3 } })
+        while handler.commands < 3:
+            time.sleep(0.01)
+        handler.outcome = 'aborts'
+        rsp = self.reply(client)
+        self.assertEqual((rsp['errno'], rsp['context']['seq']),
+                         (errno.EIO, 3))
+        client.close()
+
+    def test_stream_1(self):
+        # A stream goes out a page per pass: others are served meanwhile.
+        self.start(Pager(40000))
+        client, other = self.connect(), self.connect()
+        demux = Demux(client)
+        stream = demux.stream({ 'command': 'pages', 'stream': True,
+                                'limit': 1000, 'context': { 'seq': 1 } })
+        self.assertEqual(next(stream), { 'id': 0, 'x': 'y' * 100 })
+        other.send_all({ 'command': 'x', 'context': { 'seq': 2 } })
+        self.assertEqual(self.reply(other)['value'], [ ])
+        ids = [ 0 ] + [ entry['id'] for entry in stream ]
+        self.assertEqual(ids, list(range(40000)))
+        self.assertFalse(demux._streams)
+        client.close()
+        other.close()
+
+
+class Pager(object):
+    '''A handler that pages through range(n) as the engine would'''
+
+    def __init__(self, n):
+        self.n = n
+
+    def __call__(self, cmdict):
+        first = cmdict.get('after_id', -1) + 1
+        last = min(first + cmdict.get('limit', self.n), self.n) \
+            if cmdict['command'] == 'pages' else first
+        return { 'value': [ { 'id': i, 'x': 'y' * 100 }
+                            for i in range(first, last) ],
+                 'after_id': last - 1,
+                 'more': last < self.n,
+                 'context': cmdict['context'] }, None
+
+
+class Offloader(object):
+    '''A handler that keeps "slow" commands for the test to finish.'''
+
+    def __init__(self):
+        self.held = [ ]
+
+    def __call__(self, cmdict):
+        return { 'value': 'inline', 'context': cmdict['context'] }, None
+
+    def offload(self, cmdict, done):
+        if cmdict['command'] != 'slow':
+            return False
+        self.held.append((cmdict, done))
+        return True
+
+
+class Committer(object):
+    '''A handler with a group commit the test ends, one way or the other'''
+
+    def __init__(self):
+        self.commands = 0
+        self.pending = False
+        self.outcome = None
+        self.ended = dict(commits=0, aborts=0)
+
+    def __call__(self, cmdict):
+        self.commands += 1
+        if cmdict['command'] == 'write':
+            self.pending = True
+        return { 'value': cmdict['command'],
+                 'context': cmdict['context'] }, None
+
+    def flush(self):
+        if not self.pending:
+            return None
+        if self.outcome is None:
+            return 0.01
+        self.ended[self.outcome] += 1
+        self.pending = False
+        self.outcome = None
+        return None
+
+    def commit_token(self):
+        if not self.pending:
+            return None
+        return dict(self.ended)
+
+    def committed(self, token):
+        if self.ended['aborts'] != token['aborts']:
+            return False
+        if self.ended['commits'] != token['commits']:
+            return True
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,685 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for sqlbackend.py against a scratch SQLite3 database """
+
+import argparse
+import os
+import re
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from backend_sqlite3 import LibrarianDBackendSQLite3, SQLite3assist
+    from book_register import create_empty_db
+    from book_shelf_bos import TMShelf
+    from cmdproto import LibrarianCommandProtocol
+    from engine import LibrarianCommandEngine
+    from sqlbackend import LibrarianDBackendSQL
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+_DIR = stat.S_IFDIR + 0o777
+_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+_CONFIG = os.path.join(_SRC, '..', 'configfiles', 'fame.json')
+
+
+def scratch_backend(db_file):
+    '''Schema only plus the root shelves book_register.py would add.'''
+    cur = SQLite3assist(db_file=db_file)
+    create_empty_db(cur)
+    for row in ((1, 'garbage', 0), (2, '.', 2), (3, 'lost+found', 2)):
+        cur.execute('INSERT INTO shelves VALUES (?,0,0,0,0,0,?,?,?,2)',
+                    (row[0], row[1], _DIR, row[2]))
+    cur.commit()
+    db = LibrarianDBackendSQL.__new__(LibrarianDBackendSQL)
+    db._cur = cur
+    return db
+
+
+class TestShelfPaths(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(self.db_file)
+        self.db = scratch_backend(self.db_file)
+        parent_id = 2
+        self.ids = [ ]
+        for name in ('a', 'b', 'c'):
+            shelf = TMShelf(name=name, parent_id=parent_id, mode=_DIR)
+            parent_id = self.db.create_shelf(shelf).id
+            self.ids.append(parent_id)
+        self.db.create_shelf(TMShelf(name='f', parent_id=parent_id))
+
+    def tearDown(self):
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.db_file + suffix)
+            except OSError:
+                pass
+
+    def test_get_shelves_by_path_1(self):
+        shelves = self.db.get_shelves_by_path(['a', 'b', 'c', 'f'])
+        self.assertEqual([s.name for s in shelves], ['a', 'b', 'c', 'f'])
+        self.assertEqual([s.id for s in shelves[:3]], self.ids)
+
+    def test_get_shelves_by_path_2(self):
+        shelves = self.db.get_shelves_by_path(['a', 'x', 'c'])
+        self.assertEqual([s.name for s in shelves], ['a'])
+
+    def test_get_shelves_by_path_3(self):
+        shelves = self.db.get_shelves_by_path(['c', 'f'], self.ids[1])
+        self.assertEqual([s.name for s in shelves], ['c', 'f'])
+
+    def test_get_shelf_path_1(self):
+        shelf = TMShelf(name='f', parent_id=self.ids[-1])
+        shelf.matchfields = ('name', 'parent_id')
+        self.assertEqual(self.db.get_shelf_path(shelf), '/a/b/c/f')
+
+    def test_get_shelf_path_2(self):
+        shelf = TMShelf(id=self.ids[0])
+        shelf.matchfields = ('id', )
+        self.assertEqual(self.db.get_shelf_path(shelf), '/a')
+        shelf.id = 9999
+        self.assertIsNone(self.db.get_shelf_path(shelf))
+
+    def test_statements_1(self):
+        stats = self.db.statement_stats
+        before = dict((sql, count) for sql, (count, secs) in stats.items())
+        for parent_id in [ 2 ] + self.ids:
+            self.db.get_directory_shelves(TMShelf(id=parent_id))
+            shelf = TMShelf(id=parent_id)
+            shelf.matchfields = ('id', )
+            self.db.get_shelf(shelf)
+        new = [ (sql, count - before.get(sql, 0))
+                for sql, (count, secs) in stats.items()
+                if count != before.get(sql, 0) ]
+        # One text each, whatever the ids were
+        self.assertEqual(len(new), 2)
+        self.assertEqual([ count for sql, count in new ], [ 4, 4 ])
+        self.assertIn('parent_id=?', ' '.join(sql for sql, count in new))
+
+    def test_statements_2(self):
+        # IN lists come in a few lengths, whatever the number of ids
+        self.db._cur.executemany(
+            'INSERT INTO books VALUES (?, 0, ?, 0, 0)',
+            [ (n + 1, n) for n in range(700) ])
+        self.db._cur.commit()
+        for n in range(1, 701, 23):
+            books = self.db.get_books_by_ids(range(n, 0, -1))
+            self.assertEqual([ book.id for book in books ],
+                             list(range(n, 0, -1)))
+        shapes = [ key for key in self.db._statements
+                   if key[0] == 'get_books_by_ids' ]
+        self.assertEqual(sorted(shapes),
+                         [ ('get_books_by_ids', n) for n in (8, 64, 500) ])
+
+
+class TestCommandTransactions(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(self.db_file)
+        self.db = scratch_backend(self.db_file)
+
+    def tearDown(self):
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.db_file + suffix)
+            except OSError:
+                pass
+
+    def _exists(self, name):
+        shelf = TMShelf(name=name, parent_id=2)
+        shelf.matchfields = ('name', 'parent_id')
+        return self.db.get_shelf(shelf) is not None
+
+    def test_command_transaction_1(self):
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='a', parent_id=2))
+        root = TMShelf(id=2, mode=_DIR)
+        root.matchfields = ('mode', )
+        self.db.modify_shelf(root, commit=True)
+        self.assertTrue(self.db.pending)    # commit was absorbed
+        self.assertFalse(self.db.end_command())
+        self.assertFalse(self.db.pending)
+        self.assertTrue(self._exists('a'))
+
+    def test_command_transaction_2(self):
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='a', parent_id=2))
+        self.assertTrue(self.db.end_command(ok=False))
+        self.assertFalse(self._exists('a'))
+
+    def test_command_transaction_3(self):
+        # The window holds the first command; the second one's failure
+        # must not take the first one down with it.
+        self.db.group_commit_secs = 60.0
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='a', parent_id=2))
+        self.db.end_command()
+        self.assertTrue(self.db.pending)
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='b', parent_id=2))
+        self.db.end_command(ok=False)
+        self.assertGreater(self.db.flush(), 0)
+        self.assertIsNone(self.db.flush(force=True))
+        self.assertFalse(self.db.pending)
+        self.assertTrue(self._exists('a'))
+        self.assertFalse(self._exists('b'))
+
+    def test_command_transaction_4(self):
+        # Nested, as for the commands of a batch
+        self.db.begin_command()
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='a', parent_id=2))
+        self.assertFalse(self.db.end_command())
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='b', parent_id=2))
+        self.db.rollback()      # only as far as the inner begin
+        self.db.create_shelf(TMShelf(name='c', parent_id=2))
+        self.assertTrue(self.db.end_command(ok=False))
+        self.assertTrue(self.db.pending)
+        self.assertFalse(self.db.end_command())
+        self.assertFalse(self.db.pending)
+        self.assertEqual([ self._exists(n) for n in 'abc' ],
+                         [ True, False, False ])
+
+    def test_command_transaction_5(self):
+        # A token follows its work to the commit, or to its loss.
+        self.db.group_commit_secs = 60.0
+        self.assertIsNone(self.db.commit_token())
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='a', parent_id=2))
+        self.db.end_command()
+        token = self.db.commit_token()
+        self.assertIsNone(self.db.committed(token))
+        self.db.flush(force=True)
+        self.assertTrue(self.db.committed(token))
+        self.db._cur.execute('UPDATE shelves SET mode=mode WHERE id=2')
+        token = self.db.commit_token()
+        self.db._cur.rollback()
+        self.assertFalse(self.db.committed(token))
+        self.assertIsNone(self.db.commit_token())
+
+
+class TestReadOnly(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(self.db_file)
+        self.db = scratch_backend(self.db_file)
+        self.ro = SQLite3assist(db_file=self.db_file, ro=True)
+
+    def tearDown(self):
+        self.ro.close()
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.db_file + suffix)
+            except OSError:
+                pass
+
+    def _names(self):
+        self.ro.execute('SELECT name FROM shelves ORDER BY id')
+        return [ r[0] for r in self.ro.fetchall() ]
+
+    def test_read_only_1(self):
+        # A reader sees only what's committed, and a snapshot of it for
+        # as long as its own command lasts.
+        self.db.group_commit_secs = 60.0
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='a', parent_id=2))
+        self.db.end_command()
+        self.assertTrue(self.db.pending)
+        self.assertNotIn('a', self._names())
+        self.ro.begin()
+        names = self._names()
+        self.db.flush(force=True)
+        self.assertEqual(self._names(), names)
+        self.assertFalse(self.ro.end())
+        self.assertIn('a', self._names())
+
+    def test_read_only_2(self):
+        with self.assertRaises(Exception):
+            self.ro.execute('DELETE FROM shelves')
+
+
+class TestReaderBackend(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(self.db_file)
+        db = scratch_backend(self.db_file)
+        db._cur.execute('INSERT INTO globals VALUES(?, ?, ?, ?, ?)',
+                        (LibrarianDBackendSQL.SCHEMA_VERSION, 1 << 33,
+                         1 << 36, 8, 1))
+        db.close()
+        self.db = LibrarianDBackendSQLite3(
+            argparse.Namespace(db_file=self.db_file, shard='1/2'))
+        self.reader = self.db.reader()
+
+    def tearDown(self):
+        self.reader.close()
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.db_file + suffix)
+            except OSError:
+                pass
+
+    def _names(self):
+        return [ shelf.name for shelf in self.reader.get_shelf_all() ]
+
+    def test_reader_backend_1(self):
+        # Same database and shard, but it reads past the writer's lock
+        # and sees only what's committed.
+        self.assertEqual(self.reader.shard, (1, 2))
+        self.db.begin_command()
+        self.db.create_shelf(TMShelf(name='a', parent_id=2))
+        self.assertNotIn('a', self._names())
+        self.assertFalse(self.db.end_command())
+        self.assertIn('a', self._names())
+        with self.assertRaises(Exception):
+            self.reader.create_shelf(TMShelf(name='b', parent_id=2))
+
+
+class TestIteration(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(self.db_file)
+        self.db = scratch_backend(self.db_file)
+        self.nrows = 2 * SQLite3assist._FETCH_CHUNK + 3
+        self.db._cur.executemany(
+            'INSERT INTO books VALUES (?, 0, ?, 0, 0)',
+            [ (n + 1, n) for n in range(self.nrows) ])
+        self.db._cur.commit()
+
+    def tearDown(self):
+        self.db.close()
+        os.unlink(self.db_file)
+
+    def test_iteration_1(self):
+        books = self.db.get_book_all()
+        self.assertEqual([ b.id for b in books ],
+                         list(range(1, self.nrows + 1)))
+        self.assertEqual(books[-1].book_num, self.nrows - 1)
+        # Abandon a query mid-chunk: the next one mustn't see its leftovers
+        cur = self.db._cur
+        cur.execute('SELECT * FROM books')
+        cur.iterclass = 'default'
+        self.assertEqual(next(cur).id, 1)
+        cur.execute('SELECT id FROM books WHERE id > ?', self.nrows - 2)
+        cur.iterclass = None
+        self.assertEqual([ r for r in cur ], [ (self.nrows - 1, ),
+                                               (self.nrows, ) ])
+
+    def test_intlv_group_1(self):
+        cur = self.db._cur
+        cur.execute('UPDATE books SET intlv_group=id % 3, allocated=id % 2')
+        get = self.db.get_books_by_intlv_group
+        books = get(self.nrows, [ 1 ], 'ANY')
+        self.assertTrue(books and all(b.intlv_group == 1 for b in books))
+        books = get(self.nrows, [ 1 ], [ 1 ], exclude=True)
+        self.assertTrue(all(b.intlv_group != 1 and b.allocated == 1
+                            for b in books))
+        self.assertEqual(len(books), len(
+            [ n for n in range(1, self.nrows + 1) if n % 3 != 1 and n % 2 ]))
+        books = get(2, [ 0, 2 ], 'ANY', ascending=False, after_id=100)
+        self.assertEqual([ b.id for b in books ], [ 99, 98 ])
+
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(self.db_file)
+        self.db = scratch_backend(self.db_file)
+        self.db.close()
+        self.lazy = [ SQLite3assist(db_file=self.db_file, lazy=True)
+                      for _ in range(2) ]
+        for cur in self.lazy:
+            cur.execute('PRAGMA busy_timeout=100')
+
+    def tearDown(self):
+        for cur in self.lazy:
+            cur.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.db_file + suffix)
+            except OSError:
+                pass
+
+    def _count(self, cur):
+        cur.execute('SELECT COUNT(*) FROM shelves')
+        return cur.fetchone()[0]
+
+    def test_lazy_1(self):
+        # Both read inside a command; only the first write takes the lock.
+        a, b = self.lazy
+        a.begin()
+        b.begin()
+        self.assertEqual(self._count(a), self._count(b))
+        self.assertFalse(a._conn.in_transaction)
+        a.execute('DELETE FROM shelves WHERE id=3')
+        self.assertTrue(a._conn.in_transaction)
+        self.assertEqual(self._count(b), 3)     # not committed yet
+        self.assertFalse(a.end())
+        self.assertFalse(b.end())               # never wrote
+        a.commit()
+        self.assertEqual(self._count(b), 2)
+        self.assertEqual(a.write_waits['acquired'], 1)
+        self.assertEqual(b.write_waits['acquired'], 0)
+
+    def test_lazy_2(self):
+        # Nested levels opened late still unwind one at a time.
+        a = self.lazy[0]
+        a.begin()
+        a.begin()
+        a.rollback()        # nothing to roll back to yet
+        a.execute('DELETE FROM shelves WHERE id=3')
+        self.assertTrue(a.end(ok=False))
+        self.assertEqual(self._count(a), 3)
+        a.begin()
+        a.execute('DELETE FROM shelves WHERE id=2')
+        self.assertFalse(a.end())
+        self.assertFalse(a.end())
+        a.commit()
+        self.assertEqual(self._count(a), 2)
+
+    def _write_later(self, waits):
+        cur = SQLite3assist(db_file=self.db_file, lazy=True)
+        cur.begin()
+        waits.append(self._count(cur))          # reads don't wait
+        cur.hold_writes()
+        cur.end()
+        waits.append(cur.write_waits)
+        cur.close()
+
+    def test_lazy_3(self):
+        # The second writer waits for the first to finish, not longer.
+        a = self.lazy[0]
+        a.begin()
+        a.hold_writes()
+        waits = [ ]
+        thread = threading.Thread(target=self._write_later, args=(waits, ))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(waits, [ 3 ])
+        a.end()
+        thread.join(timeout=1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(waits[1]['contended'], 1)
+        self.assertLess(waits[1]['max_wait_secs'], 0.5)
+
+
+class TestSOCStatus(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(self.db_file)
+        self.db = scratch_backend(self.db_file)
+        for node_id in (1, 2):
+            self.db.execute(
+                'INSERT INTO SOCs VALUES (?,"",0,"","",0,0,0,0,0,0)',
+                node_id)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.db_file + suffix)
+            except OSError:
+                pass
+
+    def _socs(self):
+        self.db.execute('SELECT node_id, status, heartbeat, cpu_percent '
+                        'FROM SOCs ORDER BY node_id')
+        return self.db.fetchall()
+
+    def test_soc_status_1(self):
+        self.db.modify_node_soc_status(1)
+        self.db.modify_node_soc_status(2, 1, 33)
+        self.assertFalse(self.db.pending)
+        self.assertEqual(self._socs(), [(1, 0, 0, 0), (2, 0, 0, 0)])
+        self.db.flush()     # first flush is due at once
+        socs = self._socs()
+        self.assertFalse(self.db.pending)
+        self.assertGreater(socs[0][2], 0)
+        self.assertEqual(socs[0][1::2], (0, 0))   # heartbeat only
+        self.assertEqual(socs[1][1::2], (1, 33))
+
+    def test_soc_status_2(self):
+        self.db.modify_node_soc_status(1)
+        self.db.flush()
+        self.db.modify_node_soc_status(2, 1, 33)
+        wait = self.db.flush()      # held for SOC_FLUSH_SECS
+        self.assertTrue(0 < wait <= self.db.SOC_FLUSH_SECS)
+        self.assertEqual(self._socs()[1][1], 0)
+        self.db.flush(force=True)   # as at shutdown
+        self.assertEqual(self._socs()[1][1], 1)
+
+
+class TestQueryPlans(unittest.TestCase):
+    '''Every statement the engine issues for a run of commands, as
+       EXPLAIN QUERY PLAN sees it.  A full scan fails unless it's of a
+       table sized by the topology or a query for a whole table.
+       book_counts is one row per IG and allocation state.'''
+
+    _TOPOLOGY = frozenset(('globals', 'FRDnodes', 'SOCs', 'FAModules',
+                           'book_counts'))
+
+    _WHOLE_TABLE = re.compile(
+        r'SELECT \* FROM (books|books_on_shelves|opened_shelves|shelves)'
+        r'( WHERE 1)?( ORDER BY id)?( LIMIT \d+)?$')
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_file = os.path.join(self.tmpdir.name, 'librarian.db')
+        subprocess.check_call(
+            [ sys.executable, os.path.join(_SRC, 'book_register.py'),
+              '-d', db_file, _CONFIG ], stdout=subprocess.DEVNULL)
+        self.engine = LibrarianCommandEngine(LibrarianDBackendSQLite3(
+            argparse.Namespace(db_file=db_file, verbose=0)))
+        self.lcp = LibrarianCommandProtocol({
+            'node_id': min(self.engine.node_ids), 'pid': 1, 'physloc': '1'})
+        self.conn = self.engine.db._cur._conn
+        self.statements = [ ]
+        self.conn.set_trace_callback(self.statements.append)
+
+    def tearDown(self):
+        self.conn.set_trace_callback(None)
+        self.engine.db.close()
+        self.tmpdir.cleanup()
+
+    def _do(self, *args, **kwargs):
+        rsp = self.engine(self.lcp(*args, **kwargs))[0]
+        self.assertNotIn('errmsg', rsp, '%s: %s' % (args[0], rsp))
+        return rsp['value']
+
+    def _workload(self):
+        size = self.engine.book_size_bytes
+        self._do('mkdir', path='/d', mode=_DIR)
+        shelf = self._do('create_shelf', path='/d/f', mode=0o100666)
+        self._do('resize_shelf', path='/d/f', id=shelf['id'],
+                 size_bytes=3 * size, zero_enabled=False)
+        self._do('list_shelf_books', path='/d/f')
+        self._do('list_shelf_books', path='/d/f', columns='delta')
+        self._do('set_xattr', path='/d/f', xattr='user.a', value='1')
+        self._do('get_xattr', path='/d/f', xattr='user.a')
+        self._do('list_xattrs', path='/d/f')
+        self._do('remove_xattr', path='/d/f', xattr='user.a')
+        self._do('list_shelves', path='/d')
+        self._do('get_shelf_path', name='f', parent_id=shelf['parent_id'])
+        self._do('symlink', path='/d/l', target='/d/f')
+        self._do('readlink', path='/d/l')
+        again = self._do('open_shelf', path='/d/f')
+        self._do('list_open_shelves')
+        self._do('list_open_shelves', after_id=0, limit=10)
+        for handle in (shelf['open_handle'], again['open_handle']):
+            self._do('close_shelf', id=shelf['id'], open_handle=handle)
+        self._do('rename_shelf', path='/d/f', id=shelf['id'],
+                 newpath='/d/g')
+        self._do('set_am_time', path='/d/g', atime=1, mtime=2)
+        books = self._do('get_book_all', limit=10)
+        self._do('get_book_all', after_id=books[-1]['id'], limit=10)
+        self._do('get_book', id=books[0]['id'])
+        self._do('get_book_ig', intlv_group=[ 0 ], limit=10)
+        self._do('get_book_info_all', intlv_group=0, limit=10)
+        self._do('get_fs_stats')
+        self._do('resize_shelf', path='/d/g', id=shelf['id'],
+                 size_bytes=size, zero_enabled=True)
+        self._do('destroy_shelf', path='/d/l')
+        self._do('destroy_shelf', path='/d/g')
+        self._do('rmdir', path='/d')
+        self._do('kill_zombie_books')
+
+    def test_query_plans_1(self):
+        self._workload()
+        self.conn.set_trace_callback(None)
+        tables = set(r[0] for r in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"))
+        scans = { }
+        for sql in self.statements:
+            sql = ' '.join(sql.split())
+            if sql.split(' ', 1)[0].upper() not in (
+                    'SELECT', 'UPDATE', 'DELETE', 'WITH'):
+                continue
+            if self._WHOLE_TABLE.match(sql):
+                continue
+            for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql):
+                scanned = re.match(r'SCAN (TABLE )?(\w+)', row[3])
+                if scanned and scanned.group(2) in tables and \
+                   scanned.group(2) not in self._TOPOLOGY:
+                    scans[sql] = row[3]
+        self.assertGreater(len(self.statements), 50)
+        self.assertEqual(scans, { })
+
+
+
+class TestReaderEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_file = os.path.join(self.tmpdir.name, 'librarian.db')
+        subprocess.check_call(
+            [ sys.executable, os.path.join(_SRC, 'book_register.py'),
+              '-d', db_file, _CONFIG ], stdout=subprocess.DEVNULL)
+        self.engine = LibrarianCommandEngine(LibrarianDBackendSQLite3(
+            argparse.Namespace(db_file=db_file, verbose=0)))
+        self.reader = self.engine.reader(self.engine.db.reader())
+        self.lcp = LibrarianCommandProtocol({
+            'node_id': min(self.engine.node_ids), 'pid': 1, 'physloc': '1'})
+
+    def tearDown(self):
+        self.reader.db.close()
+        self.engine.db.close()
+        self.tmpdir.cleanup()
+
+    def _do(self, engine, *args, **kwargs):
+        rsp = engine(self.lcp(*args, **kwargs))[0]
+        self.assertNotIn('errmsg', rsp, '%s: %s' % (args[0], rsp))
+        return rsp['value']
+
+    def _names(self):
+        return [ shelf['name']
+                 for shelf in self._do(self.reader, 'list_shelves',
+                                       path='/d') ]
+
+    def test_reader_engine_1(self):
+        # A reader's command sees one snapshot, even if the writer commits
+        # between its SELECTs.
+        self._do(self.engine, 'mkdir', path='/d', mode=_DIR)
+        get_directory_shelves = self.reader.db.get_directory_shelves
+
+        def meanwhile(shelf):
+            self._do(self.engine, 'create_shelf', path='/d/x', mode=0o100666)
+            self.assertFalse(self.engine.db.pending)
+            return get_directory_shelves(shelf)
+
+        self.reader.db.get_directory_shelves = meanwhile
+        self.assertEqual(self._names(), [ '.', '..' ])
+        self.reader.db.get_directory_shelves = get_directory_shelves
+        self.assertEqual(self._names(), [ '.', '..', 'x' ])
+
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_file = os.path.join(self.tmpdir.name, 'librarian.db')
+        subprocess.check_call(
+            [ sys.executable, os.path.join(_SRC, 'book_register.py'),
+              '-d', db_file, _CONFIG ], stdout=subprocess.DEVNULL)
+        args = argparse.Namespace(db_file=db_file, verbose=0)
+        self.engine = LibrarianCommandEngine(
+            LibrarianDBackendSQLite3(args, lazy=True))
+        self.engine.start_workers(
+            lambda: LibrarianDBackendSQLite3(args, lazy=True), 2)
+        self.lcp = LibrarianCommandProtocol({
+            'node_id': min(self.engine.node_ids), 'pid': 1, 'physloc': '1'})
+
+    def tearDown(self):
+        self.engine.close()
+        self.engine.db.close()
+        self.tmpdir.cleanup()
+
+    def test_workers_1(self):
+        # close_shelf by id and destroy_shelf by path are the same shelf,
+        # so a destroy waits for a close's locks.
+        shelf = self.engine(self.lcp('create_shelf', path='/f',
+                                     mode=0o100666))[0]['value']
+        close = self.lcp('close_shelf', id=shelf['id'],
+                         open_handle=shelf['open_handle'])
+        destroy = self.lcp('destroy_shelf', path='/f')
+        keys = self.engine.shelf_lock_keys(close)
+        self.assertNotIn('errmsg', self.engine(close)[0])
+        self.assertIn(('shelf', str(shelf['id'])),
+                      self.engine.shelf_lock_keys(destroy))
+        replies = [ ]
+        done = threading.Event()
+
+        def destroyed(result, OOBmsg):
+            replies.append(result)
+            done.set()
+
+        with self.engine.locks.held(keys):
+            self.engine.workers.submit(destroy, destroyed)
+            self.assertFalse(done.wait(0.2))
+        self.assertTrue(done.wait(5))
+        self.assertNotIn('errmsg', replies[0])
+        self.assertEqual(self.engine.locks.stats['shelf']['contended'], 1)
+
+if __name__ == '__main__':
+    unittest.main()